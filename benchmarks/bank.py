@@ -0,0 +1,47 @@
+# coding: utf-8
+"""問題集の出題文を 1 つずつ build_automaton で作る場合と、bank.BankBuilder で search_parents のメモを
+共有して作る場合の時間と search_parents の回数を比べる
+
+    PYTHONPATH=. python benchmarks/bank.py [出題文の数]
+"""
+from __future__ import annotations
+import random
+import sys
+import time
+from emil import data
+from emil.rule import Rule
+from emil.builder import BuildStats, build_automaton
+from emil.bank import BankBuilder
+
+WORDS = ["きょうは", "いい", "てんき", "ですね", "がっこう", "しんぶん", "にゃんこ", "ちょっと",
+         "こんにちは", "ありがとう", "じてんしゃ", "きって", "ぎゅうにゅう", "おんせん", "、", "。"]
+
+
+def question_bank(size: int) -> list:
+    rng = random.Random(0)
+    return ["".join(rng.choice(WORDS) for _ in range(rng.randint(2, 8))) for _ in range(size)]
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    texts = question_bank(size)
+    print(f"{'rule':<40} {'separate[s]':>12} {'bank[s]':>8} {'calls':>8} {'bank calls':>11} {'saved':>6}")
+    for filename in ["google_ime_default_roman_table.txt", "google_ime_tomoemon_azik.txt"]:
+        rule = Rule.from_file(data.filepath(filename), data.DIRECT_INPUTTABLE)
+        stats = BuildStats()
+        started = time.perf_counter()
+        for text in texts:
+            build_automaton(rule, text, stats)
+        separate = time.perf_counter() - started
+
+        builder = BankBuilder(rule)
+        started = time.perf_counter()
+        for text in sorted(texts, key=lambda t: t[::-1]):
+            builder.build(text)
+        bank = time.perf_counter() - started
+        print(f"{filename:<40} {separate:>12.2f} {bank:>8.2f} {stats.search_parents_calls:>8} "
+              f"{builder.stats.search_parents_calls:>11} {builder.stats.saved_ratio:>6.1%}")
+
+
+if __name__ == "__main__":
+    main()
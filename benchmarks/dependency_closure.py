@@ -0,0 +1,71 @@
+# coding: utf-8
+"""Rule.fill_dependency_paths による build_automaton あたりのコストの変化を測る
+
+AZIK の「@ → ん」「ん@ → ＠」のように next で連なる Entry を depth 段重ねたルールで、
+EntryNode ごとに dependencies をたどっていた以前の方法と、Rule で計算済みの dependency_paths を
+参照する現在の方法とで build_automaton の時間を比べる
+
+    PYTHONPATH=. python benchmarks/dependency_closure.py
+"""
+from __future__ import annotations
+import timeit
+from typing import List
+from emil import data
+from emil.rule import Rule, Entry, DependentEntry
+from emil.builder import EntryNode, build_automaton
+
+
+def legacy_flatten_dependencies(self: EntryNode) -> List[List[DependentEntry]]:
+    # fill_dependency_paths 導入前の実装
+    def backtrack(entry, current_stack, result):
+        if not entry.dependencies or entry.substitutables:
+            result.append(current_stack)
+        for d in entry.dependencies:
+            new_stack = current_stack[:]
+            new_stack.insert(0, d)
+            backtrack(d, new_stack, result)
+        for s in entry.substitutables:
+            new_stack = current_stack[:]
+            new_stack.insert(0, s)
+            backtrack(s, new_stack, result)
+    result: List[List[DependentEntry]] = []
+    backtrack(self.entry, [], result)
+    return [tuple(d) for d in result]
+
+
+def chain_rule(depth: int, width: int) -> Rule:
+    """「@」から始まり next を depth 段たどって「＠」を出力する、各段の入力方法が width 通りあるルール"""
+    # 各段の next には直接入力できない文字（①②③…）を使う
+    marks = [chr(0x2460 + i) for i in range(depth)]
+    elist = [Entry("a", "あ", ""), Entry("@", "", marks[0])]
+    for i in range(1, depth):
+        elist.append(Entry(f"{marks[i-1]}@", "", marks[i]))
+        # 各段に別の入力方法も用意して、依存関係の列の数を増やす
+        for j in range(width - 1):
+            elist.append(Entry(f"{marks[i-1]}{j}", "", marks[i]))
+    elist.append(Entry(f"{marks[-1]}@", "＠", ""))
+    # 別の入力方法に使う数字も直接入力できるようにする
+    return Rule(elist, direct_inputtable=data.DIRECT_INPUTTABLE | set("0123456789"))
+
+
+def bench(rule: Rule, text: str, number: int) -> float:
+    return min(timeit.repeat(lambda: build_automaton(rule, text), number=number, repeat=3)) / number
+
+
+def main():
+    text = "あ＠" * 50
+    print(f"{'depth':>5} {'width':>5} {'legacy[ms]':>11} {'current[ms]':>12} {'speedup':>8}")
+    for depth, width in [(2, 1), (16, 1), (64, 1), (256, 1), (4, 3), (6, 3)]:
+        rule = chain_rule(depth, width)
+        current = bench(rule, text, 5)
+        original = EntryNode.flatten_dependencies
+        EntryNode.flatten_dependencies = legacy_flatten_dependencies
+        try:
+            legacy = bench(rule, text, 5)
+        finally:
+            EntryNode.flatten_dependencies = original
+        print(f"{depth:>5} {width:>5} {legacy*1000:>11.2f} {current*1000:>12.2f} {legacy/current:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
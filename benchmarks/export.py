@@ -0,0 +1,45 @@
+# coding: utf-8
+"""export.dumps の平坦な形式と、Automaton をそのまま pickle したものとで、サイズと読み込み時間を比べる
+
+    PYTHONPATH=. python benchmarks/export.py
+"""
+from __future__ import annotations
+import pickle
+import sys
+import timeit
+from emil import data, export
+from emil.rule import Rule
+from emil.builder import build_automaton, build_merged_automaton
+
+TEXTS = {
+    "word": "きょうはいいてんきですね",
+    "sentence": "きょうはいいてんきですね、しんぶんをよみにがっこうへいきました。" * 30,
+}
+
+
+def best(f, number: int) -> float:
+    return min(timeit.repeat(f, number=number, repeat=5)) / number
+
+
+def main():
+    # Node と Edge が相互に参照し合うので、pickle は出題文の長さに比例した深さで再帰する
+    sys.setrecursionlimit(1000000)
+    default = Rule.from_file(data.filepath("google_ime_default_roman_table.txt"), data.DIRECT_INPUTTABLE)
+    azik = Rule.from_file(data.filepath("google_ime_tomoemon_azik.txt"), data.DIRECT_INPUTTABLE)
+    print(f"{'case':<20} {'pickle[B]':>10} {'flat[B]':>9} {'ratio':>6} "
+          f"{'pickle load[ms]':>16} {'flat load[ms]':>14} {'speedup':>8}")
+    for name, text in TEXTS.items():
+        for case, auto in [(f"{name}/default", build_automaton(default, text)),
+                           (f"{name}/merged", build_merged_automaton({"default": default, "azik": azik}, text))]:
+            pickled = pickle.dumps(auto, protocol=pickle.HIGHEST_PROTOCOL)
+            flat = export.dumps(auto)
+            number = 200 if name == "word" else 5
+            pickle_load = best(lambda: pickle.loads(pickled), number)
+            # 読み込んで最初の 1 打鍵を判定できるまで
+            flat_load = best(lambda: export.loads(flat).inputtable(), number)
+            print(f"{case:<20} {len(pickled):>10} {len(flat):>9} {len(flat)/len(pickled):>6.2f} "
+                  f"{pickle_load*1000:>16.3f} {flat_load*1000:>14.3f} {pickle_load/flat_load:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
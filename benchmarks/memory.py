@@ -0,0 +1,93 @@
+# coding: utf-8
+"""出題文の Automaton をまとめて保持したときのメモリ使用量を、以前の構造と比べる
+
+以前の構造: __dict__ を持つ Node, Edge と、Edge ごとに作り直した Entry のリスト
+現在の構造: __slots__ を持つ Node, Edge と、Rule.intern_entries で共有した Entry のタプル
+
+    PYTHONPATH=. python benchmarks/memory.py
+"""
+from __future__ import annotations
+import random
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Dict, List, Set
+from emil import data
+from emil.rule import Rule, Entry, DependentEntry
+from emil.builder import EntryNode, build_automaton, build_index_based_inputtable
+
+RULE_FILES = ["google_ime_default_roman_table.txt", "google_ime_tomoemon_azik.txt"]
+WORDS = ["きょうは", "いい", "てんき", "ですね", "がっこう", "しんぶん", "にゃんこ", "ちょっと",
+         "こんにちは", "ありがとう", "、", "。", "じてんしゃ", "きって", "ぎゅうにゅう", "おんせん"]
+
+
+@dataclass
+class LegacyNode:
+    next_edges: List[LegacyEdge] = field(init=False, default_factory=list)
+
+
+@dataclass
+class LegacyEdge:
+    entries: List[Entry]
+    previous: LegacyNode
+    next: LegacyNode
+
+
+class LegacyEntry:
+    # slotted になる前の Entry と同じく __dict__ を持つ
+    def __init__(self, input, output, next):
+        self.input = input
+        self.output = output
+        self.next = next
+
+
+def legacy_build(rule: Rule, text: str) -> LegacyNode:
+    en_tail = EntryNode(entry=DependentEntry("", "", ""), child=None)
+    indexes: Dict[int, Set[EntryNode]] = build_index_based_inputtable(rule, text, en_tail, {})
+    indexed_nodes: Dict[int, LegacyNode] = {}
+    start = LegacyNode()
+    end = LegacyNode()
+    worklist = [(start, 0)]
+    while worklist:
+        previous_node, index = worklist.pop()
+        for n in indexes[index]:
+            next_index = index + n.total_length()
+            if next_index == len(text):
+                next_node = end
+            elif next_index in indexed_nodes:
+                next_node = indexed_nodes[next_index]
+            else:
+                next_node = indexed_nodes[next_index] = LegacyNode()
+                worklist.append((next_node, next_index))
+            children = tuple(n.children())
+            for d in n.flatten_dependencies():
+                entries = [LegacyEntry(e.input, e.output, e.next) for e in d + children]
+                previous_node.next_edges.append(LegacyEdge(entries, previous_node, next_node))
+    return start
+
+
+def measure(build, rule: Rule, texts: List[str]) -> int:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [build(rule, t) for t in texts]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return after - before
+
+
+def main():
+    random.seed(0)
+    texts = ["".join(random.choice(WORDS) for _ in range(8)) for _ in range(500)]
+    print(f"{'rule':<40} {'legacy[KiB]':>12} {'current[KiB]':>13} {'ratio':>6}")
+    for filename in RULE_FILES:
+        rule = Rule.from_file(data.filepath(filename), data.DIRECT_INPUTTABLE)
+        # Rule 側で共有される Entry は 1 度作れば済むので、事前に作っておいて数に含めない
+        for t in texts:
+            build_automaton(rule, t)
+        legacy = measure(legacy_build, rule, texts)
+        current = measure(build_automaton, rule, texts)
+        print(f"{filename:<40} {legacy/1024:>12.0f} {current/1024:>13.0f} {current/legacy:>6.2f}")
+
+
+if __name__ == "__main__":
+    main()
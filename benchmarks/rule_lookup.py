@@ -0,0 +1,105 @@
+# coding: utf-8
+"""Rule の Trie を使った search_parents と、末尾・接頭辞の部分文字列を作って dict を引いていた以前の方法を比べる
+
+AZIK より大きく、長い output を持つ Entry を多く含むルール（単語登録したようなルール）を作り、
+Entry の数と最長の output の長さを変えて build_automaton の時間を測る
+
+    PYTHONPATH=. python benchmarks/rule_lookup.py
+"""
+from __future__ import annotations
+import dataclasses
+import random
+import timeit
+from typing import List, Optional
+from emil import builder, data
+from emil.rule import Rule, Entry, DependentEntry
+from emil.builder import BuildStats, EntryNode, build_automaton
+from emil.strings import split_prefixes, split_suffixes
+
+KANA = [chr(c) for c in range(ord("あ"), ord("ん") + 1)]
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def legacy_search_parents(rule: Rule, text: str, tail: EntryNode, stats: Optional[BuildStats] = None) -> List[EntryNode]:
+    # Trie 導入前の実装
+    if not text:
+        return []
+    current = []
+    tail_input = tail.entry.input if tail.entry else ""
+    tail_input_prefixes = split_prefixes(tail_input, len(tail_input))
+    text_suffixes = split_suffixes(text, rule.max_output_length)
+    for s in text_suffixes:
+        for e in rule.output_edict.get(s, []):
+            if e.next:
+                if tail_input.startswith(e.next):
+                    if not tail.entry.is_direct_inputtable:
+                        current.append(EntryNode(entry=e, child=tail))
+                continue
+            if e.has_only_common_prefix:
+                if not tail_input:
+                    continue
+                if any(1 for p in tail_input_prefixes if (e.input + p) in rule.input_edict):
+                    continue
+                current.append(EntryNode(entry=e, child=tail))
+                continue
+            current.append(EntryNode(entry=e, child=None))
+        for e in rule.output_with_next_edict.get(s, []):
+            d = dataclasses.replace(e, next="", output=e.output + e.next)
+            d.dependencies = e.dependencies
+            d.substitutables = e.substitutables
+            d.has_only_common_prefix = e.has_only_common_prefix
+            d.is_direct_inputtable = e.is_direct_inputtable
+            d.dependency_paths = e.dependency_paths
+            current.append(EntryNode(entry=d, child=None))
+        if s in rule.direct_inputtable:
+            e = DependentEntry(input=s, output=s, next="", is_direct_inputtable=True)
+            current.append(EntryNode(entry=e, child=None))
+    if not current:
+        raise Exception(f"any of {text_suffixes} is NOT matched to rules")
+    return current
+
+
+def word_rule(size: int, max_length: int, seed: int = 0) -> Rule:
+    """かな 1 文字ずつの Entry に加えて、output が 2〜max_length 文字の Entry を size 個持つルール"""
+    rng = random.Random(seed)
+    elist = [Entry(f"k{LETTERS[i // 26]}{LETTERS[i % 26]}", k, "") for i, k in enumerate(KANA)]
+    outputs = set()
+    while len(outputs) < size:
+        outputs.add("".join(rng.choice(KANA) for _ in range(rng.randint(2, max_length))))
+    for i, output in enumerate(sorted(outputs)):
+        code = "".join(LETTERS[(i // 26 ** j) % 26] for j in range(4))
+        elist.append(Entry(f"q{code}", output, ""))
+    return Rule(elist, direct_inputtable=data.DIRECT_INPUTTABLE)
+
+
+def sentence(rule: Rule, length: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    outputs = [e.output for e in rule.elist if len(e.output) > 1]
+    text = ""
+    while len(text) < length:
+        text += rng.choice(outputs)
+    return text
+
+
+def bench(rule: Rule, text: str, number: int) -> float:
+    return min(timeit.repeat(lambda: build_automaton(rule, text), number=number, repeat=3)) / number
+
+
+def main():
+    print(f"{'entries':>8} {'max_len':>7} {'legacy[ms]':>11} {'trie[ms]':>9} {'speedup':>8}")
+    for size, max_length in [(1000, 4), (1000, 16), (10000, 8), (10000, 32), (50000, 64)]:
+        rule = word_rule(size, max_length)
+        text = sentence(rule, 300)
+        current = bench(rule, text, 3)
+        original = builder.search_parents
+        builder.search_parents = legacy_search_parents
+        try:
+            legacy = bench(rule, text, 3)
+        finally:
+            builder.search_parents = original
+        print(f"{len(rule.elist):>8} {rule.max_output_length:>7} {legacy*1000:>11.2f} {current*1000:>9.2f} "
+              f"{legacy/current:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+# coding: utf-8
+"""同梱のルールファイルを使って、主要な処理の時間とピークメモリを測る
+
+    PYTHONPATH=. python benchmarks/suite.py                         # 結果を表示する
+    PYTHONPATH=. python benchmarks/suite.py --output bench.json     # 結果を JSON で保存する
+    PYTHONPATH=. python benchmarks/suite.py --baseline bench.json   # 保存した結果と比べる
+
+benchmarks/ のスクリプトはどれもリポジトリのルートで実行する。PYTHONPATH=. はルートの emil を読み込むためのもので、
+pip install -e . でインストールしてあれば付けなくてよい
+
+--baseline を指定した場合、いずれかのケースが --threshold 倍より遅くなっていれば終了コード 1 で終わる
+"""
+from __future__ import annotations
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+from emil import data, viz
+from emil.rule import Rule
+from emil.builder import build_automaton, build_merged_automaton
+from emil.replay import replay
+
+RULE_FILES = {
+    "default": "google_ime_default_roman_table.txt",
+    "azik": "google_ime_tomoemon_azik.txt",
+}
+SHORT_WORDS = ["きょうは", "いい", "てんき", "ですね", "がっこう", "しんぶん", "にゃんこ", "ちょっと",
+               "こんにちは", "ありがとう", "じてんしゃ", "きって", "ぎゅうにゅう", "おんせん"]
+PATHOLOGICAL = {
+    # 「っ」の連続は tt/っ/t が連なる Edge になり、Edge の数が長さの 2 乗で増える
+    "sokuon": "っ" * 120 + "た",
+    "hatsuon": "ん" * 200 + "い",
+    "long_vowel": "あ" + "ー" * 200,
+    "mixed": "しんぶんしっっっちゃんーー" * 20,
+}
+
+
+def long_sentence(length: int) -> str:
+    rng = random.Random(0)
+    words = SHORT_WORDS + ["、", "。"]
+    text = ""
+    while len(text) < length:
+        text += rng.choice(words)
+    return text
+
+
+# (ケース名, 準備して計測する関数を返す関数)
+Case = Tuple[str, Callable[[], Callable[[], object]]]
+
+
+def cases(sentence_length: int) -> List[Case]:
+    result: List[Case] = []
+    rules = {name: Rule.from_file(data.filepath(f), data.DIRECT_INPUTTABLE) for name, f in RULE_FILES.items()}
+    sentence = long_sentence(sentence_length)
+
+    for name, filename in RULE_FILES.items():
+        path = data.filepath(filename)
+        result.append((f"rule_load/{name}", lambda path=path: lambda: Rule.from_file(path, data.DIRECT_INPUTTABLE)))
+
+    for name, rule in rules.items():
+        result.append((f"build/short_words/{name}",
+                       lambda rule=rule: lambda: [build_automaton(rule, w) for w in SHORT_WORDS]))
+        result.append((f"build/long_sentence/{name}",
+                       lambda rule=rule: lambda: build_automaton(rule, sentence)))
+        for case, text in PATHOLOGICAL.items():
+            result.append((f"build/pathological/{case}/{name}",
+                           lambda rule=rule, text=text: lambda: build_automaton(rule, text)))
+
+        def input_replay(rule=rule):
+            auto = build_automaton(rule, sentence)
+            keys = auto.tail_input_str()
+
+            def run():
+                auto.reset()
+                for k in keys:
+                    auto.input(k)
+            return run
+        result.append((f"input/automaton/{name}", input_replay))
+
+        def compiled_replay(rule=rule):
+            compiled = build_automaton(rule, sentence).compile()
+            keys = compiled.tail_input_str()
+            return lambda: replay(compiled, keys)
+        result.append((f"input/replay/{name}", compiled_replay))
+
+        def render(rule=rule):
+            auto = build_automaton(rule, sentence)
+            return lambda: viz.render(auto)
+        result.append((f"viz/render/{name}", render))
+
+    # すべての配列を 1 つにまとめた Automaton（build/long_sentence/* の合計と比べる）
+    result.append(("build/long_sentence/merged", lambda: lambda: build_merged_automaton(rules, sentence)))
+    return result
+
+
+def measure(prepare: Callable[[], Callable[[], object]], repeat: int) -> Dict[str, float]:
+    run = prepare()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    # tracemalloc は実行を遅くするので、時間とは別に 1 回だけ実行して測る
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "time_min": min(times),
+        "time_mean": statistics.mean(times),
+        "peak_bytes": peak,
+        "repeat": repeat,
+    }
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], threshold: float) -> bool:
+    ok = True
+    print(f"{'case':<44} {'baseline[ms]':>13} {'current[ms]':>12} {'ratio':>6}")
+    for name, r in results.items():
+        b = baseline.get(name)
+        if b is None:
+            print(f"{name:<44} {'-':>13} {r['time_min']*1000:>12.3f} {'new':>6}")
+            continue
+        ratio = r["time_min"] / b["time_min"] if b["time_min"] else float("inf")
+        mark = ""
+        if ratio > threshold:
+            ok = False
+            mark = "  REGRESSION"
+        print(f"{name:<44} {b['time_min']*1000:>13.3f} {r['time_min']*1000:>12.3f} {ratio:>6.2f}{mark}")
+    return ok
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="結果を書き出す JSON ファイル")
+    parser.add_argument("--baseline", help="比較する、以前に --output で保存した JSON ファイル")
+    parser.add_argument("--threshold", type=float, default=1.2, help="遅くなったと判定する比率")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--sentence-length", type=int, default=2000)
+    parser.add_argument("--filter", default="", help="名前にこの文字列を含むケースだけを実行する")
+    args = parser.parse_args(argv)
+
+    results: Dict[str, Dict[str, float]] = {}
+    for name, prepare in cases(args.sentence_length):
+        if args.filter not in name:
+            continue
+        results[name] = measure(prepare, args.repeat)
+        r = results[name]
+        print(f"{name:<44} min {r['time_min']*1000:>10.3f} ms  mean {r['time_mean']*1000:>10.3f} ms  "
+              f"peak {r['peak_bytes']/1024:>10.0f} KiB", file=sys.stderr)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "sentence_length": args.sentence_length,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        if not compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+# coding: utf-8
+from __future__ import annotations
+from typing import Optional, List, Tuple, Iterable, Union
+from dataclasses import dataclass
+import random
+from .rule import Rule
+from .automaton import Automaton
+from .dfa import CompiledAutomaton
+from .emil import Emil
+from .util import pool_map
+
+
+"""出題文の難易度の指標として、入力可能なキー列の数や打鍵数を求める
+
+CompiledAutomaton の遷移表は 1 打鍵ごとの決定的な遷移で、閉路を持たない。
+異なるキー列は遷移表の異なる経路に対応するので、終端から逆向きの DP で経路を列挙せずに求められる
+"""
+
+
+@dataclass
+class KeystrokeStats:
+    text: str
+    # 出題文を最後まで入力できる異なるキー列の数
+    count: int
+    # キー列の打鍵数の最小、最大、平均（すべてのキー列を同じ重みとしたもの）
+    min_keystrokes: int
+    max_keystrokes: int
+    mean_keystrokes: float
+    # 一様に選んだキー列
+    samples: List[str]
+
+
+class KeystrokeAnalysis:
+    """状態 ID ごとに、そこから最後まで入力するキー列の数と打鍵数を求めたもの
+
+    計算は遷移表の状態数と遷移の数に比例する時間で終わる
+    """
+
+    def __init__(self, automaton: Union[Automaton, CompiledAutomaton]):
+        if isinstance(automaton, Automaton):
+            automaton = automaton.compile()
+        self.automaton = automaton
+        transitions = automaton.transitions
+        n = len(transitions)
+        # 状態 ID ごとの、最後まで入力するキー列の数、打鍵数の合計、最小、最大
+        # 最後まで入力できない状態は数が 0 で、最小と最大は -1
+        self.counts: List[int] = [0] * n
+        self.totals: List[int] = [0] * n
+        self.mins: List[int] = [-1] * n
+        self.maxs: List[int] = [-1] * n
+        counts, totals, mins, maxs = self.counts, self.totals, self.mins, self.maxs
+        for s in self.__postorder():
+            if not transitions[s]:
+                if not automaton.available_edges[s]:
+                    # 終端
+                    counts[s], mins[s], maxs[s] = 1, 0, 0
+                continue
+            count = total = 0
+            lo = hi = -1
+            for next_id, _ in transitions[s].values():
+                c = counts[next_id]
+                if not c:
+                    continue
+                count += c
+                # 遷移先の各キー列の前に 1 打鍵ずつ増える
+                total += totals[next_id] + c
+                if lo < 0 or mins[next_id] + 1 < lo:
+                    lo = mins[next_id] + 1
+                if maxs[next_id] + 1 > hi:
+                    hi = maxs[next_id] + 1
+            counts[s], totals[s], mins[s], maxs[s] = count, total, lo, hi
+
+    def __postorder(self) -> List[int]:
+        # 遷移先を先に計算するために帰りがけ順に並べる（再帰しない）
+        transitions = self.automaton.transitions
+        order = []
+        visited = {0}
+        stack = [(0, iter(transitions[0].values()))]
+        while stack:
+            s, nexts = stack[-1]
+            for next_id, _ in nexts:
+                if next_id not in visited:
+                    visited.add(next_id)
+                    stack.append((next_id, iter(transitions[next_id].values())))
+                    break
+            else:
+                stack.pop()
+                order.append(s)
+        return order
+
+    @property
+    def count(self) -> int:
+        return self.counts[0]
+
+    @property
+    def min_keystrokes(self) -> int:
+        return self.mins[0]
+
+    @property
+    def max_keystrokes(self) -> int:
+        return self.maxs[0]
+
+    @property
+    def mean_keystrokes(self) -> float:
+        if not self.counts[0]:
+            return 0.0
+        return self.totals[0] / self.counts[0]
+
+    def sample(self, rng: Optional[random.Random] = None) -> str:
+        """最後まで入力できるキー列のうちの 1 つを、すべてが同じ確率になるように選ぶ"""
+        if rng is None:
+            rng = random.Random()
+        if not self.count:
+            raise Exception("no key sequence can finish the automaton")
+        transitions = self.automaton.transitions
+        counts = self.counts
+        keys = []
+        s = 0
+        while transitions[s]:
+            # 遷移先から最後まで入力するキー列の数に比例した確率で次のキーを選ぶ
+            r = rng.randrange(counts[s])
+            for c, (next_id, _) in transitions[s].items():
+                r -= counts[next_id]
+                if r < 0:
+                    keys.append(c)
+                    s = next_id
+                    break
+        return "".join(keys)
+
+    def stats(self, text: str = "", samples: int = 0, rng: Optional[random.Random] = None) -> KeystrokeStats:
+        if rng is None:
+            rng = random.Random()
+        return KeystrokeStats(text, self.count, self.min_keystrokes, self.max_keystrokes, self.mean_keystrokes,
+                              [self.sample(rng) for _ in range(samples)])
+
+
+def analyze(automaton: Union[Automaton, CompiledAutomaton], text: str = "", samples: int = 0,
+            rng: Optional[random.Random] = None) -> KeystrokeStats:
+    return KeystrokeAnalysis(automaton).stats(text, samples, rng)
+
+
+def _analyze(emil: Emil, args: Tuple[str, int, Optional[int]]) -> KeystrokeStats:
+    text, samples, seed = args
+    # seed を指定した場合は、処理するプロセスや順序によらず出題文ごとに同じキー列を選ぶ
+    rng = random.Random(f"{seed}:{text}") if seed is not None else random.Random()
+    return analyze(emil.build(text), text, samples, rng)
+
+
+def analyze_many(rule: Rule, words: Iterable[str], samples: int = 0, seed: Optional[int] = None,
+                 processes: Optional[int] = None, chunksize: int = 64) -> List[KeystrokeStats]:
+    """単語のリストの各単語について KeystrokeStats を求める
+
+    util.pool_map で処理する（Emil はワーカーごとに 1 度だけ作る）
+    """
+    return list(pool_map(Emil, (rule,), _analyze, ((w, samples, seed) for w in words), processes, chunksize))
@@ -1,29 +1,108 @@
 # coding: utf-8
 from __future__ import annotations
-from typing import Optional, List, Dict, Set, Tuple
+from typing import TYPE_CHECKING, Optional, List, Dict, Set, Tuple, FrozenSet
 import dataclasses
 from dataclasses import dataclass
 from .rule import Entry
+from .util import slotted
+
+if TYPE_CHECKING:
+    from .dfa import CompiledAutomaton
+    from .guide import Guide, EdgeCost
+
+
+# Edge.layouts, State.layouts ですべての配列を表す値
+ALL_LAYOUTS = -1
+
+
+# Node.inputtable で共有する集合（入力可能な文字の組み合わせの数しか増えない）
+_interned_inputtables: Dict[FrozenSet[str], FrozenSet[str]] = {}
 
 
 # 表示文字列の入力状態を表す
+@slotted
 @dataclass
 class Node:
     next_edges: List[Edge] = dataclasses.field(init=False, default_factory=list)
+    # この Node から次に入力可能な文字（next_edges を作り終えたときに update_inputtable で計算する）
+    inputtable: FrozenSet[str] = dataclasses.field(init=False, default_factory=frozenset, repr=False)
+
+    def update_inputtable(self):
+        inputtable = frozenset(e.entries[0].input[0] for e in self.next_edges)
+        # 同じ集合を持つ Node は多いので共有する
+        self.inputtable = _interned_inputtables.setdefault(inputtable, inputtable)
 
     @property
     def finished(self) -> bool:
         return bool(self.next_edges)
 
+    def start_edges(self, layouts: int = ALL_LAYOUTS) -> Tuple[Tuple[Edge, int, int], ...]:
+        """この Node に到達したときに入力可能な (Edge, entry の位置, input の位置) を返す
+
+        layouts を指定した場合は、その配列で使える Edge だけにする
+        """
+        if layouts == ALL_LAYOUTS:
+            return tuple((e, 0, 0) for e in self.next_edges)
+        return tuple((e, 0, 0) for e in self.next_edges if e.layouts & layouts)
+
 
 # 次の Node へ遷移するための入力
+# entries は Rule.intern_entries で共有されたもの
+@slotted
 @dataclass
 class Edge:
-    entries: List[Entry]
+    entries: Tuple[Entry, ...]
     previous: Node
     next: Node
+    # この Edge を使える配列（build_merged_automaton に渡した Rule の位置のビット）
+    layouts: int = ALL_LAYOUTS
+
+
+def recorded_entries(available_edges: Tuple[Tuple[Edge, int, int], ...]) -> int:
+    """Edge の先頭から、入力可能なすべての Edge で同じ entry の入力が完了している数
+
+    「n」だけを入力した状態では「n/ん, ki/き」の Edge では「ん」が完了しているが、「nn/ん」の Edge では
+    完了していない。どちらの Edge で入力を続けても History が食い違わないように、History には
+    すべての Edge で完了している entry だけを記録する
+    """
+    if not available_edges:
+        return 0
+    first, count, _ = available_edges[0]
+    # Node に到達した直後など、先頭の Edge で完了した entry がなければ調べなくてよい
+    if not count:
+        return 0
+    first_entries = first.entries
+    for edge, entry_index, _ in available_edges[1:]:
+        if entry_index < count:
+            count = entry_index
+        entries = edge.entries
+        n = 0
+        while n < count and entries[n] == first_entries[n]:
+            n += 1
+        if not n:
+            return 0
+        count = n
+    return count
+
+
+def pending_input(available_edges: Tuple[Tuple[Edge, int, int], ...]) -> str:
+    """先頭の入力可能な Edge で、History に記録していない entry から入力済みの文字列
+
+    最初の entry は input の先頭から返すので、直前に記録した entry の next の分は呼び出し側で除く
+    """
+    if not available_edges:
+        return ""
+    edge, entry_index, input_index = available_edges[0]
+    entries = edge.entries
+    recorded = recorded_entries(available_edges)
+    pieces = []
+    for k in range(recorded, entry_index + 1):
+        start = len(entries[k-1].next) if k > recorded else 0
+        pieces.append(entries[k].input[start:input_index if k == entry_index else None])
+    return "".join(pieces)
 
 
+@slotted
 @dataclass
 class InputResult:
     succeeded: bool
@@ -32,36 +111,150 @@ class InputResult:
     passed_entries: Tuple[Entry, ...]
 
 
+class _HistoryBuffer:
+    """History の文字列を組み立てるための、1 つの系列で共有される入力済み文字列の断片
+
+    文字列を参照されたときにだけ History の末尾に追記していく
+    """
+    def __init__(self, nodes: List[History]):
+        self.nodes = nodes
+        self.input_pieces = [n.input_piece for n in nodes]
+        self.outputs = [n.entry.output for n in nodes]
+        # 最後に組み立てた (断片の数, inputted, outputted)
+        self.cache: Tuple[int, str, str] = (0, "", "")
+
+    def fork(self, length: int) -> _HistoryBuffer:
+        return _HistoryBuffer(self.nodes[:length])
+
+    def append(self, node: History):
+        self.nodes.append(node)
+        self.input_pieces.append(node.input_piece)
+        self.outputs.append(node.entry.output)
+
+    def strings(self, length: int) -> Tuple[str, str]:
+        count, inputted, outputted = self.cache
+        if length == count:
+            return inputted, outputted
+        if length > count:
+            inputted += "".join(self.input_pieces[count:length])
+            outputted += "".join(self.outputs[count:length])
+        else:
+            inputted = "".join(self.input_pieces[:length])
+            outputted = "".join(self.outputs[:length])
+        self.cache = (length, inputted, outputted)
+        return inputted, outputted
+
+
+@slotted
+@dataclass(eq=False)
+class History:
+    """これまでに入力が完了した Entry の永続リスト
+
+    追加は親への参照を持つだけなので O(1) で、test() で分岐した古い State とも親を共有する
+    """
+    entry: Optional[Entry] = None
+    parent: Optional[History] = None
+    # entry.input のうち、直前の entry.next で自動入力された部分を除いたもの
+    input_piece: str = ""
+    length: int = 0
+    inputted_length: int = 0
+    outputted_length: int = 0
+    _buffer: Optional[_HistoryBuffer] = dataclasses.field(default=None, repr=False)
+
+    def extend(self, entries: Tuple[Entry, ...]) -> History:
+        h = self
+        for e in entries:
+            piece = e.input[len(h.entry.next):] if h.entry else e.input
+            h = History(e, h, piece, h.length + 1,
+                        h.inputted_length + len(piece), h.outputted_length + len(e.output))
+        return h
+
+    def __materialize(self) -> _HistoryBuffer:
+        # 文字列を組み立て済みの祖先までたどり、その系列の末尾に自身までを追記する
+        path = []
+        h = self
+        while h._buffer is None and h.length:
+            path.append(h)
+            h = h.parent
+        if not h.length:
+            buffer = _HistoryBuffer([])
+        elif len(h._buffer.nodes) == h.length:
+            buffer = h._buffer
+        else:
+            # 別の分岐が既に追記されているので、分岐点までをコピーする
+            buffer = h._buffer.fork(h.length)
+        for n in reversed(path):
+            buffer.append(n)
+            n._buffer = buffer
+        return buffer
+
+    def strings(self) -> Tuple[str, str]:
+        """(inputted, outputted) を返す"""
+        if not self.length:
+            return "", ""
+        buffer = self._buffer or self.__materialize()
+        return buffer.strings(self.length)
+
+    @property
+    def inputted(self) -> str:
+        return self.strings()[0]
+
+    @property
+    def outputted(self) -> str:
+        return self.strings()[1]
+
+    def entries(self) -> Tuple[Entry, ...]:
+        result = []
+        h = self
+        while h.length:
+            result.append(h.entry)
+            h = h.parent
+        return tuple(reversed(result))
+
+
+@slotted
 @dataclass
 class State:
     node: Node
     # 入力可能な Edge, その Edge 内での entry の位置, その entry 内での input の位置
     available_edges: Tuple[Tuple[Edge, int, int], ...]
-    # これまでに入力が完了した Entry
-    passed_entries: Tuple[Entry, ...]
+    # これまでに入力が完了した Entry（入力中の Edge の entry は recorded_entries の数まで）
+    history: History
+    # 入力に使える配列（次の Node の Edge をこの配列で使えるものに絞る）
+    layouts: int = ALL_LAYOUTS
 
     @property
     def finished(self) -> bool:
         return bool(self.node.finished)
 
+    @property
+    def passed_entries(self) -> Tuple[Entry, ...]:
+        return self.history.entries()
+
+    @property
+    def inputtable(self) -> FrozenSet[str]:
+        edges = self.available_edges
+        if not edges:
+            return frozenset()
+        _, entry_index, input_index = edges[0]
+        if not entry_index and not input_index and self.layouts == ALL_LAYOUTS:
+            # Node に到達した直後は、すべての next_edges の先頭から入力できる
+            return self.node.inputtable
+        # Edge の途中（next による自動遷移の後を含む）では、入力中の entry の次の文字だけが入力できる
+        return frozenset(edge.entries[entry_index].input[input_index] for edge, entry_index, input_index in edges)
+
     @property
     def inputted(self) -> str:
-        next = 0
-        inputted = []
-        for e in self.passed_entries:
-            inputted.append(e.input[next:])
-            next = len(e.next)
+        inputted = self.history.inputted
         if self.available_edges:
-            edge, entry_index, input_index = self.available_edges[0]
-            inputted.append(edge.entries[entry_index].input[next:input_index])
-        return "".join(inputted)
+            last = self.history.entry
+            next = len(last.next) if last else 0
+            inputted += pending_input(self.available_edges)[next:]
+        return inputted
 
     @property
     def outputted(self) -> str:
-        outputted = []
-        for e in self.passed_entries:
-            outputted.append(e.output)
-        return "".join(outputted)
+        return self.history.outputted
 
     @classmethod
     def __input(cls, i: str, edge: Edge, entry_index: int, input_index: int, finished_entries=()):
@@ -80,24 +273,27 @@ class State:
 
     def test(self, i: str) -> InputResult:
         new_available_edges: List[Tuple[Edge, int, int]] = []
-        finished_entries: Tuple[Entry, ...] = ()
+        # History に記録済みの entry の数（記録していない entry は入力が完了したときにまとめて記録する）
+        recorded = recorded_entries(self.available_edges)
         for edge, entry_index, input_index in self.available_edges:
-            succeeded, new_entry_index, new_input_index, tmp_finished_entries = \
-                self.__input(i, edge, entry_index, input_index)
+            succeeded, new_entry_index, new_input_index, _ = self.__input(i, edge, entry_index, input_index)
             if succeeded:
-                finished_entries = tmp_finished_entries
                 if len(edge.entries) == new_entry_index:
+                    finished_entries = edge.entries[recorded:]
                     new_state = State(edge.next,
-                                      tuple((e, 0, 0) for e in edge.next.next_edges),
-                                      self.passed_entries + tmp_finished_entries)
-                    return InputResult(True, new_state, tmp_finished_entries)
+                                      edge.next.start_edges(self.layouts),
+                                      self.history.extend(finished_entries),
+                                      self.layouts)
+                    return InputResult(True, new_state, finished_entries)
                 else:
                     new_available_edges.append((edge, new_entry_index, new_input_index))
         if new_available_edges:
-            new_passed_entries = self.passed_entries + finished_entries
+            available_edges = tuple(new_available_edges)
+            finished_entries = available_edges[0][0].entries[recorded:recorded_entries(available_edges)]
             new_state = State(self.node,
-                              tuple(new_available_edges),
-                              new_passed_entries)
+                              available_edges,
+                              self.history.extend(finished_entries),
+                              self.layouts)
             return InputResult(True, new_state, finished_entries)
         return InputResult(False, self, ())
 
@@ -110,10 +306,35 @@ class Automaton:
     _start_node: Node
     _end_node: Node
     _state: State = dataclasses.field(init=False)
+    _guide: Optional[Guide] = dataclasses.field(init=False, default=None, repr=False)
+    # 入力に使える配列（set_layouts で変更する）
+    _layouts: int = dataclasses.field(init=False, default=ALL_LAYOUTS, repr=False)
 
     def __post_init__(self):
         self.reset()
 
+    @property
+    def guide(self) -> Guide:
+        """残りの入力文字列を求めるための Guide（初回の参照時に 1 度だけ作る）"""
+        if self._guide is None:
+            from .guide import Guide
+            self._guide = Guide(self._start_node, layouts=self._layouts)
+        return self._guide
+
+    def set_guide_cost(self, cost: EdgeCost):
+        """tail_input_str, tail_print_str で残りの入力を選ぶ基準を変更する（guide.fewest_keystrokes, guide.rule_order）
+        """
+        from .guide import Guide
+        self._guide = Guide(self._start_node, cost, self._layouts)
+
+    def set_layouts(self, layouts: int = ALL_LAYOUTS):
+        """入力に使える配列を Edge.layouts のビットで指定し、内部状態をリセットする
+        """
+        if layouts != self._layouts:
+            self._layouts = layouts
+            self._guide = None
+        self.reset()
+
     @property
     def inputted(self) -> str:
         return self._state.inputted
@@ -138,31 +359,70 @@ class Automaton:
         """内部状態をリセットする
         """
         i = self._start_node
-        self._state = State(i, [(e, 0, 0) for e in i.next_edges], ())
+        self._state = State(i, i.start_edges(self._layouts), History(), self._layouts)
+
+    def compile(self, layouts: Optional[int] = None) -> CompiledAutomaton:
+        """到達可能な状態を整数 ID に割り当てた、1 打鍵 1 回の参照で遷移できる遷移表を返す
+
+        遷移表は layouts（省略した場合は set_layouts で指定した配列）で使える Edge だけから作る
+        """
+        from .dfa import CompiledAutomaton
+        return CompiledAutomaton.from_automaton(self, layouts)
 
-    def inputtable(self) -> List[str]:
-        """次の状態に遷移可能な入力リストを返す
+    def inputtable(self) -> FrozenSet[str]:
+        """次の状態に遷移可能な入力（1 文字）の集合を返す
         """
-        pass
+        return self._state.inputtable
 
     def head_print_str(self) -> str:
         """入力済みの表示文字列を返す
         """
-        pass
+        return self._state.outputted
 
     def head_input_str(self) -> str:
         """入力済みの入力文字列を返す
         """
-        pass
+        return self._state.inputted
 
     def tail_print_str(self) -> str:
         """残りの表示文字列を返す
         """
-        pass
+        return self.guide.tail_print(self._state.available_edges)
 
     def tail_input_str(self) -> str:
         """残りの入力文字列を返す
 
         残りの入力文字列は複数のパターンがありうるが、もっともらしいものを1つ選択して返す
+        （選択の基準は set_guide_cost で変更できる）
+        """
+        return self.guide.tail_input(self._state.available_edges)
+
+
+@dataclass
+class MergedAutomaton(Automaton):
+    """複数の Rule（配列）から作った、表示文字列の位置ごとの Node を共有する Automaton
+
+    Edge.layouts の i 番目のビットは layout_names[i] の配列でその Edge を使えることを表す
+    """
+    layout_names: Tuple[str, ...] = ()
+
+    def layout_mask(self, *names: str) -> int:
+        """names の配列を表す Edge.layouts のビットを返す（names がない場合はすべての配列）
+
+        表示文字列を入力できない配列（開始の Node にその配列の Edge がない）を指定した場合は例外を送出する
         """
-        pass
+        if not names:
+            return ALL_LAYOUTS
+        mask = 0
+        for name in names:
+            if name not in self.layout_names:
+                raise Exception(f"unknown layout: {name}")
+            layout = 1 << self.layout_names.index(name)
+            if not any(e.layouts & layout for e in self._start_node.next_edges):
+                raise Exception(f"layout {name} cannot input the text")
+            mask |= layout
+        return mask
+
+    def select_layouts(self, *names: str):
+        """names の配列だけで入力するようにして、内部状態をリセットする（names がない場合はすべての配列）"""
+        self.set_layouts(self.layout_mask(*names))
@@ -0,0 +1,114 @@
+# coding: utf-8
+from __future__ import annotations
+from typing import Optional, List, Dict, Tuple, Iterable
+from dataclasses import dataclass
+import dataclasses
+from .rule import Rule
+from .automaton import Automaton
+from .builder import BuildStats, EntryNode, build_automaton
+from . import export
+from .util import pool_map
+
+
+"""問題集の出題文をまとめて作る
+
+出題文の間で同じ末尾（と後続の Entry）に対する search_parents の結果を共有する。
+ルールを変更したあとに問題集全体を作り直すときに使う
+"""
+
+
+@dataclass
+class BankStats:
+    texts: int = 0
+    # Automaton を作れなかった出題文の数
+    failed: int = 0
+    # search_parents を実行した回数
+    search_parents_calls: int = 0
+    # 同じ出題文の中で作ったメモを使った回数（出題文ごとに作る場合も同じだけ使う）
+    memo_hits: int = 0
+    # 別の出題文で作ったメモを使った回数（出題文ごとに作る場合に比べて減った search_parents の回数）
+    shared_memo_hits: int = 0
+    # Automaton を作るのにかかった時間（秒、並列に処理した場合は各プロセスの合計）
+    build_time: float = 0.0
+
+    @property
+    def saved_ratio(self) -> float:
+        """出題文ごとに作った場合の search_parents の回数のうち、共有したメモで省けた割合"""
+        total = self.search_parents_calls + self.shared_memo_hits
+        return self.shared_memo_hits / total if total else 0.0
+
+    def merge(self, other: BankStats):
+        for f in dataclasses.fields(self):
+            setattr(self, f.name, getattr(self, f.name) + getattr(other, f.name))
+
+
+class BankBuilder:
+    """1 つの Rule で多数の出題文の Automaton を作る
+
+    search_parents のメモを出題文の間で共有する。メモが max_memo_size を超えたときと、
+    rule が update されたとき（Rule.generation が変わったとき）はメモを作り直す
+    """
+
+    def __init__(self, rule: Rule, max_memo_size: int = 1000000):
+        self.rule = rule
+        self.max_memo_size = max_memo_size
+        self.memo: Dict[Tuple[str, EntryNode], List[EntryNode]] = {}
+        self.stats = BankStats()
+        self._generation = rule.generation
+
+    def build(self, text: str) -> Automaton:
+        if self._generation != self.rule.generation or len(self.memo) > self.max_memo_size:
+            self.memo.clear()
+            self._generation = self.rule.generation
+        stats = BuildStats()
+        try:
+            return build_automaton(self.rule, text, stats, self.memo)
+        except Exception:
+            self.stats.failed += 1
+            raise
+        finally:
+            self.stats.texts += 1
+            self.stats.search_parents_calls += stats.search_parents_calls
+            self.stats.memo_hits += stats.search_parents_memo_hits - stats.shared_memo_hits
+            self.stats.shared_memo_hits += stats.shared_memo_hits
+            self.stats.build_time += stats.total_time
+
+
+@dataclass
+class BankResult:
+    text: str
+    # export.dumps の形式の Automaton（作れなかった場合は None）
+    automaton: Optional[bytes]
+    error: Optional[str] = None
+
+
+def _build_one(builder: BankBuilder, item: Tuple[int, str]) -> Tuple[int, BankResult, BankStats]:
+    """(入力の位置, 出題文) を処理し、(入力の位置, BankResult, この出題文の分の BankStats) を返す"""
+    i, text = item
+    before = dataclasses.replace(builder.stats)
+    try:
+        result = BankResult(text, export.dumps(builder.build(text)))
+    except Exception as e:
+        result = BankResult(text, None, str(e))
+    stats = dataclasses.replace(builder.stats)
+    for f in dataclasses.fields(stats):
+        setattr(stats, f.name, getattr(stats, f.name) - getattr(before, f.name))
+    return i, result, stats
+
+
+def build_bank(rule: Rule, texts: Iterable[str], processes: Optional[int] = None, chunksize: int = 256,
+               max_memo_size: int = 1000000) -> Tuple[List[BankResult], BankStats]:
+    """texts の Automaton を export の形式で作り、入力の順に返す
+
+    末尾が同じ出題文が同じワーカーで続けて処理されるように、末尾から比べた順に並べてから
+    util.pool_map で処理する（BankBuilder はワーカーごとに 1 度だけ作り、メモはチャンクの間でも共有する）
+    """
+    texts = list(texts)
+    order = sorted(range(len(texts)), key=lambda i: texts[i][::-1])
+    results: List[Optional[BankResult]] = [None] * len(texts)
+    stats = BankStats()
+    for i, result, text_stats in pool_map(BankBuilder, (rule, max_memo_size), _build_one,
+                                          ((i, texts[i]) for i in order), processes, chunksize):
+        results[i] = result
+        stats.merge(text_stats)
+    return results, stats
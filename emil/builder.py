@@ -1,63 +1,112 @@
 # coding: utf-8
 from __future__ import annotations
-from typing import Optional, List, Dict, Set
+from typing import Optional, List, Dict, Set, Tuple, Callable
 import dataclasses
+import time
 from dataclasses import dataclass
 from . import data
 from .rule import Rule, DependentEntry, Entry
-from .automaton import Automaton, Node, Edge
-from .strings import split_prefixes, split_suffixes
+from .automaton import Automaton, MergedAutomaton, Node, Edge
+from .strings import Trie, split_suffixes
+
+
+@dataclass
+class BuildStats:
+    """build_automaton の処理の内訳"""
+    # search_parents を実行した回数と、同じ (末尾の文字列, 後続の EntryNode) の結果を使い回した回数
+    search_parents_calls: int = 0
+    search_parents_memo_hits: int = 0
+    # search_parents_memo_hits のうち、別の build で作ったメモを使い回した回数（bank.BankBuilder で共有した場合）
+    shared_memo_hits: int = 0
+    # search_parents で output_suffix_trie をたどった文字数
+    suffix_lookups: int = 0
+    # search_parents で作った EntryNode の数
+    entry_nodes: int = 0
+    nodes: int = 0
+    edges: int = 0
+    # EntryNode ごとの flatten_dependencies の数（Edge の数に効く）の合計と最大
+    dependency_paths: int = 0
+    max_dependency_paths: int = 0
+    # 各段階の経過時間（秒）
+    index_time: float = 0.0
+    node_time: float = 0.0
+    total_time: float = 0.0
+
+
+# 設定すると、すべての build_automaton で BuildStats を集計して (出題文, BuildStats) を渡して呼び出す
+# 未設定（None）の場合は集計しない
+build_callback: Optional[Callable[[str, BuildStats], None]] = None
 
 
 @dataclass(frozen=True)
 class EntryNode:
     entry: DependentEntry
     child: Optional[EntryNode]
+    # child までの連なり全体のハッシュ値と output の長さ（作成時に 1 度だけ求める）
+    # 「っっっ…」のように child が長く連なる場合に、比較や長さの計算で毎回たどらないようにする
+    _hash: int = dataclasses.field(init=False, repr=False, compare=False)
+    _length: int = dataclasses.field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        child = self.child
+        object.__setattr__(self, "_hash", hash((self.entry, child._hash if child is not None else 0)))
+        object.__setattr__(self, "_length", len(self.entry.output) + (child._length if child is not None else 0))
 
     def total_length(self) -> int:
-        entry_len = len(self.entry.output)
-        if not self.child:
-            return entry_len
-        return entry_len + self.child.total_length()
+        return self._length
 
+    # child は再帰せずにたどる
     def children(self) -> List[DependentEntry]:
         """ 自身を含む """
-        s = [self.entry]
-        if not self.child:
-            return s
-        return s + self.child.children()
-
-    def flatten_dependencies(self) -> List[List[DependentEntry]]:
-        """ 自身は含まない """
-        def backtrack(entry, current_stack, result):
-            if not entry.dependencies or entry.substitutables:
-                result.append(current_stack)
-            for d in entry.dependencies:
-                new_stack = current_stack[:]
-                new_stack.insert(0, d)
-                backtrack(d, new_stack, result)
-            for s in entry.substitutables:
-                new_stack = current_stack[:]
-                new_stack.insert(0, s)
-                backtrack(s, new_stack, result)
-        result: List[List[DependentEntry]] = []
-        backtrack(self.entry, [], result)
-        return result
+        s = []
+        n = self
+        while n is not None:
+            s.append(n.entry)
+            n = n.child
+        return s
+
+    def flatten_dependencies(self) -> Tuple[Tuple[DependentEntry, ...], ...]:
+        """ 自身は含まない（Rule.fill_dependency_paths で計算済みのものを返す） """
+        return self.entry.dependency_paths
+
+    def sort_key(self) -> Tuple[Tuple[str, str, str], ...]:
+        """Edge の順序をプロセス（文字列のハッシュ値）によらず一定にするためのキー"""
+        return tuple((e.input, e.output, e.next) for e in self.children())
 
     def __hash__(self):
-        return hash(self.entry)
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, EntryNode):
+            return NotImplemented
+        a, b = self, other
+        while a is not b:
+            if a is None or b is None or a._hash != b._hash or a.entry != b.entry:
+                return False
+            a, b = a.child, b.child
+        return True
 
 
-def search_parents(rule: Rule, text: str, tail: EntryNode) -> List[EntryNode]:
+def search_parents(rule: Rule, text: str, tail: EntryNode, stats: Optional[BuildStats] = None) -> List[EntryNode]:
     if not text:
         return []
     current = []
     tail_input = tail.entry.input if tail.entry else ""
-    tail_input_prefixes = split_prefixes(tail_input, len(tail_input))
-    text_suffixes = split_suffixes(text, rule.max_output_length)
-
-    for s in text_suffixes:
-        for e in rule.output_edict.get(s, []):
+    value = Trie.VALUE
+    input_trie = rule.input_trie
+    # 末尾の文字から先頭に向かって output_suffix_trie をたどり、短い末尾から順に調べる
+    node = rule.output_suffix_trie.root
+    lookups = 0
+    for i in range(len(text) - 1, max(-1, len(text) - 1 - rule.max_output_length), -1):
+        node = node.get(text[i])
+        if node is None:
+            break
+        lookups += 1
+        suffix = node.get(value)
+        if suffix is None:
+            continue
+        s, outputs, outputs_with_next, direct_inputtable = suffix
+        for e in outputs:
             #  next がある場合（「った」等）は、それが次の input に繋がる場合のみ通す
             if e.next:
                 if tail_input.startswith(e.next):
@@ -76,7 +125,7 @@ def search_parents(rule: Rule, text: str, tail: EntryNode) -> List[EntryNode]:
                 # 「今回の input + 次に来る input prefix（のいずれか）」を input に持つ
                 # Entry の場合は「んい」「んに」を正しく入力できないので無視する
                 # 「んk」のようにかな＋直接入力可能な文字列にもここで対応する
-                if any(1 for p in tail_input_prefixes if (e.input + p) in rule.input_edict):
+                if input_trie.has_extension(e.input, tail_input):
                     continue
 
                 n = EntryNode(entry=e, child=tail)
@@ -86,7 +135,7 @@ def search_parents(rule: Rule, text: str, tail: EntryNode) -> List[EntryNode]:
             n = EntryNode(entry=e, child=None)
             current.append(n)
 
-        for e in rule.output_with_next_edict.get(s, []):
+        for e in outputs_with_next:
             # next を output として扱ったときに入力候補にできるかチェックする
             #
             # 出題: "っt"
@@ -106,66 +155,306 @@ def search_parents(rule: Rule, text: str, tail: EntryNode) -> List[EntryNode]:
             d.substitutables = e.substitutables
             d.has_only_common_prefix = e.has_only_common_prefix
             d.is_direct_inputtable = e.is_direct_inputtable
+            d.dependency_paths = e.dependency_paths
             n = EntryNode(entry=d, child=None)
             current.append(n)
 
         # 直接入力可能かどうか
-        if s in rule.direct_inputtable:
+        if direct_inputtable:
             e = DependentEntry(input=s, output=s, next="", is_direct_inputtable=True)
             n = EntryNode(entry=e, child=None)
             current.append(n)
 
     if not current:
+        text_suffixes = split_suffixes(text, rule.max_output_length)
         raise Exception(f"any of {text_suffixes} is NOT matched to rules")
 
+    if stats is not None:
+        stats.search_parents_calls += 1
+        stats.suffix_lookups += lookups
+        stats.entry_nodes += len(current)
     return current
 
 
-def build_index_based_inputtable(rule: Rule, text: str, tail: EntryNode, inputtables: Dict[int, Set[EntryNode]]):
-    """表示文字列の入力済み文字数に対応する、そのとき遷移可能な Entry のリストを返す"""
+def build_index_based_inputtable(rule: Rule, text: str, tail: EntryNode, inputtables: Dict[int, Set[EntryNode]],
+                                 stats: Optional[BuildStats] = None,
+                                 memo: Optional[Dict[Tuple[str, EntryNode], List[EntryNode]]] = None):
+    """表示文字列の入力済み文字数に対応する、そのとき遷移可能な Entry のリストを返す
+
+    memo を渡すと、同じ rule で別の text を処理したときの search_parents の結果も使い回す
+    """
     if not text:
         return
 
-    parents = search_parents(rule, text, tail)
-    for p in parents:
-        current_inputtable = inputtables.setdefault(len(text)-len(p.entry.output), set())
-        if p in current_inputtable:
+    # search_parents は text の末尾 max_output_length 文字と tail だけで結果が決まるので、
+    # その組み合わせごとに結果を使い回す
+    if memo is None:
+        memo = {}
+    # この呼び出しで memo に追加したキー（別の build のメモを使った回数を数えるため）
+    created: Optional[Set[Tuple[str, EntryNode]]] = set() if stats is not None else None
+    # 長い出題文でも RecursionError にならないように、(入力済み文字数, 後続の EntryNode) の worklist で
+    # 末尾から先頭に向かってたどる
+    worklist = [(len(text), tail)]
+    while worklist:
+        end, current_tail = worklist.pop()
+        if not end:
             continue
-        current_inputtable.add(p)
-        next_text = text[:len(text)-len(p.entry.output)]
-        build_index_based_inputtable(rule, next_text, p, inputtables)
+        suffix = text[max(0, end - rule.max_output_length):end]
+        key = (suffix, current_tail)
+        parents = memo.get(key)
+        if parents is None:
+            parents = memo[key] = search_parents(rule, suffix, current_tail, stats)
+            if created is not None:
+                created.add(key)
+        elif stats is not None:
+            stats.search_parents_memo_hits += 1
+            if key not in created:
+                stats.shared_memo_hits += 1
+        for p in parents:
+            start = end - len(p.entry.output)
+            current_inputtable = inputtables.setdefault(start, set())
+            if p in current_inputtable:
+                continue
+            current_inputtable.add(p)
+            worklist.append((start, p))
     return inputtables
 
 
-def build_automaton(rule: Rule, text: str):
+def add_edges(rule: Rule, previous_node: Node, next_node: Node, n: EntryNode, stats: Optional[BuildStats] = None):
+    """EntryNode を入力する Edge を、その前に入力する Entry の列の候補ごとに追加する"""
+    children = tuple(n.children())
+    deps = n.flatten_dependencies()
+    for d in deps:
+        entries = rule.intern_entries(d + children)
+        edge = Edge(entries=entries, previous=previous_node, next=next_node)
+        previous_node.next_edges.append(edge)
+    if stats is not None:
+        stats.dependency_paths += len(deps)
+        stats.max_dependency_paths = max(stats.max_dependency_paths, len(deps))
+
+
+def build_automaton(rule: Rule, text: str, stats: Optional[BuildStats] = None,
+                    memo: Optional[Dict[Tuple[str, EntryNode], List[EntryNode]]] = None):
+    """text を入力する Automaton を作る
+
+    stats を渡すと処理の内訳を集計する。build_callback が設定されている場合は stats がなくても集計して渡す。
+    memo は build_index_based_inputtable に渡す
+    """
+    if stats is None and build_callback is not None:
+        stats = BuildStats()
+    if stats is not None:
+        started = time.perf_counter()
+
     en_tail = EntryNode(entry=DependentEntry("", "", ""), child=None)
-    indexes: Dict[int, Set[EntryNode]] = build_index_based_inputtable(rule, text, en_tail, {})
+    indexes: Dict[int, Set[EntryNode]] = build_index_based_inputtable(rule, text, en_tail, {}, stats, memo)
     indexed_nodes: Dict[int, Node] = {}
+    if stats is not None:
+        indexed = time.perf_counter()
+        stats.index_time += indexed - started
 
-    def build_nodes(previous_node: Node, end_node: Node, index: int):
-        if previous_node is end_node:
-            return
-
-        for n in indexes[index]:
-            build = False
+    start = Node()
+    end = Node()
+    # 各 Node は最初に到達したときに 1 度だけ Edge を作る
+    worklist = [(start, 0)]
+    while worklist:
+        previous_node, index = worklist.pop()
+        # set の順序は文字列のハッシュ値によって変わるので、Node ID などがプロセス間で一致するように並べ替える
+        for n in sorted(indexes[index], key=EntryNode.sort_key):
             next_index = index + n.total_length()
             if next_index == len(text):
-                next_node = end_node
+                next_node = end
             elif next_index in indexed_nodes:
                 next_node = indexed_nodes[next_index]
             else:
                 next_node = indexed_nodes[next_index] = Node()
-                build = True
-            children = n.children()
-            deps = n.flatten_dependencies()
-            for d in deps:
-                entries = [Entry(e.input, e.output, e.next) for e in d+children]
-                edge = Edge(entries=entries, previous=previous_node, next=next_node)
-                previous_node.next_edges.append(edge)
-            if build:
-                build_nodes(next_node, end_node, next_index)
+                worklist.append((next_node, next_index))
+            add_edges(rule, previous_node, next_node, n, stats)
+        previous_node.update_inputtable()
+        if stats is not None:
+            stats.nodes += 1
+            stats.edges += len(previous_node.next_edges)
+
+    if stats is not None:
+        # 終端の Node は worklist に入らないので別に数える
+        stats.nodes += 1
+        finished = time.perf_counter()
+        stats.node_time += finished - indexed
+        stats.total_time += finished - started
+        if build_callback is not None:
+            build_callback(text, stats)
+    return Automaton(start, end)
+
+
+def build_merged_automaton(rules: Dict[str, Rule], text: str, stats: Optional[BuildStats] = None) -> MergedAutomaton:
+    """rules（配列の名前 -> Rule）のいずれでも text を入力できる、1 つの Automaton を作る
+
+    表示文字列の位置ごとの Node はすべての配列で共有し、同じ Entry の列を同じ位置の間で入力する Edge は
+    1 本にまとめて Edge.layouts に使える配列のビットを立てる。
+    各配列の Edge は、その配列で start から到達できる位置にだけ作る。
+    text を入力できない配列の Edge は作らない（MergedAutomaton.layout_mask でその配列を指定すると例外を送出する）。
+    すべての配列で入力できない場合は例外を送出する
+    """
+    if stats is None and build_callback is not None:
+        stats = BuildStats()
+    if stats is not None:
+        started = time.perf_counter()
+
+    names = tuple(rules)
+    en_tail = EntryNode(entry=DependentEntry("", "", ""), child=None)
+    indexes: List[Optional[Dict[int, Set[EntryNode]]]] = []
+    errors: List[str] = []
+    for name in names:
+        try:
+            indexes.append(build_index_based_inputtable(rules[name], text, en_tail, {}, stats))
+        except Exception as e:
+            indexes.append(None)
+            errors.append(f"{name}: {e}")
+    if len(errors) == len(names):
+        raise Exception(f"no layout can input {text!r} ({'; '.join(errors)})")
+    if stats is not None:
+        indexed = time.perf_counter()
+        stats.index_time += indexed - started
 
     start = Node()
     end = Node()
-    build_nodes(start, end, 0)
-    return Automaton(start, end)
+    nodes: Dict[int, Node] = {0: start, len(text): end}
+    # 位置ごとの、start からその位置まで入力できる配列のビット
+    reachable: Dict[int, int] = {0: sum(1 << bit for bit, inputtables in enumerate(indexes) if inputtables is not None)}
+    # 各 Rule で intern した Entry の列 -> 配列間で共有する Entry の列
+    # Entry の比較は input, output, next で行うので、別の Rule の同じ Entry の列も 1 つになる
+    shared_entries: Dict[Tuple[Entry, ...], Tuple[Entry, ...]] = {}
+    # id(EntryNode) -> (sort_key, total_length, 共有する Entry の列のリスト)
+    # search_parents のメモで同じ EntryNode が多くの位置に現れるので、Edge の内容は 1 度だけ求める
+    expanded: Dict[int, Tuple[Tuple[Tuple[str, str, str], ...], int, List[Tuple[Entry, ...]]]] = {}
+
+    def expand(rule: Rule, n: EntryNode):
+        children = tuple(n.children())
+        entries_list = []
+        for d in n.flatten_dependencies():
+            interned = rule.intern_entries(d + children)
+            entries_list.append(shared_entries.setdefault(interned, interned))
+        if stats is not None:
+            stats.dependency_paths += len(entries_list)
+            stats.max_dependency_paths = max(stats.max_dependency_paths, len(entries_list))
+        return n.sort_key(), n.total_length(), entries_list
+
+    # Edge は前にしか進まないので、位置の小さい順に処理すれば到達できる配列が確定している
+    for index in range(len(text)):
+        mask = reachable.get(index)
+        if not mask:
+            continue
+        previous_node = nodes[index]
+        # (次の位置, 共有する Entry の列の id) -> Edge
+        edges: Dict[Tuple[int, int], Edge] = {}
+        for bit, (name, inputtables) in enumerate(zip(names, indexes)):
+            layout = 1 << bit
+            if not mask & layout:
+                continue
+            candidates = []
+            for n in inputtables[index]:
+                e = expanded.get(id(n))
+                if e is None:
+                    e = expanded[id(n)] = expand(rules[name], n)
+                candidates.append(e)
+            candidates.sort(key=lambda e: e[0])
+            for _, length, entries_list in candidates:
+                next_index = index + length
+                next_node = nodes.get(next_index)
+                if next_node is None:
+                    next_node = nodes[next_index] = Node()
+                reachable[next_index] = reachable.get(next_index, 0) | layout
+                for entries in entries_list:
+                    key = (next_index, id(entries))
+                    edge = edges.get(key)
+                    if edge is None:
+                        edge = edges[key] = Edge(entries=entries, previous=previous_node, next=next_node, layouts=layout)
+                        previous_node.next_edges.append(edge)
+                    else:
+                        edge.layouts |= layout
+        previous_node.update_inputtable()
+        if stats is not None:
+            stats.nodes += 1
+            stats.edges += len(previous_node.next_edges)
+
+    if stats is not None:
+        stats.nodes += 1
+        finished = time.perf_counter()
+        stats.node_time += finished - indexed
+        stats.total_time += finished - started
+        if build_callback is not None:
+            build_callback(text, stats)
+    return MergedAutomaton(start, end, layout_names=names)
+
+
+def is_safe_boundary(rule: Rule, text: str, position: int) -> bool:
+    """text を position で分割して別々に build_automaton しても、分割せずに作った場合と同じ Edge になるかどうか
+
+    - position をまたぐ output を持つ Entry がない
+    - position の直前で終わる Entry が next や common prefix によって後続の入力に依存しない
+    """
+    if position <= 0 or position >= len(text):
+        return True
+    max_length = rule.max_output_length
+    value = Trie.VALUE
+    root = rule.output_suffix_trie.root
+    # position より後で終わる末尾のうち、position より前から始まるものがあれば position をまたぐ
+    for end in range(position + 1, min(len(text), position + max_length - 1) + 1):
+        node = root
+        for i in range(end - 1, max(-1, end - 1 - max_length), -1):
+            node = node.get(text[i])
+            if node is None:
+                break
+            if i < position and value in node:
+                return False
+    node = root
+    for i in range(position - 1, max(-1, position - 1 - max_length), -1):
+        node = node.get(text[i])
+        if node is None:
+            break
+        suffix = node.get(value)
+        if suffix is None:
+            continue
+        for e in suffix.outputs:
+            if e.next or e.has_only_common_prefix:
+                return False
+    return True
+
+
+def split_segments(rule: Rule, text: str) -> List[str]:
+    """text を安全な境界（is_safe_boundary）のすべてで分割する"""
+    segments = []
+    start = 0
+    for position in range(1, len(text)):
+        if is_safe_boundary(rule, text, position):
+            segments.append(text[start:position])
+            start = position
+    segments.append(text[start:])
+    return segments
+
+
+def concat_automata(automata: List[Automaton]) -> Automaton:
+    """安全な境界で分割して作った Automaton を順に連結した新しい Automaton を返す
+
+    Node と Edge は複製し、Edge の entries は元の Automaton と共有する
+    """
+    start = Node()
+    current = start
+    for i, auto in enumerate(automata):
+        end = Node()
+        mapped: Dict[int, Node] = {id(auto._start_node): current, id(auto._end_node): end}
+        worklist = [auto._start_node]
+        visited = {id(auto._start_node)}
+        while worklist:
+            old = worklist.pop()
+            new = mapped[id(old)]
+            for e in old.next_edges:
+                next_node = mapped.get(id(e.next))
+                if next_node is None:
+                    next_node = mapped[id(e.next)] = Node()
+                if id(e.next) not in visited:
+                    visited.add(id(e.next))
+                    worklist.append(e.next)
+                new.next_edges.append(Edge(entries=e.entries, previous=new, next=next_node))
+            new.update_inputtable()
+        current = end
+    return Automaton(start, current)
@@ -0,0 +1,125 @@
+# coding: utf-8
+"""出題文のリストから Automaton をまとめて作り、export の形式で書き出す
+
+    emil-compile --rule google_ime_tomoemon_azik.txt words.txt -o compiled.jsonl -e errors.jsonl
+    emil-compile --rule my_table.txt --jsonl --text-field sentence questions.jsonl -o compiled.jsonl
+
+入力は 1 行に 1 つの出題文か（--jsonl の場合は 1 行に 1 つの JSON オブジェクト）、"-" の場合は標準入力。
+出力は 1 行に 1 つの JSON で、{"id", "text", "nodes", "edges", "automaton"}（automaton は export.dumps の
+base64）。作れなかった出題文は {"id", "text", "error"} をエラー出力に書く。
+どちらも入力の順に、処理が終わったものから書き出す。--jsonl で読めなかった行もエラー出力に書く。
+作れなかった出題文があった場合は終了コード 1 で終わる
+"""
+from __future__ import annotations
+import argparse
+import base64
+import contextlib
+import json
+import sys
+import time
+from typing import Optional, List, Tuple, Iterable, Iterator, TextIO
+from . import export
+from .emil import Emil
+from .util import pool_map
+
+# (id, 出題文, 読み込めなかった場合のエラー)
+Item = Tuple[str, str, Optional[str]]
+# (id, 出題文, 出力する JSON, エラーかどうか)
+Result = Tuple[str, str, str, bool]
+
+
+def read_items(f: TextIO, jsonl: bool = False, text_field: str = "text", id_field: str = "id") -> Iterator[Item]:
+    """出題文を 1 つずつ読む（id がない場合は行番号）
+
+    JSON として読めない行と text_field がない行は、出題文を行そのものとしてエラーを付けて返す
+    """
+    for number, line in enumerate(f, 1):
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            continue
+        if not jsonl:
+            yield str(number), line, None
+            continue
+        try:
+            obj = json.loads(line)
+        except ValueError as e:
+            yield str(number), line, f"invalid JSON: {e}"
+            continue
+        if not isinstance(obj, dict):
+            yield str(number), line, "not a JSON object"
+            continue
+        id = str(obj.get(id_field, number))
+        text = obj.get(text_field)
+        if not isinstance(text, str):
+            yield id, line, f"{text_field} is not a string" if text_field in obj else f"{text_field} is missing"
+            continue
+        yield id, text, None
+
+
+def compile_item(emil: Emil, item: Item) -> Result:
+    id, text, error = item
+    if error is not None:
+        return id, text, json.dumps({"id": id, "text": text, "error": error}, ensure_ascii=False), True
+    try:
+        auto = emil.build(text)
+        flat = export.dumps(auto)
+        header = export.HEADER.unpack_from(flat)
+        record = {"id": id, "text": text, "nodes": header[3], "edges": header[5],
+                  "automaton": base64.b64encode(flat).decode("ascii")}
+        return id, text, json.dumps(record, ensure_ascii=False), False
+    except Exception as e:
+        return id, text, json.dumps({"id": id, "text": text, "error": str(e)}, ensure_ascii=False), True
+
+
+def compile_items(rule_file: str, items: Iterable[Item], processes: Optional[int] = None,
+                  chunksize: int = 64) -> Iterator[Result]:
+    """items を順に処理した結果を、入力の順に返す
+
+    util.pool_map で処理する（Emil はワーカーごとに 1 度だけ作る）。処理待ちのチャンクは一定数までしか
+    読み込まないので、items がどれだけ長くてもメモリの使用量は変わらない
+    """
+    if processes != 1:
+        # 各ワーカーが同時に読み込んでキャッシュを作らないように、先に 1 度コンパイルしておく
+        Emil.from_file(rule_file)
+    return pool_map(Emil.from_file, (rule_file,), compile_item, items, processes, chunksize)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="emil-compile", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="出題文のファイル（- で標準入力）")
+    parser.add_argument("--rule", required=True, help="ルールファイルのパス、または同梱のルールファイルの名前")
+    parser.add_argument("-o", "--output", default="-", help="出力先（- で標準出力）")
+    parser.add_argument("-e", "--errors", default="-", help="エラーの出力先（- で標準エラー出力）")
+    parser.add_argument("--jsonl", action="store_true", help="入力を 1 行に 1 つの JSON オブジェクトとして読む")
+    parser.add_argument("--text-field", default="text", help="--jsonl のときの出題文のキー")
+    parser.add_argument("--id-field", default="id", help="--jsonl のときの ID のキー")
+    parser.add_argument("-j", "--processes", type=int, default=None, help="ワーカー数（省略時は CPU 数）")
+    parser.add_argument("--chunksize", type=int, default=64, help="ワーカーに 1 度に渡す出題文の数")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    count = errors = 0
+    with contextlib.ExitStack() as stack:
+        def open_text(path: str, mode: str, std: TextIO) -> TextIO:
+            return std if path == "-" else stack.enter_context(open(path, mode, encoding="utf-8"))
+
+        f = open_text(args.input, "r", sys.stdin)
+        out = open_text(args.output, "w", sys.stdout)
+        err = open_text(args.errors, "w", sys.stderr)
+        items = read_items(f, args.jsonl, args.text_field, args.id_field)
+        for _, _, line, failed in compile_items(args.rule, items, args.processes, args.chunksize):
+            count += 1
+            if failed:
+                errors += 1
+                err.write(line + "\n")
+            else:
+                out.write(line + "\n")
+    elapsed = time.perf_counter() - started
+    print(f"compiled {count - errors}/{count} items in {elapsed:.2f}s ({count / elapsed if elapsed else 0:.0f} items/s)",
+          file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,36 @@
 # -*- coding: utf-8 -*-
+import os
 from pathlib import Path
 
 
+# 同梱のルールファイルで直接入力できる文字（キーボードから入力される文字）
+DIRECT_INPUTTABLE = frozenset("#',-./;@[]abcdefghijklmnopqrstuvwxyz~")
+
+
 def filepath(filename):
     return Path(__file__).resolve().parent / filename
+
+
+def resolve(rule_file) -> Path:
+    """ルールファイルのパスを返す。存在しない場合は同梱のルールファイルの名前として探す"""
+    path = Path(rule_file)
+    if not path.exists() and filepath(path.name).exists():
+        return filepath(path.name)
+    return path
+
+
+def cache_dir() -> Path:
+    """同梱のルールファイルをコンパイルした結果を置くディレクトリ
+
+    環境変数 EMIL_CACHE_DIR で変更できる
+    """
+    if "EMIL_CACHE_DIR" in os.environ:
+        return Path(os.environ["EMIL_CACHE_DIR"])
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "emil"
+
+
+def load_rule(filename, direct_inputtable):
+    """同梱のルールファイルを読み込む。初回にコンパイルした結果をキャッシュし、2 回目以降はそれを読み込む"""
+    from ..rule import Rule
+    return Rule.from_file_cached(str(filepath(filename)), direct_inputtable, str(cache_dir()))
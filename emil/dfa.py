@@ -0,0 +1,188 @@
+# coding: utf-8
+from __future__ import annotations
+from typing import Optional, List, Dict, Tuple, FrozenSet
+import dataclasses
+from dataclasses import dataclass
+from .rule import Entry
+from .automaton import ALL_LAYOUTS, Automaton, Node, Edge, State, InputResult, History
+from .guide import Guide
+from .util import slotted
+
+
+"""Automaton を 1 打鍵 1 回の dict 参照で遷移できる決定性の遷移表に変換する
+"""
+
+
+# 状態を一意に表すキー（Node と、入力可能な Edge, entry の位置, input の位置）
+StateKey = Tuple[int, Tuple[Tuple[int, int, int], ...]]
+# 遷移先の状態 ID と、その遷移で入力完了になった Entry
+Transition = Tuple[int, Tuple[Entry, ...]]
+
+
+def state_key(node: Node, available_edges: Tuple[Tuple[Edge, int, int], ...]) -> StateKey:
+    return id(node), tuple((id(e), entry_index, input_index) for e, entry_index, input_index in available_edges)
+
+
+@slotted
+@dataclass
+class CompiledState:
+    automaton: CompiledAutomaton
+    id: int
+    # これまでに入力が完了した Entry
+    history: History
+
+    @property
+    def node(self) -> Node:
+        return self.automaton.nodes[self.id]
+
+    @property
+    def available_edges(self) -> Tuple[Tuple[Edge, int, int], ...]:
+        return self.automaton.available_edges[self.id]
+
+    @property
+    def finished(self) -> bool:
+        return bool(self.node.finished)
+
+    @property
+    def inputtable(self) -> FrozenSet[str]:
+        return self.automaton.inputtables[self.id]
+
+    passed_entries = State.passed_entries
+    inputted = State.inputted
+    outputted = State.outputted
+
+    def test(self, i: str) -> InputResult:
+        transition = self.automaton.transit(self.id, i)
+        if transition is None:
+            return InputResult(False, self, ())
+        next_id, passed_entries = transition
+        new_state = CompiledState(self.automaton, next_id, self.history.extend(passed_entries))
+        return InputResult(True, new_state, passed_entries)
+
+    def __repr__(self):
+        return str((self.id, self.history.length))
+
+
+@dataclass
+class CompiledAutomaton:
+    """Automaton の到達可能な状態をすべて整数 ID に割り当てた遷移表
+
+    Automaton と同じ test/input/reset を持ち、1 打鍵ごとの遷移は dict の参照 1 回で済む
+    """
+    # 状態 ID ごとの元の Node と入力可能な Edge（inputted の計算と 2 文字以上の入力に使う）
+    nodes: List[Node] = dataclasses.field(default_factory=list)
+    available_edges: List[Tuple[Tuple[Edge, int, int], ...]] = dataclasses.field(default_factory=list)
+    # 状態 ID ごとの {入力文字: (遷移先の状態 ID, 入力完了になった Entry)}
+    transitions: List[Dict[str, Transition]] = dataclasses.field(default_factory=list)
+    # 状態 ID ごとの次に入力可能な文字
+    inputtables: List[FrozenSet[str]] = dataclasses.field(default_factory=list)
+    _ids: Dict[StateKey, int] = dataclasses.field(default_factory=dict, repr=False)
+    _state: CompiledState = dataclasses.field(init=False, repr=False)
+    _guide: Optional[Guide] = dataclasses.field(init=False, default=None, repr=False)
+    # 遷移表を作るときに使う配列（Automaton.set_layouts で指定したもの）
+    _layouts: int = dataclasses.field(default=ALL_LAYOUTS, repr=False)
+
+    @staticmethod
+    def from_automaton(auto: Automaton, layouts: Optional[int] = None) -> CompiledAutomaton:
+        """layouts を省略した場合は auto の現在の配列（Automaton.set_layouts）で使える Edge から作る"""
+        compiled = CompiledAutomaton(_layouts=auto._layouts if layouts is None else layouts)
+        start = auto._start_node
+        compiled.intern(start, start.start_edges(compiled._layouts))
+        compiled.reset()
+        return compiled
+
+    def intern(self, node: Node, available_edges: Tuple[Tuple[Edge, int, int], ...]) -> int:
+        """状態に ID を割り当て、そこから到達可能なすべての状態の遷移表を作る"""
+        key = state_key(node, available_edges)
+        if key in self._ids:
+            return self._ids[key]
+        first = self._ids[key] = len(self.nodes)
+        self.nodes.append(node)
+        self.available_edges.append(available_edges)
+        self.transitions.append({})
+        self.inputtables.append(frozenset())
+
+        # 再帰すると長い出題文で RecursionError になるので worklist で辿る
+        worklist = [first]
+        while worklist:
+            current = worklist.pop()
+            state = State(self.nodes[current], self.available_edges[current], History(), self._layouts)
+            transitions = self.transitions[current]
+            # 次に入力できる文字は各 Edge の現在の entry.input の次の 1 文字に限られる
+            for c in sorted({edge.entries[entry_index].input[input_index]
+                             for edge, entry_index, input_index in state.available_edges}):
+                result = state.test(c)
+                if not result.succeeded:
+                    continue
+                new_state = result.new_state
+                new_key = state_key(new_state.node, new_state.available_edges)
+                new_id = self._ids.get(new_key)
+                if new_id is None:
+                    new_id = self._ids[new_key] = len(self.nodes)
+                    self.nodes.append(new_state.node)
+                    self.available_edges.append(tuple(new_state.available_edges))
+                    self.transitions.append({})
+                    self.inputtables.append(frozenset())
+                    worklist.append(new_id)
+                transitions[c] = (new_id, result.passed_entries)
+            self.inputtables[current] = frozenset(transitions)
+        return first
+
+    def transit(self, state_id: int, i: str) -> Optional[Transition]:
+        transition = self.transitions[state_id].get(i)
+        if transition is not None or len(i) == 1:
+            return transition
+        if not i:
+            return None
+        # 2 文字以上の入力は遷移表に無いので、元の Automaton と同じ方法で遷移させる
+        result = State(self.nodes[state_id], self.available_edges[state_id], History(), self._layouts).test(i)
+        if not result.succeeded:
+            return None
+        return self.intern(result.new_state.node, tuple(result.new_state.available_edges)), result.passed_entries
+
+    @property
+    def state_count(self) -> int:
+        return len(self.nodes)
+
+    @property
+    def inputted(self) -> str:
+        return self._state.inputted
+
+    @property
+    def outputted(self) -> str:
+        return self._state.outputted
+
+    def test(self, i: str) -> InputResult:
+        """内部状態を変更せずに、入力を与えたときに得られる結果を返す
+        """
+        return self._state.test(i)
+
+    def input(self, i: str) -> InputResult:
+        """入力して内部状態を進め、そのときに得られる結果を返す
+        """
+        result = self.test(i)
+        self._state = result.new_state
+        return result
+
+    def inputtable(self) -> FrozenSet[str]:
+        """次の状態に遷移可能な入力（1 文字）の集合を返す
+        """
+        return self._state.inputtable
+
+    def reset(self):
+        """内部状態をリセットする
+        """
+        self._state = CompiledState(self, 0, History())
+
+    guide = property(Automaton.guide.fget)
+    head_print_str = Automaton.head_print_str
+    head_input_str = Automaton.head_input_str
+    tail_print_str = Automaton.tail_print_str
+    tail_input_str = Automaton.tail_input_str
+
+    @property
+    def _start_node(self) -> Node:
+        return self.nodes[0]
+
+    def set_guide_cost(self, cost):
+        self._guide = Guide(self._start_node, cost, self._layouts)
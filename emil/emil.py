@@ -1,18 +1,76 @@
 # coding: utf-8
 from __future__ import annotations
-from typing import Optional, List, Dict, Set
+from typing import Optional, List, Dict, Set, NamedTuple
+from collections import OrderedDict
 import dataclasses
 from dataclasses import dataclass
-from . import builder, automaton
+from . import builder, automaton, data
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
 
 
 @dataclass
 class Emil:
     rule: builder.Rule
+    # 区間ごとの Automaton を保持する数（LRU で破棄する）
+    cache_size: int = 4096
+    hits: int = dataclasses.field(init=False, default=0)
+    misses: int = dataclasses.field(init=False, default=0)
+    _cache: OrderedDict = dataclasses.field(init=False, default_factory=OrderedDict, repr=False)
+    # キャッシュの Automaton を作ったときの rule.generation
+    _generation: int = dataclasses.field(init=False, default=0, repr=False)
+
+    def __post_init__(self):
+        self._generation = self.rule.generation
 
     @staticmethod
-    def from_file(rule_file: str) -> Emil:
-        pass
+    def from_file(rule_file: str, direct_inputtable: Optional[Set[str]] = None, cache_size: int = 4096) -> Emil:
+        """ルールファイル（同梱のものは名前だけでもよい）から作る
+
+        コンパイルした Rule を data.cache_dir() にキャッシュするので、2 回目以降は読み込みが速い
+        """
+        if direct_inputtable is None:
+            direct_inputtable = data.DIRECT_INPUTTABLE
+        rule = builder.Rule.from_file_cached(str(data.resolve(rule_file)), direct_inputtable, str(data.cache_dir()))
+        return Emil(rule, cache_size)
 
     def build(self, word: str) -> automaton.Automaton:
-        pass
+        """word の Automaton を返す
+
+        word を安全な境界で区間に分割し、区間ごとに作った Automaton をキャッシュして連結する
+        """
+        if self._generation != self.rule.generation:
+            self.invalidate()
+        return builder.concat_automata([self.build_segment(s) for s in builder.split_segments(self.rule, word)])
+
+    def build_segment(self, segment: str) -> automaton.Automaton:
+        cache = self._cache
+        auto = cache.get(segment)
+        if auto is not None:
+            self.hits += 1
+            cache.move_to_end(segment)
+            return auto
+        self.misses += 1
+        auto = cache[segment] = builder.build_automaton(self.rule, segment)
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return auto
+
+    def invalidate(self):
+        """rule の update で変わった表示文字列を含む区間の Automaton だけをキャッシュから取り除く"""
+        changed = self.rule.changed_outputs(self._generation)
+        for segment in [s for s in self._cache if any(c in s for c in changed)]:
+            del self._cache[segment]
+        self._generation = self.rule.generation
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.cache_size, len(self._cache))
+
+    def cache_clear(self):
+        self._cache.clear()
+        self.hits = self.misses = 0
@@ -0,0 +1,310 @@
+# coding: utf-8
+from __future__ import annotations
+from typing import Optional, List, Dict, Tuple, FrozenSet
+from array import array
+import struct
+import sys
+from .rule import Entry
+from .automaton import ALL_LAYOUTS, Automaton, MergedAutomaton, Node
+
+
+"""Automaton を、クライアント側で打鍵を検証するための平坦なバイナリ形式に書き出す
+
+形式（すべてリトルエンディアン、配列は 4 バイトの整数）:
+
+    ヘッダ（HEADER）
+    node_edges    u32[node_count + 1]   Node i の Edge は node_edges[i] から node_edges[i + 1] の手前まで
+    edge_next     u32[edge_count]       遷移先の Node
+    edge_seq      u32[edge_count]       Entry の列の番号
+    edge_layouts  i32[edge_count]       Edge.layouts（-1 はすべての配列）
+    seq_offsets   u32[seq_count + 1]    Entry の列 i は entry_refs[seq_offsets[i]:seq_offsets[i + 1]]
+    entry_refs    u32[entry_ref_count]  Entry の番号
+    entries       u32[entry_count * 3]  Entry ごとの input, output, next の文字列の番号
+    layouts       u32[layout_count]     配列の名前の文字列の番号（MergedAutomaton の場合）
+    string_offsets u32[string_count + 1]
+    strings       UTF-8 のバイト列
+
+Node 0 が開始の Node で、終端の Node の番号はヘッダに持つ
+"""
+
+
+FORMAT_VERSION = 1
+MAGIC = b"EMAT"
+# magic, version, flags（未使用）, node_count, end_node, edge_count, seq_count, entry_ref_count, entry_count,
+# string_count, string_bytes, layout_count
+HEADER = struct.Struct("<4sHHIIIIIIIII")
+
+
+def _to_bytes(a: array) -> bytes:
+    if sys.byteorder == "big":
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+def dumps(auto: Automaton) -> bytes:
+    """auto の start から到達できる Node と Edge を書き出す"""
+    strings: Dict[str, int] = {}
+    entries: Dict[Tuple[str, str, str], int] = {}
+    seqs: Dict[Tuple[Entry, ...], int] = {}
+    entry_array = array("I")
+    seq_offsets = array("I", [0])
+    entry_refs = array("I")
+
+    def string_id(s: str) -> int:
+        if s not in strings:
+            strings[s] = len(strings)
+        return strings[s]
+
+    def seq_id(seq: Tuple[Entry, ...]) -> int:
+        i = seqs.get(seq)
+        if i is None:
+            i = seqs[seq] = len(seqs)
+            for e in seq:
+                key = (e.input, e.output, e.next)
+                if key not in entries:
+                    entries[key] = len(entries)
+                    entry_array.extend((string_id(e.input), string_id(e.output), string_id(e.next)))
+                entry_refs.append(entries[key])
+            seq_offsets.append(len(entry_refs))
+        return i
+
+    # Node に幅優先で番号を付ける（Edge は Node の番号順に並べる）
+    start = auto._start_node
+    ids: Dict[int, int] = {id(start): 0}
+    order: List[Node] = [start]
+    node_edges = array("I", [0])
+    edge_next = array("I")
+    edge_seq = array("I")
+    edge_layouts = array("i")
+    for node in order:
+        for e in node.next_edges:
+            next_id = ids.get(id(e.next))
+            if next_id is None:
+                next_id = ids[id(e.next)] = len(order)
+                order.append(e.next)
+            edge_next.append(next_id)
+            edge_seq.append(seq_id(e.entries))
+            edge_layouts.append(e.layouts)
+        node_edges.append(len(edge_next))
+    if id(auto._end_node) not in ids:
+        raise Exception("end node is not reachable")
+
+    layouts = array("I", (string_id(name) for name in auto.layout_names)
+                    if isinstance(auto, MergedAutomaton) else ())
+    encoded = [s.encode("utf-8") for s in strings]
+    string_offsets = array("I", [0])
+    for b in encoded:
+        string_offsets.append(string_offsets[-1] + len(b))
+    string_bytes = b"".join(encoded)
+
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(order), ids[id(auto._end_node)], len(edge_next), len(seqs),
+                         len(entry_refs), len(entries), len(strings), len(string_bytes), len(layouts))
+    return b"".join([header, *(_to_bytes(a) for a in (node_edges, edge_next, edge_seq, edge_layouts, seq_offsets,
+                                                      entry_refs, entry_array, layouts, string_offsets)),
+                     string_bytes])
+
+
+def dump(auto: Automaton, path: str):
+    with open(path, "wb") as f:
+        f.write(dumps(auto))
+
+
+class FlatAutomaton:
+    """dumps で書き出した形式を、Edge ごとのオブジェクトを作らずに memoryview で参照する
+
+    test, input, inputtable などは元の Automaton と同じ結果を返す（クライアント側の実装の参考にもする）
+    """
+
+    def __init__(self, data: bytes):
+        view = memoryview(data)
+        if len(view) < HEADER.size:
+            raise Exception("invalid automaton data")
+        (magic, version, _, self.node_count, self.end_node, self.edge_count, seq_count, entry_ref_count,
+         entry_count, string_count, string_bytes, layout_count) = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise Exception("invalid automaton data")
+        if version != FORMAT_VERSION:
+            raise Exception(f"unsupported automaton format version: {version}")
+
+        offset = HEADER.size
+
+        def take(typecode: str, count: int) -> memoryview:
+            nonlocal offset
+            size = count * 4
+            if offset + size > len(view):
+                raise Exception("invalid automaton data")
+            part = view[offset:offset+size]
+            offset += size
+            if sys.byteorder == "big":
+                # ビッグエンディアンの環境では並べ替えたコピーを使う
+                a = array(typecode, part.tobytes())
+                a.byteswap()
+                return memoryview(a)
+            return part.cast(typecode)
+
+        self.node_edges = take("I", self.node_count + 1)
+        self.edge_next = take("I", self.edge_count)
+        self.edge_seq = take("I", self.edge_count)
+        self.edge_layouts = take("i", self.edge_count)
+        self.seq_offsets = take("I", seq_count + 1)
+        self.entry_refs = take("I", entry_ref_count)
+        self.entries = take("I", entry_count * 3)
+        layouts = take("I", layout_count)
+        self.string_offsets = take("I", string_count + 1)
+        if offset + string_bytes > len(view):
+            raise Exception("invalid automaton data")
+        self.string_bytes = view[offset:offset+string_bytes]
+        # 参照された文字列だけを decode して保持する
+        self._strings: Dict[int, str] = {}
+        self.layout_names = tuple(self.string(i) for i in layouts)
+        self._layouts = ALL_LAYOUTS
+        self.reset()
+
+    @staticmethod
+    def load(path: str) -> FlatAutomaton:
+        with open(path, "rb") as f:
+            return FlatAutomaton(f.read())
+
+    def string(self, i: int) -> str:
+        s = self._strings.get(i)
+        if s is None:
+            s = self._strings[i] = bytes(self.string_bytes[self.string_offsets[i]:self.string_offsets[i+1]]).decode("utf-8")
+        return s
+
+    def entry(self, i: int) -> Tuple[str, str, str]:
+        """Entry の (input, output, next)"""
+        return self.string(self.entries[i*3]), self.string(self.entries[i*3+1]), self.string(self.entries[i*3+2])
+
+    def edge_entries(self, edge: int) -> memoryview:
+        """Edge の Entry の番号の列"""
+        seq = self.edge_seq[edge]
+        return self.entry_refs[self.seq_offsets[seq]:self.seq_offsets[seq+1]]
+
+    def select_layouts(self, *names: str):
+        """names の配列だけで入力するようにして、内部状態をリセットする（names がない場合はすべての配列）
+
+        MergedAutomaton.layout_mask と同じく、表示文字列を入力できない配列を指定した場合は例外を送出する
+        """
+        mask = ALL_LAYOUTS if not names else 0
+        for name in names:
+            if name not in self.layout_names:
+                raise Exception(f"unknown layout: {name}")
+            layout = 1 << self.layout_names.index(name)
+            if not any(self.edge_layouts[e] & layout for e in range(self.node_edges[0], self.node_edges[1])):
+                raise Exception(f"layout {name} cannot input the text")
+            mask |= layout
+        self._layouts = mask
+        self.reset()
+
+    def start_edges(self, node: int) -> Tuple[Tuple[int, int, int], ...]:
+        layouts = self._layouts
+        return tuple((e, 0, 0) for e in range(self.node_edges[node], self.node_edges[node+1])
+                     if self.edge_layouts[e] & layouts)
+
+    def reset(self):
+        self._node = 0
+        self._available = self.start_edges(0)
+        # 入力が完了した Entry の番号
+        self._history: List[int] = []
+
+    def __input(self, i: str, edge: int, entry_index: int, input_index: int,
+                finished: Tuple[int, ...] = ()) -> Tuple[bool, int, int, Tuple[int, ...]]:
+        # State.__input と同じ
+        entries = self.edge_entries(edge)
+        while i and entry_index < len(entries):
+            entry_input, _, entry_next = self.entry(entries[entry_index])
+            if not entry_input.startswith(i, input_index):
+                return False, entry_index, input_index, finished
+            if len(entry_input) != input_index + len(i):
+                return True, entry_index, input_index + len(i), finished
+            # entry.input の最後の文字を入力完了したので、next を次の entry に入力する
+            finished += (entries[entry_index],)
+            i = entry_next
+            entry_index += 1
+            input_index = 0
+        return bool(finished), entry_index, input_index, finished
+
+    def __recorded(self, available: Tuple[Tuple[int, int, int], ...]) -> int:
+        # automaton.recorded_entries と同じ
+        if not available:
+            return 0
+        count = min(entry_index for _, entry_index, _ in available)
+        if not count:
+            return 0
+        first = self.edge_entries(available[0][0])
+        for edge, _, _ in available[1:]:
+            entries = self.edge_entries(edge)
+            n = 0
+            while n < count and entries[n] == first[n]:
+                n += 1
+            count = n
+        return count
+
+    def __test(self, i: str) -> Optional[Tuple[int, Tuple[Tuple[int, int, int], ...], Tuple[int, ...]]]:
+        # State.test と同じく、最初に入力完了になった Edge で遷移し、すべての Edge で完了した entry だけを記録する
+        new_available = []
+        recorded = self.__recorded(self._available)
+        for edge, entry_index, input_index in self._available:
+            succeeded, new_entry_index, new_input_index, _ = self.__input(i, edge, entry_index, input_index)
+            if succeeded:
+                entries = self.edge_entries(edge)
+                if new_entry_index == len(entries):
+                    next_node = self.edge_next[edge]
+                    return next_node, self.start_edges(next_node), tuple(entries[recorded:])
+                new_available.append((edge, new_entry_index, new_input_index))
+        if new_available:
+            available = tuple(new_available)
+            entries = self.edge_entries(available[0][0])
+            return self._node, available, tuple(entries[recorded:self.__recorded(available)])
+        return None
+
+    def test(self, i: str) -> bool:
+        return self.__test(i) is not None
+
+    def input(self, i: str) -> bool:
+        result = self.__test(i)
+        if result is None:
+            return False
+        self._node, self._available, finished = result
+        self._history.extend(finished)
+        return True
+
+    def inputtable(self) -> FrozenSet[str]:
+        return frozenset(self.entry(self.edge_entries(edge)[entry_index])[0][input_index]
+                         for edge, entry_index, input_index in self._available)
+
+    @property
+    def finished(self) -> bool:
+        return self._node == self.end_node
+
+    @property
+    def outputted(self) -> str:
+        return "".join(self.entry(e)[1] for e in self._history)
+
+    @property
+    def inputted(self) -> str:
+        inputted = []
+        next = 0
+        for e in self._history:
+            entry_input, _, entry_next = self.entry(e)
+            inputted.append(entry_input[next:])
+            next = len(entry_next)
+        if self._available:
+            # automaton.pending_input と同じく、記録していない entry から入力中の位置まで
+            edge, entry_index, input_index = self._available[0]
+            entries = self.edge_entries(edge)
+            recorded = self.__recorded(self._available)
+            for k in range(recorded, entry_index + 1):
+                entry_input, _, entry_next = self.entry(entries[k])
+                inputted.append(entry_input[next:input_index if k == entry_index else None])
+                next = len(entry_next)
+        return "".join(inputted)
+
+
+def loads(data: bytes) -> FlatAutomaton:
+    return FlatAutomaton(data)
+
+
+def load(path: str) -> FlatAutomaton:
+    return FlatAutomaton.load(path)
@@ -0,0 +1,139 @@
+# coding: utf-8
+from __future__ import annotations
+from typing import Optional, List, Dict, Tuple, Callable
+from .rule import Rule
+from .automaton import ALL_LAYOUTS, Node, Edge, recorded_entries
+
+
+"""残りの入力文字列（入力ガイド）を求める
+
+Automaton の終端から逆向きに、各 Node から終端までのもっともらしい Edge を 1 度だけ求めておき、
+問い合わせのたびには選んだ Edge をたどって文字列を組み立てるだけにする
+"""
+
+
+# (Edge, entry の位置, input の位置) から残りを入力するときのコストを返す
+# コストは数値のタプルで、経路ごとに要素ごとの和を取り、辞書順で小さいものを選ぶ
+EdgeCost = Callable[[Edge, int, int], Tuple[float, ...]]
+
+
+def remaining_inputs(edge: Edge, entry_index: int, input_index: int) -> List[str]:
+    """Edge の (entry の位置, input の位置) から残りを入力するときのキー列を entry ごとに返す
+
+    直前の entry の next で自動入力される部分は除く
+    """
+    entries = edge.entries
+    inputs = [entries[entry_index].input[input_index:]]
+    for k in range(entry_index + 1, len(entries)):
+        inputs.append(entries[k].input[len(entries[k-1].next):])
+    return inputs
+
+
+def fewest_keystrokes(edge: Edge, entry_index: int, input_index: int) -> Tuple[float, ...]:
+    """打鍵数がもっとも少ないものを選ぶ"""
+    return sum(len(i) for i in remaining_inputs(edge, entry_index, input_index)),
+
+
+def rule_order(rule: Rule) -> EdgeCost:
+    """ルールファイルで先に書かれている Entry を使うものを優先し、同じ場合は打鍵数が少ないものを選ぶ
+
+    ルールにない Entry（直接入力）はすべての Entry より後ろとして扱う
+    """
+    ranks: Dict[str, int] = {e.input: i for i, e in enumerate(rule.elist)}
+    last = len(rule.elist)
+
+    def cost(edge: Edge, entry_index: int, input_index: int) -> Tuple[float, ...]:
+        rank = sum(ranks.get(e.input, last) for e in edge.entries[entry_index:])
+        return rank, fewest_keystrokes(edge, entry_index, input_index)[0]
+    return cost
+
+
+def _add(a: Tuple[float, ...], b: Optional[Tuple[float, ...]]) -> Tuple[float, ...]:
+    if b is None:
+        return a
+    return tuple(x + y for x, y in zip(a, b))
+
+
+class Guide:
+    """各 Node から終端までの、コストが最小になる Edge を保持する
+
+    layouts を指定した場合は、その配列で使える Edge だけを選ぶ
+    """
+
+    def __init__(self, start: Node, cost: EdgeCost = fewest_keystrokes, layouts: int = ALL_LAYOUTS):
+        self.cost = cost
+        self.layouts = layouts
+        # id(Node) -> (終端までのコスト, 選んだ Edge)。終端はコスト None（0 として扱う）
+        self.best: Dict[int, Tuple[Optional[Tuple[float, ...]], Optional[Edge]]] = {}
+        best = self.best
+        for node in self.__postorder(start):
+            chosen = None
+            for edge in node.next_edges:
+                if not edge.layouts & layouts or id(edge.next) not in best:
+                    continue
+                c = _add(cost(edge, 0, 0), best[id(edge.next)][0])
+                if chosen is None or c < chosen[0]:
+                    chosen = (c, edge)
+            if chosen:
+                best[id(node)] = chosen
+            elif not node.next_edges:
+                best[id(node)] = (None, None)
+            # 使える Edge で終端まで行けない Node は best に入れない
+
+    @staticmethod
+    def __postorder(start: Node) -> List[Node]:
+        # 長い出題文でも再帰しないように、明示的なスタックで帰りがけ順に並べる
+        order = []
+        visited = {id(start)}
+        stack = [(start, iter(start.next_edges))]
+        while stack:
+            node, edges = stack[-1]
+            for edge in edges:
+                if id(edge.next) not in visited:
+                    visited.add(id(edge.next))
+                    stack.append((edge.next, iter(edge.next.next_edges)))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+        return order
+
+    def choose(self, available_edges: Tuple[Tuple[Edge, int, int], ...]) -> Optional[Tuple[Edge, int, int]]:
+        """入力中の Edge のうち、残りのコストが最小になるものを返す"""
+        chosen = None
+        chosen_cost = None
+        for edge, entry_index, input_index in available_edges:
+            if id(edge.next) not in self.best:
+                continue
+            c = _add(self.cost(edge, entry_index, input_index), self.best[id(edge.next)][0])
+            if chosen is None or c < chosen_cost:
+                chosen, chosen_cost = (edge, entry_index, input_index), c
+        return chosen
+
+    def __path(self, node: Node) -> List[Edge]:
+        edges = []
+        edge = self.best.get(id(node), (None, None))[1]
+        while edge is not None:
+            edges.append(edge)
+            edge = self.best[id(edge.next)][1]
+        return edges
+
+    def tail_input(self, available_edges: Tuple[Tuple[Edge, int, int], ...]) -> str:
+        chosen = self.choose(available_edges)
+        if chosen is None:
+            return ""
+        inputs = remaining_inputs(*chosen)
+        for edge in self.__path(chosen[0].next):
+            inputs.extend(remaining_inputs(edge, 0, 0))
+        return "".join(inputs)
+
+    def tail_print(self, available_edges: Tuple[Tuple[Edge, int, int], ...]) -> str:
+        chosen = self.choose(available_edges)
+        if chosen is None:
+            return ""
+        edge = chosen[0]
+        # History に記録していない entry は入力が完了していても残りに含める
+        outputs = [e.output for e in edge.entries[recorded_entries(available_edges):]]
+        for edge in self.__path(edge.next):
+            outputs.extend(e.output for e in edge.entries)
+        return "".join(outputs)
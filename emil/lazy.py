@@ -0,0 +1,171 @@
+# coding: utf-8
+from __future__ import annotations
+from typing import Optional, List, Dict, Set, Tuple, FrozenSet
+import bisect
+from .rule import Rule, DependentEntry
+from .automaton import ALL_LAYOUTS, Automaton, Node, Edge, State, History
+from .builder import EntryNode, build_index_based_inputtable, add_edges, is_safe_boundary
+
+
+"""入力の進行に合わせて Automaton を少しずつ作る
+"""
+
+
+class LazyNode(Node):
+    """next_edges を最初に参照されたときに作る Node"""
+    __slots__ = ("position", "_automaton", "_edges", "_inputtable")
+
+    def __init__(self, automaton: LazyAutomaton, position: int):
+        self.position = position
+        self._automaton = automaton
+        self._edges: Optional[List[Edge]] = None
+        self._inputtable: FrozenSet[str] = frozenset()
+
+    @property
+    def next_edges(self) -> List[Edge]:
+        if self._edges is None:
+            self._edges = []
+            self._automaton.expand(self)
+        return self._edges
+
+    @property
+    def inputtable(self) -> FrozenSet[str]:
+        self.next_edges
+        return self._inputtable
+
+    @inputtable.setter
+    def inputtable(self, inputtable: FrozenSet[str]):
+        self._inputtable = inputtable
+
+    def __repr__(self):
+        return f"LazyNode(position={self.position}, expanded={self._edges is not None})"
+
+
+class LazyAutomaton:
+    """State が到達した Node の Edge だけを作る Automaton
+
+    出題文を安全な境界（builder.is_safe_boundary）で segment_length 文字以上の区間に分け、
+    build_index_based_inputtable は State が区間に入ったときにその区間の分だけ行う。
+    入力が区間を通り過ぎると、その区間の index と Node を手放す（test で得た古い State が参照している分は残る）。
+    test, input, inputtable などは build_automaton で作った Automaton と同じ結果を返す。
+    入力できない出題文は build_automaton と同じく作成時に例外を送出する（すべての区間の index を作って確かめる）。
+    validate=False の場合は、ルールのどの output にも含まれない文字がないことだけを確かめるので、長い出題文でも
+    すぐに作れる。そのかわり、それ以外の理由で入力できない出題文は、入力がその区間に入ったときに input, test,
+    inputtable が build_automaton と同じ例外を送出する
+    """
+    # 1 つの Rule から作るので、すべての Edge を使う
+    _layouts = ALL_LAYOUTS
+
+    def __init__(self, rule: Rule, text: str, segment_length: int = 64, validate: bool = True):
+        if not text:
+            raise Exception("text is required")
+        self.rule = rule
+        self.text = text
+        self.segment_length = segment_length
+        # 区間の開始位置（昇順）。必要になったところまでしか求めない（__validate ではすべて求める）
+        self._boundaries: List[int] = [0]
+        # 区間の開始位置 -> その区間内の位置ごとの EntryNode
+        self._indexes: Dict[int, Dict[int, Set[EntryNode]]] = {}
+        self._nodes: Dict[int, LazyNode] = {}
+        self._end_node = LazyNode(self, len(text))
+        self._released = 0
+        self.__check_characters()
+        if validate:
+            self.__validate()
+        self.reset()
+
+    def __check_characters(self):
+        """出題文の各文字が、ルールのいずれかの output か直接入力可能な文字列に含まれていることを確かめる"""
+        missing = set(self.text)
+        for strings in (self.rule.output_edict, self.rule.direct_inputtable):
+            for s in strings:
+                missing.difference_update(s)
+                if not missing:
+                    return
+        raise Exception(f"cannot input characters: {''.join(sorted(missing))}")
+
+    def __validate(self):
+        """すべての区間の index を作れることを確かめる（index は保持しない）
+
+        区間の間で search_parents のメモを共有するので、同じ文字列が繰り返される出題文では
+        build_index_based_inputtable より速い
+        """
+        memo: Dict[Tuple[str, EntryNode], List[EntryNode]] = {}
+        en_tail = EntryNode(entry=DependentEntry("", "", ""), child=None)
+        start = 0
+        while start < len(self.text):
+            self.__segment(start)
+            end = self._boundaries[bisect.bisect_right(self._boundaries, start)]
+            build_index_based_inputtable(self.rule, self.text[start:end], en_tail, {}, memo=memo)
+            start = end
+
+    def __segment(self, position: int) -> int:
+        """position を含む区間の開始位置を返す"""
+        boundaries = self._boundaries
+        text = self.text
+        while boundaries[-1] <= position and boundaries[-1] < len(text):
+            p = boundaries[-1] + self.segment_length
+            while p < len(text) and not is_safe_boundary(self.rule, text, p):
+                p += 1
+            boundaries.append(min(p, len(text)))
+        return boundaries[bisect.bisect_right(boundaries, position) - 1]
+
+    def __index(self, start: int) -> Dict[int, Set[EntryNode]]:
+        index = self._indexes.get(start)
+        if index is None:
+            end = self._boundaries[bisect.bisect_right(self._boundaries, start)]
+            en_tail = EntryNode(entry=DependentEntry("", "", ""), child=None)
+            index = self._indexes[start] = build_index_based_inputtable(self.rule, self.text[start:end], en_tail, {})
+        return index
+
+    def node(self, position: int) -> LazyNode:
+        if position == len(self.text):
+            return self._end_node
+        node = self._nodes.get(position)
+        if node is None:
+            node = self._nodes[position] = LazyNode(self, position)
+        return node
+
+    def expand(self, node: LazyNode):
+        position = node.position
+        if position < len(self.text):
+            start = self.__segment(position)
+            for n in sorted(self.__index(start)[position - start], key=EntryNode.sort_key):
+                add_edges(self.rule, node, self.node(position + n.total_length()), n)
+        node.update_inputtable()
+
+    def __release(self):
+        position = self._state.node.position
+        start = self.__segment(position) if position < len(self.text) else len(self.text)
+        if start <= self._released:
+            return
+        self._released = start
+        for s in [s for s in self._indexes if s < start]:
+            del self._indexes[s]
+        for p in [p for p in self._nodes if p < position]:
+            del self._nodes[p]
+
+    @property
+    def _start_node(self) -> Node:
+        return self.node(0)
+
+    inputted = Automaton.inputted
+    outputted = Automaton.outputted
+    test = Automaton.test
+    inputtable = Automaton.inputtable
+    head_print_str = Automaton.head_print_str
+    head_input_str = Automaton.head_input_str
+
+    def input(self, i: str):
+        """入力して内部状態を進め、そのときに得られる結果を返す
+        """
+        result = Automaton.input(self, i)
+        self.__release()
+        return result
+
+    def reset(self):
+        """内部状態をリセットする
+        """
+        start = self.node(0)
+        self._state = State(start, tuple((e, 0, 0) for e in start.next_edges), History())
+        self._released = 0
@@ -0,0 +1,121 @@
+# coding: utf-8
+from __future__ import annotations
+from typing import Optional, List, Tuple, Iterable, Union
+from collections import OrderedDict
+import dataclasses
+from dataclasses import dataclass
+from .rule import Rule, Entry
+from .automaton import Automaton, History, State
+from .dfa import CompiledAutomaton, CompiledState
+from .emil import Emil
+from .util import pool_map
+
+
+"""記録した打鍵ログを出題文に対してまとめて再生し、検証する
+"""
+
+
+@dataclass
+class ReplayResult:
+    # 受け付けられなかった入力の keys 内での位置
+    misses: List[int]
+    # 入力が完了した Entry ごとの、完了した入力の keys 内での位置（passed_entries と同じ順序）
+    boundaries: List[int]
+    # 入力が完了した Entry
+    passed_entries: Tuple[Entry, ...]
+    # 再生後の CompiledAutomaton の状態 ID（Automaton で再生した場合は None）
+    state_id: Optional[int]
+    # 最後まで入力し終えたかどうか
+    completed: bool
+    # Automaton で再生した場合の再生後の状態
+    final_state: Optional[State] = dataclasses.field(default=None, repr=False)
+
+    def state(self, automaton: Union[Automaton, CompiledAutomaton]) -> Union[State, CompiledState]:
+        """再生後の状態を返す（automaton は replay に渡したもの）"""
+        if self.final_state is not None:
+            return self.final_state
+        return CompiledState(automaton, self.state_id, History().extend(self.passed_entries))
+
+
+def replay(automaton: Union[Automaton, CompiledAutomaton], keys: str) -> ReplayResult:
+    """keys を 1 文字ずつ入力したときの結果をまとめて返す（automaton の内部状態は変更せず、最初から入力する）
+
+    CompiledAutomaton の場合は、入力ごとに InputResult や State を作らずに遷移表を直接たどる。
+    Automaton の場合は遷移表を作らずに State をたどる（遷移表を作るのは、同じ出題文を何度も再生する場合だけ元が取れる）
+    """
+    if isinstance(automaton, Automaton):
+        return _replay_states(automaton, keys)
+    transitions = automaton.transitions
+    misses: List[int] = []
+    boundaries: List[int] = []
+    passed: List[Entry] = []
+    state = 0
+    for i, k in enumerate(keys):
+        transition = transitions[state].get(k)
+        if transition is None:
+            misses.append(i)
+            continue
+        state, entries = transition
+        if entries:
+            passed.extend(entries)
+            boundaries.extend([i] * len(entries))
+    return ReplayResult(misses, boundaries, tuple(passed), state, not automaton.inputtables[state])
+
+
+def _replay_states(automaton: Automaton, keys: str) -> ReplayResult:
+    start = automaton._start_node
+    layouts = automaton._layouts
+    state = State(start, start.start_edges(layouts), History(), layouts)
+    misses: List[int] = []
+    boundaries: List[int] = []
+    for i, k in enumerate(keys):
+        result = state.test(k)
+        if not result.succeeded:
+            misses.append(i)
+            continue
+        state = result.new_state
+        if result.passed_entries:
+            boundaries.extend([i] * len(result.passed_entries))
+    return ReplayResult(misses, boundaries, state.passed_entries, None, not state.available_edges, state)
+
+
+class Replayer:
+    """出題文ごとの Automaton を作って再生する（replay_many のワーカーごとに 1 つ作る）
+
+    出題文の Automaton は Emil.build のキャッシュを使って作り、直近 cache_size 個の出題文の分を保持する。
+    同じ出題文が 2 回目に再生されたときに遷移表（CompiledAutomaton）を作り、それ以降はそれを使う
+    """
+
+    def __init__(self, rule: Rule, cache_size: int = 1024):
+        self.emil = Emil(rule)
+        self.cache_size = cache_size
+        self._automata: OrderedDict = OrderedDict()
+
+    def automaton(self, text: str) -> Union[Automaton, CompiledAutomaton]:
+        automata = self._automata
+        automaton = automata.get(text)
+        if automaton is None:
+            automaton = automata[text] = self.emil.build(text)
+            if len(automata) > self.cache_size:
+                automata.popitem(last=False)
+        else:
+            if isinstance(automaton, Automaton):
+                automaton = automata[text] = automaton.compile()
+            automata.move_to_end(text)
+        return automaton
+
+    def replay(self, text: str, keys: str) -> ReplayResult:
+        return replay(self.automaton(text), keys)
+
+
+def _replay_pair(replayer: Replayer, pair: Tuple[str, str]) -> ReplayResult:
+    return replayer.replay(*pair)
+
+
+def replay_many(rule: Rule, pairs: Iterable[Tuple[str, str]],
+                processes: Optional[int] = None, chunksize: int = 64) -> List[ReplayResult]:
+    """(出題文, 打鍵ログ) の組をまとめて再生する
+
+    util.pool_map で処理する。出題文の Automaton はワーカーごとの Replayer で作る
+    """
+    return list(pool_map(Replayer, (rule,), _replay_pair, pairs, processes, chunksize))
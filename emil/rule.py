@@ -1,12 +1,39 @@
 # coding: utf-8
 from __future__ import annotations
-from typing import Optional, List, Dict, Set
+from typing import Optional, List, Dict, Set, FrozenSet, Tuple, Iterable, NamedTuple
 import dataclasses
 from dataclasses import dataclass
+from pathlib import Path
+import hashlib
+import marshal
+import mmap
+import os
+import struct
 from . import data
-from .strings import split_prefixes
+from .strings import Trie
+from .util import slotted
 
 
+# Rule.save_compiled で書き出すファイルの形式
+# 保存する内容を変えたときは COMPILED_FORMAT_VERSION を上げて、古いキャッシュを使わないようにする
+COMPILED_FORMAT_VERSION = 2
+_COMPILED_MAGIC = b"EMILRULE"
+# magic, version, key(sha256)
+_COMPILED_HEADER = struct.Struct("<8sI32s")
+
+
+def compiled_key(source: bytes, direct_inputtable: Iterable[str], allow_direct_next_input: bool = False) -> bytes:
+    """コンパイル済み Rule のキャッシュキー（ルールファイルの内容と直接入力可能な文字の集合から決まる）"""
+    h = hashlib.sha256()
+    h.update(struct.pack("<I", COMPILED_FORMAT_VERSION))
+    h.update(source)
+    h.update(b"\0")
+    h.update("\0".join(sorted(direct_inputtable)).encode("utf-8"))
+    h.update(b"\1" if allow_direct_next_input else b"\0")
+    return h.digest()
+
+
+@slotted
 @dataclass
 class Entry:
     input: str
@@ -32,13 +59,30 @@ class DependentEntry(Entry):
     has_only_common_prefix: bool = False
     # 直接入力可能な Entry かどうか
     is_direct_inputtable: bool = False
+    # この Entry の前に入力する Entry の列の候補（dependencies と substitutables をたどったもの）
+    # Rule.fill_dependency_paths で初期化し、Entry 間で共有する
+    dependency_paths: Tuple[Tuple[DependentEntry, ...], ...] = dataclasses.field(
+        init=False, default=((),), repr=False, compare=False)
 
     def __hash__(self):
         return hash((self.input, self.output, self.next))
 
 
+class OutputSuffix(NamedTuple):
+    """Rule.output_suffix_trie の値。表示文字列の末尾 text に一致する Entry など"""
+    text: str
+    # output が text の Entry
+    outputs: List[DependentEntry]
+    # output + next が text の Entry
+    outputs_with_next: List[DependentEntry]
+    # text が直接入力可能かどうか
+    direct_inputtable: bool
+
+
 @dataclass
 class Rule:
+    # interned_entries, interned_entry_lists に持つ数の上限
+    MAX_INTERNED = 1 << 16
     elist: List[Entry]
     direct_inputtable: Set[str]
     # 次の入力を使って、直接入力可能な Entry を入力済みにしたことにできるかどうか
@@ -49,8 +93,18 @@ class Rule:
     input_edict: Dict[str, DependentEntry] = dataclasses.field(init=False)
     output_edict: Dict[str, List[DependentEntry]] = dataclasses.field(init=False)
     output_with_next_edict:  Dict[str, List[DependentEntry]] = dataclasses.field(init=False)
+    # input をキーにした Trie と、output などを逆順にしたものをキーにした Trie（make_dict で作る）
+    input_trie: Trie = dataclasses.field(init=False, repr=False)
+    output_suffix_trie: Trie = dataclasses.field(init=False, repr=False)
     max_output_length: int = 0
+    # Automaton の Edge で共有する Entry と Entry の列（intern_entry, intern_entries で追加する）
+    # それぞれ MAX_INTERNED 個を超えたら空にする。pickle には含めない
+    interned_entries: Dict[Tuple[str, str, str], Entry] = dataclasses.field(init=False, repr=False)
+    interned_entry_lists: Dict[Tuple[Entry, ...], Tuple[Entry, ...]] = dataclasses.field(init=False, repr=False)
     __only_next_edict: Dict[str, List[DependentEntry]] = dataclasses.field(init=False)
+    # update で Entry を変更するたびに増える値と、各 generation で変更された output（changed_outputs で参照する）
+    generation: int = dataclasses.field(init=False, default=0)
+    changes: List[Tuple[int, FrozenSet[str]]] = dataclasses.field(init=False, default_factory=list, repr=False)
 
     def __post_init__(self):
         self.max_output_length = max(len(e.output) + len(e.next) for e in self.elist)
@@ -58,47 +112,76 @@ class Rule:
         self.fill_dependencies()
         self.fill_substitutables()
         self.fill_common_prefix()
+        self.fill_dependency_paths()
 
     def fill_substitutables(self):
-        next_edict = self.__only_next_edict
+        for e in self.dependent_entry_list:
+            self.__fill_substitutables(e)
 
-        def fill(e: DependentEntry):
-            for i in range(len(e.input)):
-                substr = e.input[:i+1]
-                if substr in next_edict:
-                    e.substitutables.extend(next_edict[substr])
+    def __fill_substitutables(self, e: DependentEntry):
+        if e.dependencies:
+            return
+        next_edict = self.__only_next_edict
+        for i in range(len(e.input)):
+            substr = e.input[:i+1]
+            if substr in next_edict:
+                e.substitutables.extend(next_edict[substr])
 
+    def fill_dependencies(self):
         for e in self.dependent_entry_list:
-            if not e.dependencies:
-                fill(e)
+            self.__fill_dependencies(e)
 
-    def fill_dependencies(self):
+    def __fill_dependencies(self, e: DependentEntry):
         direct = self.direct_inputtable
         next_edict = self.__only_next_edict
+        for i, c in enumerate(reversed(e.input)):
+            if c not in direct:
+                # 直接入力ができない文字が input に含まれている場合は、事前に入力すべき依存関係として
+                # その文字を「次の入力」に含む entry を探す
+                next_required_substr = e.input[:len(e.input)-i]
+                if next_required_substr in next_edict:
+                    # ここで fill するのは、ある entry を入力する前に必ず入力すべき entry なので
+                    # output がある entry は無視する
+                    e.dependencies.extend(next_edict[next_required_substr])
+                    return
+                raise Exception(f"cannot input entry: {e}")
 
-        def fill(e: DependentEntry):
-            for i, c in enumerate(reversed(e.input)):
-                if c not in direct:
-                    # 直接入力ができない文字が input に含まれている場合は、事前に入力すべき依存関係として
-                    # その文字を「次の入力」に含む entry を探す
-                    next_required_substr = e.input[:len(e.input)-i]
-                    if next_required_substr in next_edict:
-                        # ここで fill するのは、ある entry を入力する前に必ず入力すべき entry なので
-                        # output がある entry は無視する
-                        e.dependencies.extend(next_edict[next_required_substr])
-                        return
-                    raise Exception(f"cannot input entry: {e}")
+    def fill_dependency_paths(self, entries: Optional[List[DependentEntry]] = None):
+        """dependencies, substitutables をたどって、各 Entry の前に入力する Entry の列をすべて求める
 
-        for e in self.dependent_entry_list:
+        依存先の Entry の結果を使い回すので、各 Entry について 1 度ずつしか計算しない。
+        entries を指定した場合はそれらだけを計算し直す（それ以外の Entry は計算済みの値を使う）
+        """
+        paths: Dict[int, Tuple[Tuple[DependentEntry, ...], ...]] = {}
+        if entries is not None:
+            targets = {id(e) for e in entries}
+            paths = {id(e): e.dependency_paths for e in self.dependent_entry_list if id(e) not in targets}
+
+        def fill(e: DependentEntry) -> Tuple[Tuple[DependentEntry, ...], ...]:
+            if id(e) in paths:
+                return paths[id(e)]
+            result: List[Tuple[DependentEntry, ...]] = []
+            if not e.dependencies or e.substitutables:
+                result.append(())
+            for d in e.dependencies + e.substitutables:
+                result.extend(p + (d,) for p in fill(d))
+            paths[id(e)] = e.dependency_paths = tuple(result)
+            return e.dependency_paths
+
+        for e in self.dependent_entry_list if entries is None else entries:
             fill(e)
 
     def fill_common_prefix(self):
-        input_edict = self.input_edict
+        value = Trie.VALUE
+        root = self.input_trie.root
         for e in self.elist:
-            prefixes = split_prefixes(e.input, len(e.input)-1)
-            for p in prefixes:
-                if p in input_edict:
-                    input_edict[p].has_only_common_prefix = True
+            # input の途中までをたどる間に値を持つノードがあれば、それは e.input の接頭辞
+            node = root
+            for c in e.input:
+                p = node.get(value)
+                if p is not None:
+                    p.has_only_common_prefix = True
+                node = node[c]
 
     def make_dict(self):
         i = self.input_edict = {}
@@ -106,6 +189,8 @@ class Rule:
         n = self.__only_next_edict = {}
         d = self.dependent_entry_list = []
         w = self.output_with_next_edict = {}
+        self.interned_entries = {}
+        self.interned_entry_lists = {}
         for e in self.elist:
             if not e.input:
                 raise Exception(f"input is required: {e}")
@@ -122,6 +207,218 @@ class Rule:
                 n.setdefault(de.next, []).append(de)
             if de.next:
                 w.setdefault(de.output + de.next, []).append(de)
+        self.make_tries()
+
+    def make_tries(self):
+        """input_edict, output_edict, output_with_next_edict と direct_inputtable から Trie を作る"""
+        self.input_trie = Trie()
+        for key, e in self.input_edict.items():
+            self.input_trie.insert(key, e)
+        self.output_suffix_trie = Trie()
+        o = self.output_edict
+        w = self.output_with_next_edict
+        # max_output_length より長い直接入力可能な文字列は、表示文字列の末尾として調べることがない
+        direct = {s for s in self.direct_inputtable if len(s) <= self.max_output_length}
+        for key in o.keys() | w.keys() | direct:
+            self.output_suffix_trie.insert(key[::-1], OutputSuffix(key, o.get(key, []), w.get(key, []), key in direct))
+
+    def add_entry(self, e: Entry) -> int:
+        return self.update(add=[e])
+
+    def remove_entry(self, input: str) -> int:
+        return self.update(remove=[input])
+
+    def replace_entry(self, e: Entry) -> int:
+        """e と同じ input を持つ Entry を e に置き換える"""
+        return self.update(add=[e], remove=[e.input])
+
+    def update(self, add: Iterable[Entry] = (), remove: Iterable[str] = ()) -> int:
+        """remove の input を持つ Entry を削除してから add の Entry を追加し、新しい generation を返す
+
+        影響を受ける Entry の依存関係などだけを計算し直す。削除した input の Entry を追加した場合は元の位置に入る。
+        失敗した場合は変更前の Entry から作り直してから例外を送出する
+        """
+        elist = self.elist
+        try:
+            return self.__update(list(add), list(remove))
+        except Exception:
+            self.elist = elist
+            self.__post_init__()
+            raise
+
+    def __update(self, add: List[Entry], remove: List[str]) -> int:
+        value = Trie.VALUE
+        i = self.input_edict
+        o = self.output_edict
+        n = self.__only_next_edict
+        w = self.output_with_next_edict
+        slots: List[Optional[Entry]] = list(self.elist)
+        positions = {e.input: p for p, e in enumerate(slots)}
+        # バケットの並びは Rule を作り直した場合と同じ elist の順にする
+        touched: Set[Tuple[int, str]] = set()
+        buckets = (o, n, w)
+
+        def bucket_keys(de: DependentEntry):
+            if de.output:
+                yield 0, de.output
+            if not de.output and de.next:
+                yield 1, de.next
+            if de.next:
+                yield 2, de.output + de.next
+
+        removed: List[DependentEntry] = []
+        for input in remove:
+            de = i.pop(input, None)
+            if de is None:
+                raise Exception(f"no entry for input: {input}")
+            removed.append(de)
+            slots[positions[input]] = None
+            self.input_trie.remove(input)
+            for b, key in bucket_keys(de):
+                buckets[b][key].remove(de)
+                if not buckets[b][key]:
+                    del buckets[b][key]
+                touched.add((b, key))
+
+        added: List[DependentEntry] = []
+        for e in add:
+            if not e.input:
+                raise Exception(f"input is required: {e}")
+            if not e.output and not e.next:
+                raise Exception(f"either output or next is required: {e}")
+            if e.input in i:
+                raise Exception(f"duplicate input entry: {e}")
+            if e.input in positions and slots[positions[e.input]] is None:
+                slots[positions[e.input]] = e
+            else:
+                slots.append(e)
+            de = i[e.input] = DependentEntry(input=e.input, output=e.output, next=e.next)
+            added.append(de)
+            self.input_trie.insert(e.input, de)
+            for b, key in bucket_keys(de):
+                buckets[b].setdefault(key, []).append(de)
+                touched.add((b, key))
+
+        self.elist = [e for e in slots if e is not None]
+        if not self.elist:
+            raise Exception("rule must have at least one entry")
+        positions = {e.input: p for p, e in enumerate(self.elist)}
+        for b, key in touched:
+            if key in buckets[b]:
+                buckets[b][key].sort(key=lambda de: positions[de.input])
+        self.dependent_entry_list = [i[e.input] for e in self.elist]
+
+        # next だけを持つ Entry が変わると、その next で始まる input の Entry の依存関係が変わる
+        changed = removed + added
+        refill = {id(de): de for de in added}
+        for de in changed:
+            if not de.output and de.next:
+                refill.update((id(d), d) for d in self.input_trie.values(de.next))
+        for de in refill.values():
+            de.dependencies = []
+            de.substitutables = []
+            self.__fill_dependencies(de)
+        for de in refill.values():
+            self.__fill_substitutables(de)
+
+        # 変わった input の接頭辞を input に持つ Entry は common prefix かどうかが変わりうる
+        prefixes: Dict[int, DependentEntry] = {}
+        for de in changed:
+            node = self.input_trie.root
+            for c in de.input:
+                p = node.get(value)
+                if p is not None:
+                    prefixes[id(p)] = p
+                node = node.get(c)
+                if node is None:
+                    break
+            else:
+                if de.input in i:
+                    prefixes[id(de)] = de
+        for p in prefixes.values():
+            node = self.input_trie.node(p.input)
+            # 値以外のキー（子）があれば、p.input より長い input がある
+            p.has_only_common_prefix = len(node) > 1
+
+        # 依存関係が変わった Entry に依存する Entry の dependency_paths を計算し直す
+        closure = dict(refill)
+        worklist = list(refill.values())
+        while worklist:
+            de = worklist.pop()
+            if not de.output and de.next:
+                for d in self.input_trie.values(de.next):
+                    if id(d) not in closure:
+                        closure[id(d)] = d
+                        worklist.append(d)
+        self.fill_dependency_paths(list(closure.values()))
+
+        max_output_length = max(len(e.output) + len(e.next) for e in self.elist)
+        if max_output_length != self.max_output_length:
+            self.max_output_length = max_output_length
+            self.make_tries()
+        else:
+            direct = self.direct_inputtable
+            for _, key in touched:
+                if not key:
+                    continue
+                is_direct = key in direct and len(key) <= max_output_length
+                if key in o or key in w or is_direct:
+                    self.output_suffix_trie.insert(key[::-1], OutputSuffix(key, o.get(key, []), w.get(key, []), is_direct))
+                else:
+                    self.output_suffix_trie.remove(key[::-1])
+
+        outputs: Set[str] = set()
+        for de in [*changed, *prefixes.values(), *closure.values()]:
+            outputs.add(de.output)
+            outputs.add(de.output + de.next)
+        outputs.discard("")
+        self.generation += 1
+        self.changes.append((self.generation, frozenset(outputs)))
+        return self.generation
+
+    def changed_outputs(self, since: int) -> Set[str]:
+        """generation が since より後の update で、Automaton の作り方が変わりうる表示文字列を返す
+
+        これらの文字列を含まない出題文の Automaton は作り直さなくてよい
+        """
+        outputs: Set[str] = set()
+        for generation, changed in reversed(self.changes):
+            if generation <= since:
+                break
+            outputs |= changed
+        return outputs
+
+    def intern_entry(self, e: Entry) -> Entry:
+        """e と同じ input, output, next を持つ Entry を、この Rule から作る Automaton 全体で 1 つにして返す"""
+        key = (e.input, e.output, e.next)
+        interned = self.interned_entries
+        entry = interned.get(key)
+        if entry is None:
+            if len(interned) >= self.MAX_INTERNED:
+                interned.clear()
+            entry = interned[key] = Entry(e.input, e.output, e.next)
+        return entry
+
+    def intern_entries(self, entries: Iterable[Entry]) -> Tuple[Entry, ...]:
+        """同じ Entry の列を持つ Edge で entries を共有するために、intern した Entry のタプルを返す
+
+        上限を超えて空にした後は、それ以前に作った Automaton とは共有しない（作成済みの Automaton はそのまま使える）
+        """
+        key = tuple(self.intern_entry(e) for e in entries)
+        interned = self.interned_entry_lists
+        entry_list = interned.get(key)
+        if entry_list is None:
+            if len(interned) >= self.MAX_INTERNED:
+                interned.clear()
+            entry_list = interned[key] = key
+        return entry_list
+
+    def __getstate__(self):
+        # プロセスプールに渡すときに、intern した Entry の列を送らない
+        state = self.__dict__.copy()
+        state["interned_entries"] = {}
+        state["interned_entry_lists"] = {}
+        return state
 
     @staticmethod
     def from_text(data: str, direct_inputtable: Set[str]) -> Rule:
@@ -147,3 +444,128 @@ class Rule:
     def from_file(entry_file_path: str, direct_inputtable: Set[str]) -> Rule:
         with open(entry_file_path, encoding="utf-8") as f:
             return Rule.from_text(f.read(), direct_inputtable)
+
+    def save_compiled(self, path: str, key: bytes):
+        """依存関係などを解決済みの状態で保存する
+
+        Entry の dict と Trie、dependency_paths も Entry の位置で保存し、読み込むときに計算し直さない。
+        key には compiled_key() の値を渡す。load_compiled で同じ key を指定した場合のみ読み込まれる
+        """
+        entries = self.dependent_entry_list
+        indexes = {id(e): i for i, e in enumerate(entries)}
+
+        def entry_lists(edict: Dict[str, List[DependentEntry]]) -> Dict[str, Tuple[int, ...]]:
+            return {k: tuple(indexes[id(e)] for e in v) for k, v in edict.items()}
+
+        suffixes: List[Tuple[str, bool]] = []
+
+        def suffix_index(suffix: OutputSuffix) -> int:
+            suffixes.append((suffix.text, suffix.direct_inputtable))
+            return len(suffixes) - 1
+
+        output_suffix_trie = self.output_suffix_trie.dump(suffix_index)
+        payload = (
+            tuple(sorted(self.direct_inputtable)),
+            self.allow_direct_next_input,
+            self.max_output_length,
+            tuple((e.input, e.output, e.next) for e in self.elist),
+            # 依存関係などは初期値と異なる Entry のものだけを保存する
+            tuple((i,
+                   e.has_only_common_prefix,
+                   e.is_direct_inputtable,
+                   tuple(indexes[id(d)] for d in e.dependencies),
+                   tuple(indexes[id(d)] for d in e.substitutables))
+                  for i, e in enumerate(entries)
+                  if e.has_only_common_prefix or e.is_direct_inputtable or e.dependencies or e.substitutables),
+            entry_lists(self.output_edict),
+            entry_lists(self.__only_next_edict),
+            entry_lists(self.output_with_next_edict),
+            self.input_trie.dump(lambda e: indexes[id(e)]),
+            output_suffix_trie,
+            tuple(suffixes),
+            tuple((i, tuple(tuple(indexes[id(d)] for d in p) for p in e.dependency_paths))
+                  for i, e in enumerate(entries) if e.dependency_paths != ((),)),
+        )
+        # 途中で失敗しても壊れたファイルが残らないように、一時ファイルに書いてから置き換える
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_COMPILED_HEADER.pack(_COMPILED_MAGIC, COMPILED_FORMAT_VERSION, key))
+            marshal.dump(payload, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load_compiled(path: str, key: Optional[bytes] = None) -> Optional[Rule]:
+        """save_compiled で保存した Rule を読み込む
+
+        形式のバージョンか key が一致しない場合と、ファイルが壊れている（空、途中で切れている、別の形式）場合は
+        None を返す（呼び出し側で作り直して保存し直す）
+        """
+        try:
+            payload = Rule.__read_compiled(path, key)
+            if payload is None:
+                return None
+            (direct_inputtable, allow_direct_next_input, max_output_length, elist, dependents,
+             output_edict, only_next_edict, output_with_next_edict, input_trie, output_suffix_trie, suffixes,
+             dependency_paths) = payload
+            # __post_init__ の依存関係の解決や make_dict はせずに、保存済みの結果を復元する
+            rule = Rule.__new__(Rule)
+            rule.elist = [Entry(input=i, output=o, next=n) for i, o, n in elist]
+            rule.direct_inputtable = set(direct_inputtable)
+            rule.allow_direct_next_input = allow_direct_next_input
+            rule.max_output_length = max_output_length
+            rule.generation = 0
+            rule.changes = []
+            rule.interned_entries = {}
+            rule.interned_entry_lists = {}
+            entries = rule.dependent_entry_list = [DependentEntry(input=i, output=o, next=n) for i, o, n in elist]
+            rule.input_edict = {e.input: e for e in entries}
+            o = rule.output_edict = {k: [entries[i] for i in v] for k, v in output_edict.items()}
+            rule.__only_next_edict = {k: [entries[i] for i in v] for k, v in only_next_edict.items()}
+            w = rule.output_with_next_edict = {k: [entries[i] for i in v] for k, v in output_with_next_edict.items()}
+            rule.input_trie = Trie.load(input_trie, entries)
+            rule.output_suffix_trie = Trie.load(output_suffix_trie, [
+                OutputSuffix(text, o.get(text, []), w.get(text, []), direct) for text, direct in suffixes])
+            for i, common_prefix, direct, dependencies, substitutables in dependents:
+                e = entries[i]
+                e.has_only_common_prefix = common_prefix
+                e.is_direct_inputtable = direct
+                e.dependencies = [entries[d] for d in dependencies]
+                e.substitutables = [entries[d] for d in substitutables]
+            for i, paths in dependency_paths:
+                entries[i].dependency_paths = tuple(tuple(entries[d] for d in p) for p in paths)
+            return rule
+        except (ValueError, TypeError, EOFError, IndexError, KeyError, struct.error):
+            return None
+
+    @staticmethod
+    def __read_compiled(path: str, key: Optional[bytes]) -> Optional[tuple]:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < _COMPILED_HEADER.size:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                magic, version, saved_key = _COMPILED_HEADER.unpack_from(m)
+                if magic != _COMPILED_MAGIC or version != COMPILED_FORMAT_VERSION \
+                        or (key is not None and key != saved_key):
+                    return None
+                with memoryview(m) as view:
+                    return marshal.loads(view[_COMPILED_HEADER.size:])
+
+    @staticmethod
+    def from_file_cached(entry_file_path: str, direct_inputtable: Set[str], cache_dir: str) -> Rule:
+        """cache_dir にコンパイル済みの Rule があればそれを読み込み、なければ作って保存する"""
+        with open(entry_file_path, "rb") as f:
+            source = f.read()
+        key = compiled_key(source, direct_inputtable)
+        cache_path = Path(cache_dir) / f"{Path(entry_file_path).stem}.{key.hex()[:16]}.rule"
+        if cache_path.exists():
+            rule = Rule.load_compiled(str(cache_path), key)
+            if rule:
+                return rule
+        rule = Rule.from_text(source.decode("utf-8"), direct_inputtable)
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            rule.save_compiled(str(cache_path), key)
+        except OSError:
+            # キャッシュを書き込めない環境でも Rule は使えるようにする
+            pass
+        return rule
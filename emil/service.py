@@ -0,0 +1,207 @@
+# coding: utf-8
+from __future__ import annotations
+from typing import Optional, List, Dict, Tuple, NamedTuple, Deque
+from collections import deque
+from concurrent.futures import Executor
+import asyncio
+import statistics
+import time
+from .rule import Rule
+from .builder import build_automaton
+from .session import SessionManager, SharedAutomaton, Session
+from .util import run_in_worker, worker_executor
+
+
+"""asyncio のサーバーから使う入力判定の API
+
+打鍵はセッションごとのキューに入れ、イベントループの 1 回の処理（tick）の間に届いたものをまとめて判定する。
+Automaton の作成はイベントループを止めないように executor で行う
+"""
+
+
+class KeyResult(NamedTuple):
+    # 入力を受け付けたかどうか
+    accepted: bool
+    # 最後まで入力し終えたかどうか
+    finished: bool
+
+
+class TickMetrics(NamedTuple):
+    # この tick で判定した打鍵の数と、打鍵があったセッションの数
+    keystrokes: int
+    sessions: int
+    # 1 つのセッションのキューにたまっていた打鍵の最大数
+    max_queue_depth: int
+    # 打鍵を受け取ってから判定し終えるまでの時間（秒）の最大と平均
+    max_latency: float
+    mean_latency: float
+    # 判定にかかった時間（秒）
+    processing_time: float
+
+
+def build_shared(rule: Rule, text: str) -> SharedAutomaton:
+    """executor で実行する（Node と Edge を持たない SharedAutomaton だけを返すので、プロセス間で渡せる）"""
+    return SharedAutomaton.from_automaton(build_automaton(rule, text))
+
+
+def _worker_rule(rule: Rule) -> Rule:
+    """worker_executor の各ワーカーで 1 度だけ Rule を受け取る"""
+    return rule
+
+
+# (入力文字, 結果を返す Future, 受け取った時刻)
+_Pending = Tuple[str, "asyncio.Future[KeyResult]", float]
+
+
+class TypingService:
+    """1 つの Rule の問題とセッションを管理する
+
+    1 つのイベントループから使う（スレッドセーフではない）。
+    build_automaton は GIL を離さないので、スレッドプールで実行してもイベントループが止まる。
+    executor を省略した場合はこのインスタンスが作るプロセスプールで Automaton を作り、shutdown で終了する。
+    このプロセスプールには Rule をワーカーごとに 1 度だけ渡し、prepare では text だけを送る
+    （executor を指定した場合は prepare のたびに Rule も pickle して送る）。
+    rule が update されたとき（Rule.generation が変わったとき）は、次の prepare でプロセスプールを作り直し、
+    変わった表示文字列を含む問題の登録を取り消す（開いているセッションは作成済みの遷移表を使い続ける）
+    """
+
+    def __init__(self, rule: Rule, executor: Optional[Executor] = None, metrics_size: int = 1024):
+        self.rule = rule
+        self._owns_executor = executor is None
+        self.executor = executor if executor is not None else worker_executor(_worker_rule, (rule,))
+        self.manager = SessionManager()
+        # 問題 ID -> 出題文と、登録済みの問題を作ったときの rule.generation
+        self._texts: Dict[str, str] = {}
+        self._generation = rule.generation
+        # セッション ID -> 判定待ちの打鍵
+        self._queues: Dict[str, List[_Pending]] = {}
+        self._scheduled = False
+        # 作成中の問題（同じ問題を同時に prepare しても 1 度だけ作る）
+        self._preparing: Dict[str, asyncio.Task] = {}
+        # 直近の tick の TickMetrics
+        self.ticks: Deque[TickMetrics] = deque(maxlen=metrics_size)
+        self.total_keystrokes = 0
+
+    async def prepare(self, question_id: str, text: str):
+        """text の Automaton を executor で作り、question_id で登録する（登録済みの場合は何もしない）"""
+        self._sync_rule()
+        if (question_id, None) in self.manager.automata:
+            return
+        task = self._preparing.get(question_id)
+        if task is None:
+            task = self._preparing[question_id] = asyncio.ensure_future(self._prepare(question_id, text))
+        await asyncio.shield(task)
+
+    async def _prepare(self, question_id: str, text: str):
+        try:
+            loop = asyncio.get_running_loop()
+            while True:
+                generation = self.rule.generation
+                if self._owns_executor:
+                    automaton = await loop.run_in_executor(self.executor, run_in_worker, build_shared, text)
+                else:
+                    automaton = await loop.run_in_executor(self.executor, build_shared, self.rule, text)
+                # 作っている間に rule が update され、text に影響する場合は作り直す
+                self._sync_rule()
+                if generation == self.rule.generation \
+                        or not any(c in text for c in self.rule.changed_outputs(generation)):
+                    break
+            self.manager.register_shared(question_id, automaton)
+            self._texts[question_id] = text
+        finally:
+            del self._preparing[question_id]
+
+    def _sync_rule(self):
+        """rule.generation が変わっていれば、プロセスプールを作り直し、影響を受ける問題の登録を取り消す"""
+        if self._generation == self.rule.generation:
+            return
+        changed = self.rule.changed_outputs(self._generation)
+        self._generation = self.rule.generation
+        if self._owns_executor:
+            # 実行中の作成は古いプロセスプールで終わらせる（結果は _prepare で捨てる）
+            self.executor.shutdown(wait=False)
+            self.executor = worker_executor(_worker_rule, (self.rule,))
+        for question_id, text in list(self._texts.items()):
+            if any(c in text for c in changed):
+                del self._texts[question_id]
+                for key in [k for k in self.manager.automata if k[0] == question_id]:
+                    del self.manager.automata[key]
+
+    def shutdown(self):
+        """このインスタンスが作ったプロセスプールを終了する"""
+        if self._owns_executor:
+            self.executor.shutdown()
+
+    def open(self, session_id: str, question_id: str) -> Session:
+        """セッションを作る（問題は prepare 済みであること）"""
+        return self.manager.open(session_id, question_id)
+
+    def close(self, session_id: str):
+        """セッションを閉じる（判定待ちの打鍵は受け付けなかったものとして返す）"""
+        for _, future, _ in self._queues.pop(session_id, []):
+            if not future.done():
+                future.set_result(KeyResult(False, False))
+        self.manager.close(session_id)
+
+    def submit(self, session_id: str, key: str) -> asyncio.Future:
+        """打鍵をキューに入れ、判定結果の KeyResult を返す Future を返す
+
+        同じ tick の間に届いた打鍵は、その tick の最後にまとめて判定する
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if session_id not in self.manager.sessions:
+            future.set_exception(Exception(f"unknown session: {session_id}"))
+            return future
+        self._queues.setdefault(session_id, []).append((key, future, time.perf_counter()))
+        if not self._scheduled:
+            self._scheduled = True
+            loop.call_soon(self._flush)
+        return future
+
+    async def input(self, session_id: str, key: str) -> KeyResult:
+        return await self.submit(session_id, key)
+
+    @property
+    def queue_depth(self) -> int:
+        """判定待ちの打鍵の数"""
+        return sum(len(q) for q in self._queues.values())
+
+    def _flush(self):
+        self._scheduled = False
+        queues, self._queues = self._queues, {}
+        started = time.perf_counter()
+        latencies = []
+        max_depth = 0
+        for session_id, pending in queues.items():
+            max_depth = max(max_depth, len(pending))
+            session = self.manager.sessions.get(session_id)
+            for key, future, received in pending:
+                if session is None:
+                    result = KeyResult(False, False)
+                else:
+                    s = session[2]
+                    accepted = s.input(key)
+                    result = KeyResult(accepted, not s.automaton.transitions[s.state_id])
+                if not future.done():
+                    future.set_result(result)
+                latencies.append(time.perf_counter() - received)
+        if latencies:
+            self.total_keystrokes += len(latencies)
+            self.ticks.append(TickMetrics(len(latencies), len(queues), max_depth, max(latencies),
+                                          statistics.mean(latencies), time.perf_counter() - started))
+
+    def metrics(self) -> Dict[str, float]:
+        """直近の tick の集計"""
+        ticks = list(self.ticks)
+        latencies = sorted(t.max_latency for t in ticks)
+        return {
+            "ticks": len(ticks),
+            "total_keystrokes": self.total_keystrokes,
+            "queue_depth": self.queue_depth,
+            "mean_batch_size": float(statistics.mean(t.keystrokes for t in ticks)) if ticks else 0.0,
+            "max_queue_depth": max((t.max_queue_depth for t in ticks), default=0),
+            "p50_tick_latency": latencies[len(latencies) // 2] if latencies else 0.0,
+            "p99_tick_latency": latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] if latencies else 0.0,
+            "max_processing_time": max((t.processing_time for t in ticks), default=0.0),
+        }
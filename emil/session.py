@@ -0,0 +1,342 @@
+# coding: utf-8
+from __future__ import annotations
+from typing import Optional, List, Dict, Tuple, NamedTuple, FrozenSet
+from array import array
+import bisect
+import hashlib
+import struct
+import sys
+from .rule import Entry
+from .automaton import ALL_LAYOUTS, Automaton, MergedAutomaton, pending_input
+from .dfa import CompiledAutomaton
+
+
+"""1 つの Automaton を共有する多数の入力セッションを、小さな値で保存・復元できる形で管理する
+"""
+
+
+class SharedAutomaton:
+    """複数のセッションから参照される、変更しない遷移表
+
+    CompiledAutomaton の遷移表を、Entry を整数 ID に置き換えたものとして持つ。
+    Node と Edge は参照しないので、別のプロセスで作って pickle で受け取れる
+    """
+
+    def __init__(self, automaton: CompiledAutomaton):
+        # input, output, next だけを持つ Entry（DependentEntry の依存関係は持たない）
+        self.entries: List[Entry] = []
+        ids: Dict[int, int] = {}
+
+        def entry_id(e: Entry) -> int:
+            if id(e) not in ids:
+                ids[id(e)] = len(self.entries)
+                self.entries.append(Entry(e.input, e.output, e.next))
+            return ids[id(e)]
+
+        # 状態 ID ごとの {入力文字: (遷移先の状態 ID, 入力完了になった Entry の ID)}
+        self.transitions: List[Dict[str, Tuple[int, Tuple[int, ...]]]] = [
+            {c: (next_id, tuple(entry_id(e) for e in entries)) for c, (next_id, entries) in t.items()}
+            for t in automaton.transitions
+        ]
+        self.inputtables: List[FrozenSet[str]] = automaton.inputtables
+        # 状態 ID ごとの、履歴に記録していない入力済みの部分（inputted の計算に使う）
+        self.pending_inputs: List[str] = [pending_input(edges) for edges in automaton.available_edges]
+        # 別のプロセスで作った SharedAutomaton と同じものかを確認するための値
+        h = hashlib.sha256()
+        for i, t in enumerate(self.transitions):
+            h.update(repr((i, sorted(t.items()))).encode("utf-8"))
+        for e in self.entries:
+            h.update(repr((e.input, e.output, e.next)).encode("utf-8"))
+        self.fingerprint = h.digest()[:8]
+
+    @staticmethod
+    def from_automaton(auto: Automaton, layouts: Optional[int] = None) -> SharedAutomaton:
+        return SharedAutomaton(auto.compile(layouts))
+
+
+class SessionHandle(NamedTuple):
+    # SharedAutomaton の状態 ID（Node と入力中の Edge, entry, input の位置を表す）
+    state_id: int
+    # セッションの履歴のうち有効な Entry の数
+    history_offset: int
+    # snapshot したときの Session.epoch（その後に history_offset より前の履歴が上書きされていれば restore できない）
+    epoch: int
+
+    _struct = struct.Struct("<III")
+
+    def pack(self) -> bytes:
+        return self._struct.pack(self.state_id, self.history_offset, self.epoch)
+
+    @classmethod
+    def unpack(cls, data: bytes) -> SessionHandle:
+        return cls(*cls._struct.unpack(data))
+
+
+class Session:
+    """1 人分の入力状態
+
+    状態は (状態 ID, 履歴の長さ, epoch) だけで表され、履歴はセッションごとの Entry ID の配列に追記する。
+    snapshot() は 12 バイトの値を返すだけなので毎打鍵呼んでよく、restore() で履歴の長さを戻すと
+    それ以降の履歴は次の入力で上書きされる。上書きされた履歴を含む snapshot は restore できない
+    """
+    # 別のプロセスへ移すときの形式: magic, version, fingerprint, state_id, history_offset, epoch
+    _DUMP_HEADER = struct.Struct("<4sB8sIII")
+    _DUMP_MAGIC = b"EMSS"
+    _DUMP_VERSION = 2
+
+    def __init__(self, automaton: SharedAutomaton):
+        self.automaton = automaton
+        self.state_id = 0
+        # Entry ID の配列（dumps では 4 バイトのリトルエンディアンで書き出す）
+        self.history = array("I")
+        self.history_offset = 0
+        # 履歴を上書きするたびに 1 増やす
+        self.epoch = 0
+        # epoch i から i + 1 に変わったときに位置 p を上書きしたことを (i, p) として、p が昇順になるように持つ
+        # （後でより前の位置を上書きした記録があれば、それより後の位置の記録は不要なので捨てる。履歴の長さまでしか増えない）
+        self._overwritten_epochs = array("I")
+        self._overwritten_offsets = array("I")
+        # これより前の epoch の snapshot は restore できない（loads したセッションは上書きの記録を持たない）
+        self.oldest_epoch = 0
+        # 履歴の位置ごとの、入力文字列の断片（直前の Entry の next で自動入力された部分を除く）と表示文字列
+        self._input_pieces: List[str] = []
+        self._outputs: List[str] = []
+        # 履歴の位置ごとの、その位置までの inputted と outputted の長さ
+        self._inputted_lengths = array("I")
+        self._outputted_lengths = array("I")
+        # 最後に組み立てた (履歴の長さ, inputted, outputted)
+        self._cache: Tuple[int, str, str] = (0, "", "")
+
+    def test(self, key: str) -> bool:
+        """内部状態を変更せずに、key を入力できるかどうかを返す"""
+        return key in self.automaton.transitions[self.state_id]
+
+    def input(self, key: str) -> bool:
+        """1 文字入力して内部状態を進め、入力できたかどうかを返す"""
+        transition = self.automaton.transitions[self.state_id].get(key)
+        if transition is None:
+            return False
+        self.state_id, entry_ids = transition
+        if entry_ids:
+            if self.history_offset < len(self.history):
+                self.__truncate()
+            for e in entry_ids:
+                self.__append(e)
+        return True
+
+    def __truncate(self):
+        """history_offset より後の履歴を捨てる（その位置から上書きする）"""
+        offset = self.history_offset
+        del self.history[offset:]
+        del self._input_pieces[offset:]
+        del self._outputs[offset:]
+        del self._inputted_lengths[offset:]
+        del self._outputted_lengths[offset:]
+        epochs, offsets = self._overwritten_epochs, self._overwritten_offsets
+        while offsets and offsets[-1] >= offset:
+            epochs.pop()
+            offsets.pop()
+        epochs.append(self.epoch)
+        offsets.append(offset)
+        self.epoch += 1
+        count, inputted, outputted = self._cache
+        if count > offset:
+            self._cache = (offset, inputted[:self.__inputted_length(offset)],
+                           outputted[:self.__outputted_length(offset)])
+
+    def __append(self, entry_id: int):
+        entries = self.automaton.entries
+        e = entries[entry_id]
+        history = self.history
+        piece = e.input[len(entries[history[-1]].next):] if history else e.input
+        history.append(entry_id)
+        self._input_pieces.append(piece)
+        self._outputs.append(e.output)
+        self._inputted_lengths.append(self.__inputted_length(len(history) - 1) + len(piece))
+        self._outputted_lengths.append(self.__outputted_length(len(history) - 1) + len(e.output))
+        self.history_offset += 1
+
+    def __inputted_length(self, length: int) -> int:
+        return self._inputted_lengths[length - 1] if length else 0
+
+    def __outputted_length(self, length: int) -> int:
+        return self._outputted_lengths[length - 1] if length else 0
+
+    def reset(self):
+        self.state_id = 0
+        self.history_offset = 0
+
+    @property
+    def handle(self) -> SessionHandle:
+        return SessionHandle(self.state_id, self.history_offset, self.epoch)
+
+    def snapshot(self) -> bytes:
+        return self.handle.pack()
+
+    def restore(self, data: bytes):
+        """snapshot() の値に戻す（同じセッションの履歴を使う）"""
+        handle = SessionHandle.unpack(data)
+        if handle.state_id >= len(self.automaton.transitions) or handle.epoch > self.epoch:
+            raise Exception(f"invalid session handle: {handle}")
+        if handle.epoch < self.oldest_epoch:
+            raise Exception(f"session handle is stale: {handle}")
+        # snapshot の後に、その履歴の範囲内が上書きされていないこと
+        # （snapshot の後の記録のうち最初のものが、それ以降で最も前の位置を上書きしている）
+        i = bisect.bisect_left(self._overwritten_epochs, handle.epoch)
+        if i < len(self._overwritten_offsets) and self._overwritten_offsets[i] < handle.history_offset:
+            raise Exception(f"session handle is stale: {handle}")
+        if handle.history_offset > len(self.history):
+            raise Exception(f"invalid session handle: {handle}")
+        self.state_id, self.history_offset = handle.state_id, handle.history_offset
+
+    def dumps(self) -> bytes:
+        """履歴を含めて、別のプロセスの同じ SharedAutomaton で loads できる形式にする"""
+        header = self._DUMP_HEADER.pack(self._DUMP_MAGIC, self._DUMP_VERSION, self.automaton.fingerprint,
+                                         self.state_id, self.history_offset, self.epoch)
+        history = self.history[:self.history_offset]
+        if sys.byteorder == "big":
+            history.byteswap()
+        return header + history.tobytes()
+
+    @classmethod
+    def loads(cls, automaton: SharedAutomaton, data: bytes) -> Session:
+        """dumps() の値からセッションを作る
+
+        上書きの記録は引き継がないので、epoch が dumps したときより前の snapshot は restore できない
+        """
+        magic, version, fingerprint, state_id, history_offset, epoch = cls._DUMP_HEADER.unpack_from(data)
+        if magic != cls._DUMP_MAGIC or version != cls._DUMP_VERSION:
+            raise Exception("invalid session data")
+        if fingerprint != automaton.fingerprint:
+            raise Exception("session data is for another automaton")
+        history = array("I")
+        history.frombytes(data[cls._DUMP_HEADER.size:])
+        if sys.byteorder == "big":
+            history.byteswap()
+        if len(history) != history_offset or state_id >= len(automaton.transitions) \
+                or any(i >= len(automaton.entries) for i in history):
+            raise Exception("invalid session data")
+        session = cls(automaton)
+        for e in history:
+            session.__append(e)
+        session.state_id = state_id
+        session.epoch = session.oldest_epoch = epoch
+        return session
+
+    @property
+    def passed_entries(self) -> Tuple[Entry, ...]:
+        entries = self.automaton.entries
+        return tuple(entries[i] for i in self.history[:self.history_offset])
+
+    def __strings(self) -> Tuple[str, str]:
+        """(入力完了した Entry の inputted, outputted) を返す
+
+        前回からの差分だけを連結し、restore で戻った場合は前回の文字列を切り詰める
+        """
+        length = self.history_offset
+        count, inputted, outputted = self._cache
+        if length == count:
+            return inputted, outputted
+        if length > count:
+            inputted += "".join(self._input_pieces[count:length])
+            outputted += "".join(self._outputs[count:length])
+        else:
+            inputted = inputted[:self.__inputted_length(length)]
+            outputted = outputted[:self.__outputted_length(length)]
+        self._cache = (length, inputted, outputted)
+        return inputted, outputted
+
+    @property
+    def inputted(self) -> str:
+        inputted = self.__strings()[0]
+        pending = self.automaton.pending_inputs[self.state_id]
+        if not pending:
+            return inputted
+        next = len(self.automaton.entries[self.history[self.history_offset - 1]].next) if self.history_offset else 0
+        return inputted + pending[next:]
+
+    @property
+    def outputted(self) -> str:
+        return self.__strings()[1]
+
+    def inputtable(self):
+        return self.automaton.inputtables[self.state_id]
+
+
+class SessionManager:
+    """問題ごとの SharedAutomaton と、それを使うセッションを ID で管理する
+
+    同じ問題（と配列）のセッションはすべて 1 つの SharedAutomaton を参照する。
+    asyncio のサーバーで 1 つのイベントループから使うことを想定している（スレッドセーフではない）
+    """
+
+    def __init__(self):
+        # (問題 ID, 配列の名前) -> SharedAutomaton。配列の名前が None のものはすべての配列で入力できる
+        self.automata: Dict[Tuple[str, Optional[str]], SharedAutomaton] = {}
+        # 配列ごとの SharedAutomaton を作るための、問題 ID ごとの MergedAutomaton
+        self.merged: Dict[str, MergedAutomaton] = {}
+        self.sessions: Dict[str, Tuple[str, Optional[str], Session]] = {}
+
+    def register(self, question_id: str, automaton: Automaton):
+        """問題を登録する
+
+        automaton が MergedAutomaton の場合は、open で配列を指定したときにその配列用の遷移表を作る
+        """
+        self.automata[(question_id, None)] = SharedAutomaton.from_automaton(automaton, ALL_LAYOUTS)
+        if isinstance(automaton, MergedAutomaton):
+            self.merged[question_id] = automaton
+
+    def register_shared(self, question_id: str, automaton: SharedAutomaton):
+        """作成済みの SharedAutomaton で問題を登録する（別のスレッドなどで作ったもの）"""
+        self.automata[(question_id, None)] = automaton
+
+    def shared(self, question_id: str, layout: Optional[str] = None) -> SharedAutomaton:
+        key = (question_id, layout)
+        automaton = self.automata.get(key)
+        if automaton is None:
+            if question_id not in self.merged:
+                raise Exception(f"question {question_id} does not have layouts")
+            merged = self.merged[question_id]
+            automaton = self.automata[key] = SharedAutomaton.from_automaton(merged, merged.layout_mask(layout))
+        return automaton
+
+    def open(self, session_id: str, question_id: str, layout: Optional[str] = None) -> Session:
+        """セッションを作る（layout を指定した場合はその配列だけで入力できる）"""
+        session = Session(self.shared(question_id, layout))
+        self.sessions[session_id] = (question_id, layout, session)
+        return session
+
+    def get(self, session_id: str) -> Session:
+        return self.sessions[session_id][2]
+
+    def close(self, session_id: str):
+        self.sessions.pop(session_id, None)
+
+    def snapshot(self, session_id: str) -> bytes:
+        return self.get(session_id).snapshot()
+
+    def restore(self, session_id: str, data: bytes):
+        self.get(session_id).restore(data)
+
+    def dumps(self, session_id: str) -> bytes:
+        question_id, layout, session = self.sessions[session_id]
+        q = question_id.encode("utf-8")
+        # 配列の指定がない場合は長さを 0xFFFF にする
+        l = layout.encode("utf-8") if layout is not None else b""
+        return (struct.pack("<H", len(q)) + q + struct.pack("<H", len(l) if layout is not None else 0xFFFF) + l
+                + session.dumps())
+
+    def loads(self, session_id: str, data: bytes) -> Session:
+        """dumps() の値から、この SessionManager にセッションを作る（問題は register 済みであること）"""
+        (length,) = struct.unpack_from("<H", data)
+        question_id = data[2:2+length].decode("utf-8")
+        offset = 2 + length
+        (length,) = struct.unpack_from("<H", data, offset)
+        offset += 2
+        layout = None
+        if length != 0xFFFF:
+            layout = data[offset:offset+length].decode("utf-8")
+            offset += length
+        session = Session.loads(self.shared(question_id, layout), data[offset:])
+        self.sessions[session_id] = (question_id, layout, session)
+        return session
@@ -1,4 +1,5 @@
 # coding: utf-8
+from typing import Any, Callable, Sequence
 
 
 def split_suffixes(text: str, max_length: int):
@@ -13,3 +14,105 @@ def split_prefixes(text: str, max_length: int):
         return []
     max_length = min(max_length, len(text))
     return [text[:i+1] for i in range(max_length)]
+
+
+class Trie:
+    """文字列のキーを 1 文字ずつたどるための木
+
+    各ノードは {文字: 子ノード} の dict で、キーに対応する値はノードの VALUE に持つ。
+    たどる側はノードの dict を直接使うことで、部分文字列を作らずに接頭辞を順に調べられる
+    """
+    __slots__ = ("root",)
+    # 値を持つキー（1 文字の文字列とは衝突しない）
+    VALUE = ""
+
+    def __init__(self):
+        self.root: dict = {}
+
+    def insert(self, key: str, value):
+        node = self.root
+        for c in key:
+            child = node.get(c)
+            if child is None:
+                child = node[c] = {}
+            node = child
+        node[Trie.VALUE] = value
+
+    def node(self, key: str):
+        """key に対応するノードを返す（なければ None）"""
+        node = self.root
+        for c in key:
+            node = node.get(c)
+            if node is None:
+                return None
+        return node
+
+    def get(self, key: str, default=None):
+        node = self.node(key)
+        if node is None:
+            return default
+        return node.get(Trie.VALUE, default)
+
+    def has_extension(self, key: str, text: str) -> bool:
+        """key + (text の 1 文字以上の接頭辞のいずれか) が値を持つかどうか"""
+        node = self.node(key)
+        if node is None:
+            return False
+        for c in text:
+            node = node.get(c)
+            if node is None:
+                return False
+            if Trie.VALUE in node:
+                return True
+        return False
+
+    def remove(self, key: str):
+        """key の値を削除し、値も子も持たなくなったノードを取り除く"""
+        path = []
+        node = self.root
+        for c in key:
+            path.append((node, c))
+            node = node.get(c)
+            if node is None:
+                return
+        node.pop(Trie.VALUE, None)
+        for parent, c in reversed(path):
+            if parent[c]:
+                break
+            del parent[c]
+
+    def values(self, prefix: str = ""):
+        """prefix で始まる（prefix 自身を含む）キーの値を返す"""
+        node = self.node(prefix)
+        if node is None:
+            return
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for c, child in node.items():
+                if c == Trie.VALUE:
+                    yield child
+                else:
+                    stack.append(child)
+
+    def dump(self, index: Callable[[Any], int]) -> dict:
+        """値を index(値) に置き換えた、marshal で保存できる dict を返す（load で元に戻す）"""
+        def dump_node(node: dict) -> dict:
+            return {c: index(child) if c == Trie.VALUE else dump_node(child) for c, child in node.items()}
+        return dump_node(self.root)
+
+    @staticmethod
+    def load(root: dict, values: Sequence) -> "Trie":
+        """dump の結果から、値を values[値] に戻した Trie を作る（root のノードをそのまま使う）"""
+        value = Trie.VALUE
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            for c, child in node.items():
+                if c == value:
+                    node[c] = values[child]
+                else:
+                    stack.append(child)
+        trie = Trie()
+        trie.root = root
+        return trie
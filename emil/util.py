@@ -0,0 +1,92 @@
+# coding: utf-8
+from __future__ import annotations
+from typing import Optional, Any, Callable, Iterable, Iterator, List, Tuple, TypeVar
+from concurrent.futures import ProcessPoolExecutor
+import collections
+import dataclasses
+import itertools
+import multiprocessing
+
+S = TypeVar("S")
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def slotted(cls):
+    """dataclass に __slots__ を追加したクラスを作り直して返す（Python 3.10 以降の dataclass(slots=True) 相当）
+
+    インスタンスごとの __dict__ を持たなくなるので、大量に作るクラスのメモリ使用量が減る
+    init=False のフィールドには default_factory を指定すること（default はクラス変数になるため使えない）
+    """
+    names = tuple(f.name for f in dataclasses.fields(cls) if f.name not in getattr(cls, "__slots__", ()))
+    # 基底クラスで定義済みのフィールドは基底クラスの slot を使う
+    for base in cls.__mro__[1:]:
+        names = tuple(n for n in names if n not in getattr(base, "__slots__", ()))
+    cls_dict = dict(cls.__dict__)
+    cls_dict["__slots__"] = names
+    for name in names:
+        cls_dict.pop(name, None)
+    cls_dict.pop("__dict__", None)
+    cls_dict.pop("__weakref__", None)
+    return type(cls)(cls.__name__, cls.__bases__, cls_dict)
+
+
+# pool_map のワーカーで 1 度だけ作る状態
+_worker_state: Any = None
+
+
+def _init_worker(make_state: Callable[..., Any], state_args: Tuple):
+    global _worker_state
+    _worker_state = make_state(*state_args)
+
+
+def _run_chunk(fn: Callable[[Any, Any], Any], chunk: List[Any]) -> List[Any]:
+    return [fn(_worker_state, item) for item in chunk]
+
+
+def run_in_worker(fn: Callable[[Any, T], R], item: T) -> R:
+    """worker_executor で作ったプロセスプールで fn(state, item) を実行する（executor.submit に渡す）"""
+    return fn(_worker_state, item)
+
+
+def worker_executor(make_state: Callable[..., Any], state_args: Tuple,
+                    max_workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """各ワーカーで make_state(*state_args) を 1 度だけ作る ProcessPoolExecutor を返す
+
+    pool_map と同じく、タスクごとに state を pickle して送らずに済む。run_in_worker と組み合わせて使う
+    """
+    return ProcessPoolExecutor(max_workers, initializer=_init_worker, initargs=(make_state, state_args))
+
+
+def _chunks(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    it = iter(items)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def pool_map(make_state: Callable[..., S], state_args: Tuple, fn: Callable[[S, T], R], items: Iterable[T],
+             processes: Optional[int] = None, chunksize: int = 64) -> Iterator[R]:
+    """items の各要素に fn(state, item) を適用した結果を、items の順に返す
+
+    state は make_state(*state_args) で作る。processes が 1 の場合は現在のプロセスで 1 度だけ作って処理し、
+    それ以外はプロセスプールの各ワーカーで 1 度だけ作る（processes が None のときは CPU 数）。
+    items は chunksize 個ずつ同じワーカーで続けて処理し、処理待ちのチャンクはワーカー数の 4 倍までしか読み込まない。
+    make_state と fn はモジュールの関数（pickle できるもの）であること
+    """
+    if processes == 1:
+        state = make_state(*state_args)
+        for item in items:
+            yield fn(state, item)
+        return
+    processes = processes or multiprocessing.cpu_count()
+    with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(make_state, state_args)) as pool:
+        pending: collections.deque = collections.deque()
+        for chunk in _chunks(items, chunksize):
+            pending.append(pool.apply_async(_run_chunk, (fn, chunk)))
+            if len(pending) >= processes * 4:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
@@ -1,6 +1,7 @@
 # coding: utf-8
 from __future__ import annotations
-from typing import Optional, List, Dict, Set
+from typing import Optional, List, Dict, Set, Tuple, TextIO
+import io
 from .automaton import Automaton, Node, Edge
 
 
@@ -8,41 +9,76 @@ from .automaton import Automaton, Node, Edge
 """
 
 
+def walk(start: Node) -> List[Tuple[Node, int]]:
+    """start から到達可能な Node を 1 度ずつ、(Node, start からの表示文字列の長さ) の組で返す
+    """
+    visited = {id(start)}
+    result = [(start, 0)]
+    worklist = [(start, 0)]
+    while worklist:
+        node, position = worklist.pop()
+        for e in node.next_edges:
+            if id(e.next) in visited:
+                continue
+            visited.add(id(e.next))
+            next_position = position + sum(len(et.output) for et in e.entries)
+            result.append((e.next, next_position))
+            worklist.append((e.next, next_position))
+    return result
+
+
 def trace(previous: Node, output_stack: str, nodes: Dict[int, str], edges: Dict[int, Edge]):
-    if id(previous) not in nodes:
-        nodes[id(previous)] = f"n{len(output_stack)}"
-    for e in previous.next_edges:
-        if id(e) not in edges:
-            edges[id(e)] = e
-        trace(e.next, output_stack + "".join(et.output for et in e.entries), nodes, edges)
+    # 訪問済みの Node はたどらないので、Node と Edge の数に比例する時間で終わる
+    for node, position in walk(previous):
+        nodes.setdefault(id(node), f"n{len(output_stack) + position}")
+        for e in node.next_edges:
+            edges.setdefault(id(e), e)
+
+
+def quote(s: str) -> str:
+    return '"' + s.replace("\\", "\\\\").replace('"', '\\"') + '"'
 
 
 def str_edge(e: Edge) -> str:
-    s = " | ".join(f"{entry.input}/{entry.output}/{entry.next}" for entry in e.entries)
-    s = s.replace('"', '\"')
-    return '"' + s + '"'
-
-
-def render(auto: Automaton) -> str:
-    nodes = {}
-    edges = {}
-    trace(auto._start_node, "", nodes, edges)
-    nl = "\n"
-    return f"""digraph graph_name {{
-  graph [
-    ranksep = 1.0
-  ];
-
-  //node define
-  {
-      (";"+nl+"  ").join(n for n in nodes.values()) + ";"
-  }
-
-  // edge define
-  {
-      (";"+nl+"  ").join(nodes[id(e.previous)] + " -> " + nodes[id(e.next)] + " [" + nl +
-        "    label = " + str_edge(e) + nl +
-        "  ]"
-        for e in edges.values()) + ";"
-  }
-}}"""
+    return quote(" | ".join(f"{entry.input}/{entry.output}/{entry.next}" for entry in e.entries))
+
+
+def render_to(auto: Automaton, f: TextIO, collapse: bool = False):
+    """graphviz の dot 形式で f に少しずつ書き出す
+
+    collapse が True の場合は、同じ Node の間にある Edge をまとめて 1 本にし、ラベルを改行で区切って並べる
+    """
+    nodes = [(n, f"n{position}") for n, position in walk(auto._start_node)]
+    names = {id(n): name for n, name in nodes}
+    f.write("digraph graph_name {\n"
+            "  graph [\n"
+            "    ranksep = 1.0\n"
+            "  ];\n"
+            "\n"
+            "  //node define\n")
+    for _, name in nodes:
+        f.write(f"  {name};\n")
+    f.write("\n"
+            "  // edge define\n")
+    for node, name in nodes:
+        if collapse:
+            grouped: Dict[int, List[Edge]] = {}
+            for e in node.next_edges:
+                grouped.setdefault(id(e.next), []).append(e)
+            for edges in grouped.values():
+                label = "\\n".join(str_edge(e)[1:-1] for e in edges)
+                f.write(f"  {name} -> {names[id(edges[0].next)]} [\n"
+                        f"    label = \"{label}\"\n"
+                        "  ];\n")
+        else:
+            for e in node.next_edges:
+                f.write(f"  {name} -> {names[id(e.next)]} [\n"
+                        f"    label = {str_edge(e)}\n"
+                        "  ];\n")
+    f.write("}")
+
+
+def render(auto: Automaton, collapse: bool = False) -> str:
+    buf = io.StringIO()
+    render_to(auto, buf, collapse)
+    return buf.getvalue()
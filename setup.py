@@ -14,5 +14,9 @@ setup(
     # ユーザーが指定した場合にインストールされる外部パッケージ.
     extras_require={},
     # コマンドが実行されたときのエントリーポイント.
-    entry_points={}
+    entry_points={
+        "console_scripts": [
+            "emil-compile = emil.cli:main",
+        ],
+    }
 )
@@ -0,0 +1,47 @@
+# coding: utf-8
+from __future__ import annotations
+import random
+from typing import Dict, Iterator, Optional
+import pytest
+from emil import data
+from emil.rule import Rule
+from emil.automaton import Automaton
+
+# 配列名と変換表のファイル名
+LAYOUTS = {"roman": "google_ime_default_roman_table.txt", "azik": "google_ime_tomoemon_azik.txt"}
+TABLES = list(LAYOUTS.values())
+
+
+@pytest.fixture(scope="session")
+def layouts() -> Dict[str, Rule]:
+    """配列名ごとの Rule。テストの間で共有するので、Rule を書き換えるテストは自分で Rule を作ること"""
+    return {name: Rule.from_file(data.filepath(table), data.DIRECT_INPUTTABLE) for name, table in LAYOUTS.items()}
+
+
+@pytest.fixture(params=list(LAYOUTS))
+def rule(request, layouts: Dict[str, Rule]) -> Rule:
+    """すべての配列で実行する"""
+    return layouts[request.param]
+
+
+@pytest.fixture(scope="session")
+def roman_rule(layouts: Dict[str, Rule]) -> Rule:
+    return layouts["roman"]
+
+
+def walk(auto: Automaton, rnd: Optional[random.Random] = None,
+         miss_keys: str = "qx-", miss_rate: float = 0.1) -> Iterator[str]:
+    """auto が入力を受け付けなくなるまで、次に入力する文字を 1 文字ずつ返す。
+    返した文字を auto に入力するのは呼び出し側で、入力してから次の文字を取り出す。
+
+    rnd を渡さなければガイドの入力文字列を先頭から返す。
+    渡すと入力できる文字から選び、miss_rate の割合で miss_keys の文字（入力できないことがある）を混ぜる。
+    """
+    if rnd is None:
+        yield from auto.tail_input_str()
+        return
+    while True:
+        inputtable = sorted(auto.inputtable())
+        if not inputtable:
+            return
+        yield rnd.choice(miss_keys) if rnd.random() < miss_rate else rnd.choice(inputtable)
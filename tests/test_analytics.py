@@ -0,0 +1,56 @@
+# coding: utf-8
+from __future__ import annotations
+import random
+from typing import List
+import pytest
+from emil.rule import Rule
+from emil.automaton import State
+from emil.builder import build_automaton
+from emil.analytics import KeystrokeAnalysis, analyze_many
+
+WORDS = ["かな", "きって", "しんぶん", "ちょっと", "がっこう", "てぃっしゅ", "ん"]
+
+
+def enumerate_keys(state: State, keys: str = "") -> List[str]:
+    """state から最後まで入力できるキー列をすべて並べる"""
+    if not state.available_edges:
+        return [keys]
+    found = []
+    for c in sorted(state.inputtable):
+        result = state.test(c)
+        if result.succeeded:
+            found.extend(enumerate_keys(result.new_state, keys + c))
+    return found
+
+
+@pytest.mark.parametrize("word", WORDS)
+def test_matches_enumeration(rule: Rule, word: str):
+    auto = build_automaton(rule, word)
+    expected = enumerate_keys(auto._state)
+    assert len(set(expected)) == len(expected) > 0
+    lengths = [len(keys) for keys in expected]
+    analysis = KeystrokeAnalysis(auto)
+    assert analysis.count == len(expected)
+    assert analysis.min_keystrokes == min(lengths)
+    assert analysis.max_keystrokes == max(lengths)
+    assert analysis.mean_keystrokes == pytest.approx(sum(lengths) / len(lengths))
+
+
+@pytest.mark.parametrize("word", WORDS)
+def test_samples_are_accepted(rule: Rule, word: str):
+    expected = set(enumerate_keys(build_automaton(rule, word)._state))
+    analysis = KeystrokeAnalysis(build_automaton(rule, word).compile())
+    rnd = random.Random(0)
+    for _ in range(50):
+        keys = analysis.sample(rnd)
+        assert keys in expected
+        auto = build_automaton(rule, word)
+        for key in keys:
+            assert auto.input(key).succeeded
+        assert not auto._state.available_edges
+
+
+def test_analyze_many_is_deterministic(rule: Rule):
+    single = analyze_many(rule, WORDS, samples=5, seed=1, processes=1)
+    assert [s.text for s in single] == WORDS
+    assert analyze_many(rule, WORDS, samples=5, seed=1, processes=2, chunksize=2) == single
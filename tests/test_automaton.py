@@ -0,0 +1,75 @@
+# coding: utf-8
+from __future__ import annotations
+import random
+import pytest
+from emil.rule import Rule
+from emil.builder import build_automaton
+from conftest import walk
+
+TEXTS = ["きょうはいいてんきですね、しんぶんをよみにがっこうへいきました。", "ちょっとまって", "っっか", "こんにちは"]
+
+
+def assert_same_result(expected, result):
+    assert result.succeeded == expected.succeeded
+    assert result.passed_entries == expected.passed_entries
+    for attr in ("inputted", "outputted", "inputtable", "passed_entries"):
+        assert getattr(result.new_state, attr) == getattr(expected.new_state, attr), attr
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_compiled_matches_automaton(rule: Rule, seed: int):
+    rnd = random.Random(seed)
+    for text in TEXTS:
+        auto = build_automaton(rule, text)
+        compiled = auto.compile()
+        for key in walk(auto, rnd, "qx-;"):
+            assert compiled.inputtable() == auto.inputtable()
+            assert (compiled.inputted, compiled.outputted) == (auto.inputted, auto.outputted)
+            inputtable = sorted(auto.inputtable())
+            # 入力できる文字から 2 〜 3 文字の入力を作り、test で比べる（transit で遷移表にない状態を作る）
+            keys = "".join(rnd.choice(inputtable) for _ in range(rnd.randint(2, 3)))
+            assert_same_result(auto.test(keys), compiled.test(keys))
+            assert_same_result(auto.input(key), compiled.input(key))
+        assert not compiled.inputtable()
+        assert compiled.tail_input_str() == auto.tail_input_str() == ""
+
+
+def test_multi_character_test(rule: Rule):
+    auto = build_automaton(rule, "きょうはいいてんき")
+    compiled = auto.compile()
+    keys = auto.tail_input_str()
+    for i in range(len(keys)):
+        for j in range(i + 1, len(keys) + 1):
+            assert_same_result(auto.test(keys[i:j]), compiled.test(keys[i:j]))
+        assert_same_result(auto.input(keys[i]), compiled.input(keys[i]))
+    # 2 文字以上の入力で transit が作った状態は、1 文字ずつ入力した場合と同じ状態 ID になる
+    compiled.reset()
+    multi = compiled.test(keys[:3]).new_state
+    for key in keys[:3]:
+        compiled.input(key)
+    assert multi.id == compiled._state.id
+
+
+@pytest.mark.parametrize("text", ["てんき", "しんぶん", "きって", "ちょっと", "こんにちは"])
+def test_strings_on_every_key_sequence(rule: Rule, text: str):
+    # 「n」で「n/ん, ki/き」と「nn/ん」の両方の Edge が残る場合も、どちらで入力を続けても
+    # outputted と inputted が食い違わない（Edge の並び順によらない）
+    auto = build_automaton(rule, text)
+    stack = [(auto._state, "")]
+    finished = 0
+    while stack:
+        state, keys = stack.pop()
+        assert state.inputted == keys
+        assert text.startswith(state.outputted)
+        assert "".join(e.output for e in state.passed_entries) == state.outputted
+        auto._state = state
+        assert state.outputted + auto.tail_print_str() == text
+        if not state.available_edges:
+            assert state.outputted == text
+            finished += 1
+        for c in sorted(state.inputtable):
+            result = state.test(c)
+            assert result.succeeded
+            assert result.new_state.passed_entries == state.passed_entries + result.passed_entries
+            stack.append((result.new_state, keys + c))
+    assert finished > 1
@@ -0,0 +1,46 @@
+# coding: utf-8
+from __future__ import annotations
+from emil import data, export
+from emil.rule import Rule, Entry
+from emil.builder import build_automaton
+from emil.bank import BankBuilder, build_bank
+
+# 末尾が同じ出題文を含む
+TEXTS = ["きょうはいいてんきですね", "こんにちは", "あしたもいいてんきですね", "いいてんきですね", "しんぶんをよんだ",
+         "ちょっとまって", "こんばんは"]
+
+
+def test_results_match_build_automaton(roman_rule: Rule):
+    results, stats = build_bank(roman_rule, TEXTS, processes=1)
+    # 末尾から比べた順に作るが、入力の順に返す
+    assert [r.text for r in results] == TEXTS
+    for text, result in zip(TEXTS, results):
+        assert result.error is None
+        assert result.automaton == export.dumps(build_automaton(roman_rule, text))
+    assert (stats.texts, stats.failed) == (len(TEXTS), 0)
+    assert stats.shared_memo_hits > 0
+    assert 0.0 < stats.saved_ratio < 1.0
+
+
+def test_unbuildable_text(roman_rule: Rule):
+    texts = ["こんにちは", "漢字", "かな"]
+    results, stats = build_bank(roman_rule, texts, processes=2, chunksize=1)
+    assert [r.text for r in results] == texts
+    assert results[1].automaton is None and results[1].error
+    assert results[0].error is None and results[2].error is None
+    assert (stats.texts, stats.failed) == (3, 1)
+
+
+def test_memo_is_cleared_on_rule_update():
+    rule = Rule.from_file(data.filepath("google_ime_default_roman_table.txt"), data.DIRECT_INPUTTABLE)
+    builder = BankBuilder(rule)
+    for text in TEXTS:
+        builder.build(text)
+    assert builder.memo
+    rule.add_entry(Entry("qqj", "て", ""))
+    # 古いメモを使うと「て」の新しい入力方法が入らない
+    assert export.dumps(builder.build("いいてんきですね")) == \
+        export.dumps(build_automaton(rule, "いいてんきですね"))
+    fresh = BankBuilder(rule)
+    fresh.build("いいてんきですね")
+    assert builder.memo.keys() == fresh.memo.keys()
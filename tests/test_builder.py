@@ -0,0 +1,169 @@
+# coding: utf-8
+from __future__ import annotations
+import time
+from typing import Dict
+import pytest
+from emil import builder, export
+from emil.rule import Rule
+from emil.automaton import ALL_LAYOUTS, Automaton
+from emil.builder import BuildStats, build_automaton, build_merged_automaton, is_safe_boundary, split_segments, concat_automata
+from emil.emil import Emil, CacheInfo
+from conftest import walk
+
+SENTENCE = "きょうはいいてんきですね、しんぶんをよみにがっこうへいきました。ちょっとまって。"
+
+
+def type_all(auto: Automaton):
+    """ガイドの入力文字列を最後まで入力する"""
+    assert auto.inputtable()
+    for i, key in enumerate(walk(auto)):
+        assert auto.input(key).succeeded, f"{key!r} at {i} is not accepted"
+    assert auto.tail_input_str() == ""
+    assert not auto.inputtable()
+
+
+def test_long_text(rule: Rule):
+    # 再帰せずに作るので、10 万文字以上でも RecursionError にならない
+    text = SENTENCE * (100000 // len(SENTENCE) + 1)
+    assert len(text) >= 100000
+    type_all(build_automaton(rule, text))
+
+
+@pytest.mark.parametrize("text", ["っ" * 80 + "か", "ん" * 200 + "か", "っ" * 40 + "ん" * 40 + "な"])
+def test_long_runs(rule: Rule, text: str):
+    # 「っ」が連なると EntryNode の child も長く連なる。比較やハッシュ値の計算で連なりを毎回たどると
+    # 数十秒かかる（現在は 1 秒未満）
+    started = time.perf_counter()
+    auto = build_automaton(rule, text)
+    assert time.perf_counter() - started < 5.0
+    type_all(auto)
+
+
+def edge_set(auto: Automaton, layouts: int = ALL_LAYOUTS):
+    """(表示文字列の開始位置, 終了位置, Entry の列) の集合（layouts の配列で使える Edge だけ）"""
+    edges = set()
+    worklist = [(auto._start_node, 0)]
+    visited = {id(auto._start_node)}
+    while worklist:
+        node, position = worklist.pop()
+        for e in node.next_edges:
+            if not e.layouts & layouts:
+                continue
+            next_position = position + sum(len(entry.output) for entry in e.entries)
+            edges.add((position, next_position, tuple((x.input, x.output, x.next) for x in e.entries)))
+            if id(e.next) not in visited:
+                visited.add(id(e.next))
+                worklist.append((e.next, next_position))
+    return edges
+
+
+@pytest.mark.parametrize("text", [SENTENCE, "こんにちは", "っ" * 5 + "か", "しんぶんをよんだ"])
+def test_merged_layouts_match_standalone(layouts: Dict[str, Rule], text: str):
+    merged = build_merged_automaton(layouts, text)
+    for name, rule in layouts.items():
+        assert edge_set(merged, merged.layout_mask(name)) == edge_set(build_automaton(rule, text))
+        merged.select_layouts(name)
+        type_all(merged)
+
+
+def test_merged_skips_untypeable_layout(layouts: Dict[str, Rule]):
+    text = "ゔぁいおりん"
+    with pytest.raises(Exception):
+        build_automaton(layouts["azik"], text)
+    merged = build_merged_automaton(layouts, text)
+    assert edge_set(merged) == edge_set(merged, merged.layout_mask("roman")) \
+        == edge_set(build_automaton(layouts["roman"], text))
+    with pytest.raises(Exception, match="cannot input"):
+        merged.select_layouts("azik")
+    merged.select_layouts("roman")
+    type_all(merged)
+
+    flat = export.loads(export.dumps(merged))
+    with pytest.raises(Exception, match="cannot input"):
+        flat.select_layouts("azik")
+    flat.select_layouts("roman")
+
+    with pytest.raises(Exception):
+        build_merged_automaton({"azik": layouts["azik"]}, text)
+
+
+BOUNDARY_TEXTS = ["かんあ", "しんや", "ほんとうに", "さんぽ", "きって", "がっこう", "ちょっと", "かっ", "んんな",
+                  "ったった", "てぃっしゅ", "ゔぁんって", "きょうはいいてんきですね、しんぶんをよみにがっこうへいきました。"]
+
+
+@pytest.mark.parametrize("text", BOUNDARY_TEXTS)
+def test_safe_boundaries(rule: Rule, text: str):
+    try:
+        expected = edge_set(build_automaton(rule, text))
+    except Exception:
+        pytest.skip("the table cannot input the text")
+    for position in range(1, len(text)):
+        if is_safe_boundary(rule, text, position):
+            halves = [build_automaton(rule, text[:position]), build_automaton(rule, text[position:])]
+            assert edge_set(concat_automata(halves)) == expected, position
+    assert edge_set(Emil(rule).build(text)) == expected
+
+
+def test_emil_cache(rule: Rule):
+    text = "ほんとうにいってきます"
+    segments = split_segments(rule, text)
+    assert len(segments) > 2 and "".join(segments) == text
+    expected = edge_set(build_automaton(rule, text))
+    emil = Emil(rule)
+    assert edge_set(emil.build(text)) == expected
+    assert emil.cache_info() == CacheInfo(0, len(set(segments)), emil.cache_size, len(set(segments)))
+    assert edge_set(emil.build(text)) == expected
+    assert emil.cache_info().hits == len(segments)
+    emil.cache_clear()
+    assert emil.cache_info() == CacheInfo(0, 0, emil.cache_size, 0)
+    # 上限を超えた区間は古いものから捨てる
+    emil = Emil(rule, cache_size=1)
+    assert edge_set(emil.build(text)) == expected
+    assert emil.cache_info().currsize == 1
+
+
+def count_graph(auto: Automaton):
+    """(Node の数, Edge の数)"""
+    nodes, edges = 0, 0
+    worklist = [auto._start_node]
+    visited = {id(auto._start_node)}
+    while worklist:
+        node = worklist.pop()
+        nodes += 1
+        edges += len(node.next_edges)
+        for e in node.next_edges:
+            if id(e.next) not in visited:
+                visited.add(id(e.next))
+                worklist.append(e.next)
+    return nodes, edges
+
+
+def test_build_stats(rule: Rule, monkeypatch):
+    text = "きょうはいいてんきですね、いいてんきですね"
+    stats = BuildStats()
+    auto = build_automaton(rule, text, stats)
+    assert (stats.nodes, stats.edges) == count_graph(auto)
+    assert stats.search_parents_calls > 0 and stats.search_parents_memo_hits > 0
+    assert stats.shared_memo_hits == 0
+    assert stats.suffix_lookups > 0 and stats.entry_nodes > 0
+    assert stats.max_dependency_paths > 0 and stats.dependency_paths >= stats.edges
+    assert stats.total_time > 0.0
+    assert stats.index_time + stats.node_time == pytest.approx(stats.total_time)
+
+    # build_callback を設定すると stats を渡さなくても集計して渡す
+    calls = []
+    monkeypatch.setattr(builder, "build_callback", lambda t, s: calls.append((t, s)))
+    build_automaton(rule, text)
+    (called_text, called_stats), = calls
+    assert called_text == text
+    assert (called_stats.nodes, called_stats.search_parents_calls) == (stats.nodes, stats.search_parents_calls)
+    calls.clear()
+    build_automaton(rule, text, stats)
+    assert calls == [(text, stats)]
+
+    # どちらもなければ BuildStats を作らない
+    def fail():
+        raise AssertionError("BuildStats is created")
+    monkeypatch.setattr(builder, "build_callback", None)
+    monkeypatch.setattr(builder, "BuildStats", fail)
+    build_automaton(rule, text)
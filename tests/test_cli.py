@@ -0,0 +1,68 @@
+# coding: utf-8
+from __future__ import annotations
+import base64
+import io
+import json
+import pytest
+from emil import export
+from emil.rule import Rule
+from emil.builder import build_automaton
+from emil.cli import read_items, main
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("EMIL_CACHE_DIR", str(tmp_path / "cache"))
+
+
+def test_read_items_lines():
+    items = list(read_items(io.StringIO("こんにちは\n\n  \nかな\r\n")))
+    assert items == [("1", "こんにちは", None), ("4", "かな", None)]
+
+
+def test_read_items_jsonl():
+    lines = [
+        '{"id": "a", "text": "こんにちは"}',
+        '{"text": "かな"}',
+        '{"id": 7, "sentence": "かな"}',
+        '{"id": "b", "text": 1}',
+        '["かな"]',
+        '{"text": ',
+    ]
+    items = list(read_items(io.StringIO("\n".join(lines)), jsonl=True))
+    assert items[:2] == [("a", "こんにちは", None), ("2", "かな", None)]
+    assert items[2] == ("7", lines[2], "text is missing")
+    assert items[3] == ("b", lines[3], "text is not a string")
+    assert items[4] == ("5", lines[4], "not a JSON object")
+    id, text, error = items[5]
+    assert (id, text) == ("6", lines[5]) and error.startswith("invalid JSON")
+    # text_field と id_field を変えた場合
+    items = list(read_items(io.StringIO(lines[2]), jsonl=True, text_field="sentence", id_field="key"))
+    assert items == [("1", "かな", None)]
+
+
+def test_main(tmp_path, roman_rule: Rule):
+    source = tmp_path / "words.jsonl"
+    source.write_text("\n".join(json.dumps(obj, ensure_ascii=False) for obj in [
+        {"id": "a", "text": "こんにちは"},
+        {"id": "b", "text": "かな"},
+    ]) + "\n", encoding="utf-8")
+    output, errors = tmp_path / "out.jsonl", tmp_path / "errors.jsonl"
+    args = [str(source), "--rule", "google_ime_default_roman_table.txt", "--jsonl", "-j", "1",
+            "-o", str(output), "-e", str(errors)]
+    assert main(args) == 0
+    records = [json.loads(line) for line in output.read_text(encoding="utf-8").splitlines()]
+    assert [(r["id"], r["text"]) for r in records] == [("a", "こんにちは"), ("b", "かな")]
+    for r in records:
+        assert base64.b64decode(r["automaton"]) == export.dumps(build_automaton(roman_rule, r["text"]))
+    assert errors.read_text(encoding="utf-8") == ""
+    assert list((tmp_path / "cache").glob("*.rule"))
+
+    # 作れない出題文と読めない行が 1 つでもあれば終了コードは 1
+    with open(source, "a", encoding="utf-8") as f:
+        f.write('{"id": "c", "text": "漢字"}\n{"id": \n')
+    assert main(args) == 1
+    assert [json.loads(line)["id"] for line in output.read_text(encoding="utf-8").splitlines()] == ["a", "b"]
+    failed = [json.loads(line) for line in errors.read_text(encoding="utf-8").splitlines()]
+    assert [r["id"] for r in failed] == ["c", "4"]
+    assert all(r["error"] for r in failed)
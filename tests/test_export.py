@@ -0,0 +1,77 @@
+# coding: utf-8
+from __future__ import annotations
+import random
+import pytest
+from emil import export
+from emil.automaton import Automaton
+from emil.builder import build_automaton, build_merged_automaton
+from conftest import walk
+
+TEXTS = ["きょうはいいてんきですね、しんぶんをよみにがっこうへいきました。", "ちょっとまって", "っっか"]
+
+
+def type_randomly(auto: Automaton, flat: export.FlatAutomaton, rnd: random.Random):
+    for key in walk(auto, rnd):
+        assert flat.inputtable() == auto.inputtable()
+        assert not flat.finished
+        inputtable = sorted(auto.inputtable())
+        keys = "".join(rnd.choice(inputtable) for _ in range(2))
+        assert flat.test(keys) == auto.test(keys).succeeded
+        assert flat.input(key) == auto.input(key).succeeded
+        assert (flat.inputted, flat.outputted) == (auto.inputted, auto.outputted)
+        assert tuple(flat.entry(e) for e in flat._history) == \
+            tuple((e.input, e.output, e.next) for e in auto._state.passed_entries)
+    assert not flat.inputtable()
+    assert flat.finished
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_round_trip(layouts, seed: int):
+    rnd = random.Random(seed)
+    for rule in layouts.values():
+        for text in TEXTS:
+            auto = build_automaton(rule, text)
+            type_randomly(auto, export.loads(export.dumps(auto)), rnd)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_merged_round_trip(layouts, seed: int):
+    rnd = random.Random(seed)
+    for text in TEXTS:
+        merged = build_merged_automaton(layouts, text)
+        flat = export.loads(export.dumps(merged))
+        assert flat.layout_names == merged.layout_names
+        for names in [(), ("roman",), ("azik",), ("roman", "azik")]:
+            merged.select_layouts(*names)
+            flat.select_layouts(*names)
+            type_randomly(merged, flat, rnd)
+        with pytest.raises(Exception, match="unknown layout"):
+            flat.select_layouts("kana")
+
+
+def test_load_file(layouts, tmp_path):
+    auto = build_automaton(layouts["roman"], "こんにちは")
+    path = str(tmp_path / "a.emat")
+    export.dump(auto, path)
+    type_randomly(auto, export.load(path), random.Random(0))
+
+
+@pytest.mark.parametrize("corrupt", [
+    lambda b: b"",
+    lambda b: b[:export.HEADER.size - 1],
+    lambda b: b[:export.HEADER.size],
+    lambda b: b[:len(b) // 2],
+    lambda b: b[:-1],
+    lambda b: b"XXXX" + b[4:],
+], ids=["empty", "short_header", "header_only", "half", "last_byte", "magic"])
+def test_invalid_data(layouts, corrupt):
+    saved = export.dumps(build_automaton(layouts["roman"], "こんにちは"))
+    with pytest.raises(Exception, match="invalid automaton data"):
+        export.loads(corrupt(saved))
+
+
+def test_unsupported_version(layouts):
+    saved = bytearray(export.dumps(build_automaton(layouts["roman"], "こんにちは")))
+    saved[4:6] = (export.FORMAT_VERSION + 1).to_bytes(2, "little")
+    with pytest.raises(Exception, match="unsupported"):
+        export.loads(bytes(saved))
@@ -0,0 +1,53 @@
+# coding: utf-8
+from __future__ import annotations
+import random
+import pytest
+from emil import data
+from emil.rule import Rule, Entry
+from emil.builder import build_automaton
+from emil.analytics import KeystrokeAnalysis
+from emil.guide import fewest_keystrokes, rule_order
+from conftest import walk
+
+TEXTS = ["きょうはいいてんきですね", "しんぶんをよんだ", "ちょっとまって", "がっこうへいった", "てぃっしゅ"]
+
+
+def test_rule_order_and_fewest_keystrokes():
+    rule = Rule([Entry("xka", "か", ""), Entry("ka", "か", ""), Entry("na", "な", "")], data.DIRECT_INPUTTABLE)
+    auto = build_automaton(rule, "かな")
+    assert auto.tail_input_str() == "kana"
+    auto.set_guide_cost(rule_order(rule))
+    assert auto.tail_input_str() == "xkana"
+    auto.set_guide_cost(fewest_keystrokes)
+    assert auto.tail_input_str() == "kana"
+    # 入力中の Edge は入力済みの文字に合うものから選ぶ
+    auto.input("x")
+    assert auto.tail_input_str() == "kana"
+    assert auto.tail_print_str() == "かな"
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_fewest_keystrokes_is_shortest(rule: Rule, text: str):
+    auto = build_automaton(rule, text)
+    assert len(auto.tail_input_str()) == KeystrokeAnalysis(auto).min_keystrokes
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_tail_is_typeable_from_any_state(rule: Rule, seed: int):
+    rnd = random.Random(seed)
+    for text in TEXTS:
+        auto = build_automaton(rule, text)
+        for cost in (fewest_keystrokes, rule_order(rule)):
+            auto.set_guide_cost(cost)
+            auto.reset()
+            for key in walk(auto, rnd):
+                # 入力中の entry の途中（「ky」まで入力した状態など）からでも、残りを入力すると最後まで入力できる
+                state = auto._state
+                assert auto.outputted + auto.tail_print_str() == text
+                tail = auto.tail_input_str()
+                for i, k in enumerate(tail):
+                    assert auto.input(k).succeeded, (auto.head_input_str(), tail, i)
+                assert not auto.inputtable()
+                assert auto.outputted == text and auto.tail_print_str() == ""
+                auto._state = state
+                auto.input(key)
@@ -0,0 +1,63 @@
+# coding: utf-8
+from __future__ import annotations
+import random
+import pytest
+from emil import data
+from emil.rule import Rule, Entry
+from emil.builder import build_automaton
+from emil.lazy import LazyAutomaton
+from conftest import walk
+
+TEXT = "きょうはいいてんきですね、しんぶんをよみにがっこうへいきました。ちょっとまって。" * 4
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_matches_build_automaton(rule: Rule, seed: int):
+    rnd = random.Random(seed)
+    eager = build_automaton(rule, TEXT)
+    lazy = LazyAutomaton(rule, TEXT, segment_length=8)
+    for key in walk(eager, rnd):
+        assert lazy.inputtable() == eager.inputtable()
+        expected, result = eager.input(key), lazy.input(key)
+        assert result.succeeded == expected.succeeded
+        assert result.passed_entries == expected.passed_entries
+        assert (lazy.inputted, lazy.outputted) == (eager.inputted, eager.outputted)
+    assert not lazy.inputtable()
+
+
+def test_releases_nodes_behind_cursor(rule: Rule):
+    lazy = LazyAutomaton(rule, TEXT, segment_length=8)
+    keys = build_automaton(rule, TEXT).tail_input_str()
+    for i, key in enumerate(keys):
+        assert lazy.input(key).succeeded
+        # 入力中の区間より前の index と Node は手放している
+        assert all(p >= lazy._released for p in lazy._nodes)
+        assert all(s >= lazy._released for s in lazy._indexes)
+        if i == len(keys) // 2:
+            assert lazy._released > 0
+            assert len(lazy._indexes) <= 2
+
+
+def test_untypeable_text():
+    rule = Rule([Entry("ta", "た", ""), Entry("tt", "っ", "t")], data.DIRECT_INPUTTABLE)
+    with pytest.raises(Exception):
+        LazyAutomaton(rule, "たぁ")
+    # 文字はすべてルールにあるが、最後の「っ」は入力できない
+    with pytest.raises(Exception):
+        LazyAutomaton(rule, "たたっ", segment_length=1)
+    # 確かめずに作った場合は、入力がその区間に入ったときに送出する
+    lazy = LazyAutomaton(rule, "たたっ", segment_length=1, validate=False)
+    with pytest.raises(Exception):
+        for key in "tata":
+            lazy.input(key)
+
+
+def test_skip_validation(rule: Rule):
+    text = TEXT * 100
+    lazy = LazyAutomaton(rule, text, segment_length=8, validate=False)
+    # 長い出題文でも、最初の区間の index しか作らない
+    assert list(lazy._indexes) == [0]
+    assert len(lazy._boundaries) <= 3
+    validated = LazyAutomaton(rule, text, segment_length=8)
+    assert validated._boundaries[-1] == len(text)
+    assert list(validated._indexes) == [0]
@@ -0,0 +1,65 @@
+# coding: utf-8
+from __future__ import annotations
+import random
+from typing import List, Tuple
+import pytest
+from emil.rule import Rule
+from emil.automaton import Automaton
+from emil.builder import build_automaton
+from emil.replay import replay, replay_many
+from conftest import walk
+
+TEXTS = ["こんにちは", "きょうはいいてんきですね。", "がっこうへいった", "しんぶんをよんだ", "ちょっとまって"]
+
+
+def random_keys(auto: Automaton, rnd: random.Random) -> str:
+    """入力可能な文字を中心に、ときどき入力できない文字を混ぜた打鍵ログを作る"""
+    keys = []
+    for key in walk(auto, rnd, "xqz,"):
+        auto.input(key)
+        keys.append(key)
+    return "".join(keys)
+
+
+def expected(auto: Automaton, keys: str) -> Tuple[List[int], List[int], Automaton]:
+    auto.reset()
+    misses, boundaries = [], []
+    for i, k in enumerate(keys):
+        result = auto.input(k)
+        if not result.succeeded:
+            misses.append(i)
+        boundaries.extend([i] * len(result.passed_entries))
+    return misses, boundaries, auto
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_replay_matches_input(rule: Rule, seed: int):
+    rnd = random.Random(seed)
+    for text in TEXTS:
+        auto = build_automaton(rule, text)
+        keys = random_keys(auto, rnd)
+        keys = keys[:rnd.randint(0, len(keys))]
+        misses, boundaries, auto = expected(auto, keys)
+        for target in (build_automaton(rule, text), auto.compile()):
+            result = replay(target, keys)
+            assert result.misses == misses
+            assert result.boundaries == boundaries
+            assert result.passed_entries == auto._state.passed_entries
+            assert result.completed == (not auto.inputtable())
+            state = result.state(target)
+            assert state.inputted == auto.inputted
+            assert state.outputted == auto.outputted
+            assert state.inputtable == auto.inputtable()
+
+
+def test_replay_many_reuses_texts(rule: Rule):
+    rnd = random.Random(0)
+    pairs = []
+    for _ in range(3):
+        for text in TEXTS:
+            pairs.append((text, random_keys(build_automaton(rule, text), rnd)))
+    results = replay_many(rule, pairs, processes=1)
+    for (text, keys), result in zip(pairs, results):
+        misses, boundaries, auto = expected(build_automaton(rule, text), keys)
+        assert (result.misses, result.boundaries, result.completed) == (misses, boundaries, True)
+        assert result.passed_entries == auto._state.passed_entries
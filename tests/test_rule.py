@@ -0,0 +1,140 @@
+# coding: utf-8
+from __future__ import annotations
+from pathlib import Path
+import random
+import pytest
+from emil import data, export
+from emil.emil import Emil
+from emil.rule import Rule, Entry
+from emil.strings import Trie
+from conftest import TABLES
+
+RULE_FILE = data.filepath("google_ime_default_roman_table.txt")
+
+
+def trie_items(trie: Trie, convert):
+    """Trie のノードを (キー, 値) の組にして返す（値は convert で比べられる形にする）"""
+    items = []
+    stack = [("", trie.root)]
+    while stack:
+        key, node = stack.pop()
+        assert node or not key, f"empty node: {key!r}"
+        for c, child in node.items():
+            if c == Trie.VALUE:
+                items.append((key, convert(child)))
+            else:
+                stack.append((key + c, child))
+    return sorted(items)
+
+
+def derived(rule: Rule):
+    """Rule が Entry から計算した値を、Entry を input で表して比べられる形にする"""
+    def inputs(entries):
+        return [e.input for e in entries]
+
+    def edict(d):
+        return {k: inputs(v) for k, v in d.items()}
+
+    return {
+        "entries": [(e.input, e.output, e.next, e.has_only_common_prefix, e.is_direct_inputtable,
+                     inputs(e.dependencies), inputs(e.substitutables),
+                     [inputs(p) for p in e.dependency_paths])
+                    for e in rule.dependent_entry_list],
+        "input_edict": {k: e.input for k, e in rule.input_edict.items()},
+        "output_edict": edict(rule.output_edict),
+        "only_next_edict": edict(rule._Rule__only_next_edict),
+        "output_with_next_edict": edict(rule.output_with_next_edict),
+        "input_trie": trie_items(rule.input_trie, lambda e: e.input),
+        "output_suffix_trie": trie_items(rule.output_suffix_trie, lambda s: (
+            s.text, inputs(s.outputs), inputs(s.outputs_with_next), s.direct_inputtable)),
+        "max_output_length": rule.max_output_length,
+    }
+
+
+@pytest.mark.parametrize("table", TABLES)
+def test_cached_rule_matches_fresh_rule(tmp_path: Path, table: str):
+    path = data.filepath(table)
+    Rule.from_file_cached(path, data.DIRECT_INPUTTABLE, str(tmp_path))
+    cached = Rule.from_file_cached(path, data.DIRECT_INPUTTABLE, str(tmp_path))
+    fresh = Rule.from_file(path, data.DIRECT_INPUTTABLE)
+    assert cached.elist == fresh.elist
+    assert derived(cached) == derived(fresh)
+    # 保存した Entry の dict と Trie は同じ DependentEntry を参照する
+    entries = {id(e) for e in cached.dependent_entry_list}
+    assert all(id(e) in entries for e in cached.input_trie.values())
+    assert all(id(e) in entries for s in cached.output_suffix_trie.values() for e in s.outputs + s.outputs_with_next)
+
+
+@pytest.mark.parametrize("corrupt", [
+    lambda b: b"",
+    lambda b: b[:5],
+    lambda b: b[:len(b) // 2],
+    lambda b: b"XXXX" + b[4:],
+], ids=["empty", "short", "truncated", "magic"])
+def test_broken_cache_is_rebuilt(tmp_path: Path, corrupt):
+    rule = Rule.from_file_cached(RULE_FILE, data.DIRECT_INPUTTABLE, str(tmp_path))
+    cache_path, = tmp_path.glob("*.rule")
+    saved = cache_path.read_bytes()
+    cache_path.write_bytes(corrupt(saved))
+
+    assert Rule.load_compiled(str(cache_path)) is None
+    rebuilt = Rule.from_file_cached(RULE_FILE, data.DIRECT_INPUTTABLE, str(tmp_path))
+    assert rebuilt.elist == rule.elist
+    assert cache_path.read_bytes() == saved
+
+
+def build_or_error(emil: Emil, text: str):
+    try:
+        return export.dumps(emil.build(text))
+    except Exception as e:
+        return str(e)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_update_matches_fresh_rule(seed: int):
+    rnd = random.Random(seed)
+    rule = Rule.from_file(RULE_FILE, data.DIRECT_INPUTTABLE)
+    outputs = sorted({e.output for e in rule.elist if e.output})
+    texts = ["きょうはいいてんきですね", "がっこうへいった", "ちょっとまって", "しんぶんをよんだ", "かっぱ"]
+    emil = Emil(rule)
+    for text in texts:
+        build_or_error(emil, text)
+
+    for _ in range(60):
+        before = derived(rule)
+        generation = rule.generation
+        kind = rnd.choice(["add", "remove", "replace"])
+        e = rnd.choice(rule.elist)
+        try:
+            if kind == "remove":
+                rule.remove_entry(e.input)
+            elif kind == "replace":
+                rule.replace_entry(Entry(e.input, rnd.choice(outputs), rnd.choice(["", "", e.input[-1]])))
+            else:
+                key = "".join(rnd.choice("aiueokstnhmyrwgzdbp") for _ in range(rnd.randint(1, 3)))
+                next = rnd.choice(["", "", "", key[0]])
+                rule.add_entry(Entry(key, rnd.choice(outputs) if next == "" or rnd.random() < 0.5 else "", next))
+        except Exception:
+            # 失敗した update は変更前の状態に戻る
+            assert derived(rule) == before
+            assert rule.generation == generation
+            continue
+        assert rule.generation == generation + 1
+        fresh = Rule(list(rule.elist), rule.direct_inputtable)
+        assert derived(rule) == derived(fresh)
+        fresh_emil = Emil(fresh)
+        for text in texts:
+            assert build_or_error(emil, text) == build_or_error(fresh_emil, text)
+
+
+def test_failed_update_is_rolled_back():
+    rule = Rule.from_file(RULE_FILE, data.DIRECT_INPUTTABLE)
+    before, elist = derived(rule), list(rule.elist)
+    with pytest.raises(Exception):
+        # 追加は削除の後に行うので、先に成功する削除も含めて元に戻る
+        rule.update(add=[Entry("ka", "か", ""), Entry("ka", "か", "")], remove=["ka"])
+    with pytest.raises(Exception):
+        rule.remove_entry("no such input")
+    assert rule.elist == elist
+    assert derived(rule) == before
+    assert rule.generation == 0
@@ -0,0 +1,101 @@
+# coding: utf-8
+from __future__ import annotations
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from emil import data
+from emil.rule import Rule, Entry
+from emil.service import TypingService, KeyResult
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    def __init__(self):
+        super().__init__(1)
+        self.submitted = 0
+
+    def submit(self, *args, **kwargs):
+        self.submitted += 1
+        return super().submit(*args, **kwargs)
+
+
+def test_keys_in_one_tick_are_batched(roman_rule: Rule):
+    async def run():
+        service = TypingService(roman_rule, CountingExecutor())
+        await service.prepare("q", "かな")
+        service.open("a", "q")
+        service.open("b", "q")
+        futures = [service.submit("a", k) for k in "kana"] + [service.submit("b", k) for k in "kx"]
+        assert service.queue_depth == 6
+        results = await asyncio.gather(*futures)
+        assert results[:4] == [KeyResult(True, False)] * 3 + [KeyResult(True, True)]
+        assert results[4:] == [KeyResult(True, False), KeyResult(False, False)]
+        tick, = service.ticks
+        assert (tick.keystrokes, tick.sessions, tick.max_queue_depth) == (6, 2, 4)
+        assert service.queue_depth == 0
+        service.shutdown()
+    asyncio.run(run())
+
+
+def test_close_resolves_pending_keys(roman_rule: Rule):
+    async def run():
+        service = TypingService(roman_rule, CountingExecutor())
+        await service.prepare("q", "かな")
+        service.open("a", "q")
+        futures = [service.submit("a", k) for k in "ka"]
+        service.close("a")
+        assert await asyncio.gather(*futures) == [KeyResult(False, False)] * 2
+        assert "a" not in service.manager.sessions
+        with pytest.raises(Exception):
+            await service.input("a", "k")
+        service.shutdown()
+    asyncio.run(run())
+
+
+def test_prepare_builds_once(roman_rule: Rule):
+    async def run():
+        executor = CountingExecutor()
+        service = TypingService(roman_rule, executor)
+        await asyncio.gather(*[service.prepare("q", "こんにちは") for _ in range(5)])
+        await service.prepare("q", "こんにちは")
+        assert executor.submitted == 1
+        await service.prepare("r", "こんにちは")
+        assert executor.submitted == 2
+        service.shutdown()
+        executor.shutdown()
+    asyncio.run(run())
+
+
+def test_owned_process_pool(roman_rule: Rule):
+    async def run():
+        service = TypingService(roman_rule)
+        try:
+            await asyncio.gather(service.prepare("q", "こんにちは"), service.prepare("r", "かな"))
+            service.open("a", "q")
+            results = await asyncio.gather(*[service.submit("a", k) for k in "konnnitiha"])
+            assert all(r.accepted for r in results) and results[-1].finished
+        finally:
+            service.shutdown()
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("owned", [True, False])
+def test_rule_update_reaches_builds(owned: bool):
+    rule = Rule.from_file(data.filepath("google_ime_default_roman_table.txt"), data.DIRECT_INPUTTABLE)
+
+    async def run():
+        service = TypingService(rule) if owned else TypingService(rule, CountingExecutor())
+        try:
+            await service.prepare("hello", "こんにちは")
+            await service.prepare("kana", "かな")
+            rule.add_entry(Entry("qqj", "★", ""))
+            rule.replace_entry(Entry("ka", "か", ""))
+            await service.prepare("star", "★")
+            # 変わった表示文字列を含む問題だけ登録を取り消す
+            assert ("hello", None) in service.manager.automata
+            assert ("kana", None) not in service.manager.automata
+            service.open("a", "star")
+            results = await asyncio.gather(*[service.submit("a", k) for k in "qqj"])
+            assert results[-1] == KeyResult(True, True)
+        finally:
+            service.shutdown()
+    asyncio.run(run())
@@ -0,0 +1,157 @@
+# coding: utf-8
+from __future__ import annotations
+import random
+import time
+import pytest
+from emil.rule import Rule
+from emil.builder import build_automaton
+from emil.session import SessionManager, SharedAutomaton, Session, SessionHandle
+
+TEXT = "きょうはいいてんきですね、しんぶんをよみにいきました"
+
+
+@pytest.fixture(scope="module")
+def keys(roman_rule: Rule) -> str:
+    return build_automaton(roman_rule, TEXT).tail_input_str()
+
+
+def test_restore_rejects_overwritten_handles(roman_rule: Rule, keys: str):
+    session = Session(SharedAutomaton.from_automaton(build_automaton(roman_rule, TEXT)))
+    handles = []
+    for key in keys[:12]:
+        assert session.input(key)
+        handles.append(session.snapshot())
+    # 途中まで戻して入力し直すと、戻した位置より後の履歴は上書きされる
+    session.restore(handles[3])
+    offset = session.history_offset
+    for key in keys[4:8]:
+        assert session.input(key)
+    assert session.epoch == 1
+    later = [h for h in handles[4:] if SessionHandle.unpack(h).history_offset > offset]
+    assert later
+    for h in later:
+        with pytest.raises(Exception, match="stale"):
+            session.restore(h)
+    # 上書きした位置までの handle は使える
+    for h in handles[:4]:
+        session.restore(h)
+    session.restore(handles[3])
+    assert session.history_offset == offset
+    with pytest.raises(Exception):
+        session.restore(b"\xff" * 12)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_strings_match_compiled_after_restores(roman_rule: Rule, keys: str, seed: int):
+    rnd = random.Random(seed)
+    compiled = build_automaton(roman_rule, TEXT).compile()
+    session = Session(SharedAutomaton(compiled))
+    snapshots = [(session.snapshot(), compiled._state)]
+    for _ in range(300):
+        action = rnd.random()
+        if action < 0.1:
+            snapshot, state = rnd.choice(snapshots)
+            try:
+                session.restore(snapshot)
+            except Exception:
+                continue
+            compiled._state = state
+        else:
+            inputtable = sorted(compiled.inputtable())
+            if not inputtable:
+                continue
+            key = rnd.choice(inputtable) if action < 0.95 else "q"
+            assert session.input(key) == compiled.input(key).succeeded
+            if rnd.random() < 0.3:
+                snapshots.append((session.snapshot(), compiled._state))
+        assert session.state_id == compiled._state.id
+        assert session.inputted == compiled.inputted
+        assert session.outputted == compiled.outputted
+        assert session.passed_entries == compiled._state.passed_entries
+        assert session.inputtable() == compiled.inputtable()
+
+
+def test_dumps_loads_across_managers(roman_rule: Rule, keys: str):
+    source, target = SessionManager(), SessionManager()
+    for manager in (source, target):
+        manager.register("q", build_automaton(roman_rule, TEXT))
+    session = source.open("s", "q")
+    for key in keys[:6]:
+        session.input(key)
+    handle = session.snapshot()
+    for key in keys[6:10]:
+        session.input(key)
+    session.restore(handle)
+    for key in keys[6:10]:
+        session.input(key)
+    assert session.epoch == 1
+    dumped = source.dumps("s")
+
+    loaded = target.loads("t", dumped)
+    assert (loaded.state_id, loaded.history_offset, loaded.epoch) == \
+        (session.state_id, session.history_offset, session.epoch)
+    assert (loaded.inputted, loaded.outputted) == (session.inputted, session.outputted)
+    assert loaded.passed_entries == session.passed_entries
+    # 以降の入力も元のセッションと同じ結果になる
+    for key in keys[10:]:
+        assert loaded.input(key) and session.input(key)
+        assert (loaded.inputted, loaded.outputted) == (session.inputted, session.outputted)
+    assert not loaded.inputtable()
+    assert target.dumps("t") == source.dumps("s")
+
+    other = SessionManager()
+    other.register("q", build_automaton(roman_rule, "こんにちは"))
+    with pytest.raises(Exception, match="another automaton"):
+        other.loads("t", dumped)
+
+
+def test_loads_large_epoch(roman_rule: Rule, keys: str):
+    shared = SharedAutomaton.from_automaton(build_automaton(roman_rule, TEXT))
+    session = Session(shared)
+    for key in keys[:5]:
+        session.input(key)
+    old = session.snapshot()
+    header = Session._DUMP_HEADER
+    dumped = session.dumps()
+    fields = list(header.unpack_from(dumped))
+    fields[-1] = 0xFFFFFFFF
+    started = time.perf_counter()
+    loaded = Session.loads(shared, header.pack(*fields) + dumped[header.size:])
+    assert time.perf_counter() - started < 0.1
+    assert loaded.epoch == loaded.oldest_epoch == 0xFFFFFFFF
+    # 上書きの記録を持たないので、loads より前の epoch の snapshot は restore できない
+    with pytest.raises(Exception, match="stale"):
+        loaded.restore(old)
+    loaded.restore(loaded.snapshot())
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_stale_handles_match_full_log(roman_rule: Rule, keys: str, seed: int):
+    """上書きの記録をすべて持つ場合と同じ handle を restore できる"""
+    rnd = random.Random(seed)
+    session = Session(SharedAutomaton.from_automaton(build_automaton(roman_rule, TEXT)))
+    # epoch i から i + 1 に変わったときに上書きした位置
+    log = []
+    handles = [session.handle]
+    for _ in range(400):
+        if rnd.random() < 0.2:
+            handle = rnd.choice(handles)
+            stale = any(offset < handle.history_offset for offset in log[handle.epoch:])
+            try:
+                session.restore(handle.pack())
+                assert not stale
+            except Exception as e:
+                assert stale and "stale" in str(e)
+        else:
+            inputtable = sorted(session.inputtable())
+            if not inputtable:
+                session.reset()
+                continue
+            offset, epoch = session.history_offset, session.epoch
+            session.input(rnd.choice(inputtable))
+            if session.epoch != epoch:
+                log.append(offset)
+            handles.append(session.handle)
+    assert session.epoch == len(log) > 0
+    # 記録は履歴の長さまでしか増えない
+    assert len(session._overwritten_offsets) <= len(session.history) + 1
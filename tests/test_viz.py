@@ -0,0 +1,46 @@
+# coding: utf-8
+from __future__ import annotations
+import re
+import time
+import pytest
+from emil import viz
+from emil.rule import Rule
+from emil.builder import build_automaton
+
+# 「っ」が連なると、同じ Node の間に入力の仕方の違う Edge が多数できる
+TEXTS = ["っ" * 40 + "か", "ちょっとしゅっぱつしんこう" * 20]
+EDGE = re.compile(r"^  (n\d+) -> (n\d+) \[$", re.MULTILINE)
+
+
+def node_pairs(auto):
+    """(始点の名前, 終点の名前) ごとの Edge の数"""
+    pairs = {}
+    for node, position in viz.walk(auto._start_node):
+        for e in node.next_edges:
+            key = (f"n{position}", f"n{position + sum(len(x.output) for x in e.entries)}")
+            pairs[key] = pairs.get(key, 0) + 1
+    return pairs
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_render(rule: Rule, text: str):
+    auto = build_automaton(rule, text)
+    pairs = node_pairs(auto)
+    # 到達済みの Node をたどり直さないので、Edge が多くてもすぐに終わる
+    started = time.perf_counter()
+    rendered = viz.render(auto)
+    assert time.perf_counter() - started < 2.0
+    assert len(EDGE.findall(rendered)) == sum(pairs.values())
+    assert len(re.findall(r"^  n\d+;$", rendered, re.MULTILINE)) == len(viz.walk(auto._start_node))
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_render_collapsed(rule: Rule, text: str):
+    auto = build_automaton(rule, text)
+    pairs = node_pairs(auto)
+    rendered = viz.render(auto, collapse=True)
+    lines = EDGE.findall(rendered)
+    # Node の組ごとに 1 本で、ラベルにはまとめた Edge の数だけ行がある
+    assert sorted(lines) == sorted(pairs)
+    labels = re.findall(r'label = "(.*)"$', rendered, re.MULTILINE)
+    assert sorted(label.count("\\n") + 1 for label in labels) == sorted(pairs.values())